@@ -0,0 +1,203 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Limit how many image sets build at once.
+
+Each image set takes a number of slots (its weight) out of a fixed total
+before it starts building.  Image sets that cannot start yet wait in a
+queue ordered by priority and then by arrival; only the head of the queue
+may start, so a heavy image set is not starved by lighter ones behind it.
+The queue is kept in a file next to the MultiPIDFile used for parallel
+builds, and is protected by a lock of its own.
+"""
+
+from __future__ import print_function
+
+import contextlib
+import errno
+import os
+import time
+
+from cdimage import osextras
+from cdimage.locking import Lock
+from cdimage.log import logger
+
+__metaclass__ = type
+
+
+# Default weights of image types.  DVDs use about twice as much disk
+# space and time as other images.
+IMAGE_TYPE_WEIGHTS = {
+    "dvd": 2,
+}
+
+# How often to check whether a queued image set may start, in seconds.
+POLL_INTERVAL = 10
+
+# How long to wait for the queue's lock, in seconds.
+LOCK_TIMEOUT = 60
+
+
+class AdmissionEntry:
+    def __init__(self, pid, ticket, weight, priority, running, description):
+        self.pid = pid
+        self.ticket = ticket
+        self.weight = weight
+        self.priority = priority
+        self.running = running
+        self.description = description
+
+    @classmethod
+    def parse(cls, line):
+        """Parse a line of the queue file, returning None if malformed."""
+        fields = line.rstrip("\n").split("\t", 5)
+        if len(fields) != 6:
+            return None
+        pid, ticket, weight, priority, state, description = fields
+        try:
+            return cls(
+                int(pid), int(ticket), int(weight), int(priority),
+                state == "running", description)
+        except ValueError:
+            return None
+
+    def __str__(self):
+        return "\t".join([
+            str(self.pid), str(self.ticket), str(self.weight),
+            str(self.priority), "running" if self.running else "queued",
+            self.description])
+
+
+class AdmissionController:
+    """A queue of image sets waiting for build slots."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.lock = Lock("%s.lock" % path, timeout=LOCK_TIMEOUT)
+
+    def _read(self):
+        # Must be called with self.lock held.
+        entries = []
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    entry = AdmissionEntry.parse(line)
+                    if entry is None:
+                        logger.warning(
+                            "Ignoring malformed line in %s: %r" % (
+                                self.path, line))
+                    elif osextras.pid_exists(entry.pid):
+                        entries.append(entry)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        return entries
+
+    def _write(self, entries):
+        # Must be called with self.lock held.
+        if entries:
+            with open(self.path, "w") as fd:
+                for entry in entries:
+                    print(entry, file=fd)
+        else:
+            osextras.unlink_force(self.path)
+
+    @staticmethod
+    def _queue_order(entry):
+        return (-entry.priority, entry.ticket)
+
+    def status(self):
+        """Return the running and queued entries, in queue order."""
+        with self.lock:
+            entries = self._read()
+        running = [entry for entry in entries if entry.running]
+        queued = sorted(
+            (entry for entry in entries if not entry.running),
+            key=self._queue_order)
+        return running, queued
+
+    def enqueue(self, pid, weight=1, priority=0, description=""):
+        with self.lock:
+            entries = self._read()
+            ticket = max([entry.ticket for entry in entries] + [0]) + 1
+            entries.append(AdmissionEntry(
+                pid, ticket, weight, priority, False, description))
+            self._write(entries)
+
+    def try_admit(self, pid):
+        """Start PID's image set if it is at the head of the queue and fits.
+
+        Returns True if it is now running.
+        """
+        with self.lock:
+            entries = self._read()
+            queued = sorted(
+                (entry for entry in entries if not entry.running),
+                key=self._queue_order)
+            if not queued or queued[0].pid != pid:
+                return any(
+                    entry.running and entry.pid == pid for entry in entries)
+            head = queued[0]
+            used = sum(entry.weight for entry in entries if entry.running)
+            # An image set heavier than all the slots may still run on its
+            # own.
+            if used and used + head.weight > self.slots:
+                return False
+            head.running = True
+            self._write(entries)
+            return True
+
+    def release(self, pid):
+        with self.lock:
+            self._write(
+                [entry for entry in self._read() if entry.pid != pid])
+
+    @contextlib.contextmanager
+    def held(self, pid, weight=1, priority=0, description="",
+             on_wait=None):
+        """Wait for slots for PID's image set, and hold them."""
+        self.enqueue(
+            pid, weight=weight, priority=priority, description=description)
+        try:
+            waited = False
+            while not self.try_admit(pid):
+                if not waited and on_wait is not None:
+                    on_wait()
+                waited = True
+                time.sleep(POLL_INTERVAL)
+            yield
+        finally:
+            self.release(pid)
+
+
+def admission_controller(config):
+    """Return the admission controller, or None if builds are unlimited."""
+    slots = int(config["CDIMAGE_BUILD_SLOTS"] or 0)
+    if slots <= 0:
+        return None
+    return AdmissionController(
+        os.path.join(config.root, "etc", ".build-slots"), slots)
+
+
+def build_weight(config):
+    if config["CDIMAGE_BUILD_WEIGHT"]:
+        return int(config["CDIMAGE_BUILD_WEIGHT"])
+    return IMAGE_TYPE_WEIGHTS.get(config.image_type, 1)
+
+
+def build_description(config):
+    return "%s/%s/%s" % (
+        config.project, config.full_series, config.image_type)
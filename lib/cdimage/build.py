@@ -18,7 +18,7 @@
 from __future__ import print_function
 
 import contextlib
-import gzip
+from functools import partial
 import os
 import shutil
 import signal
@@ -30,19 +30,31 @@ import time
 import traceback
 
 from cdimage import osextras
+from cdimage.admission import (
+    admission_controller,
+    build_description,
+    build_weight,
+)
+from cdimage.atomicfile import AtomicFile
 from cdimage.build_id import next_build_id
 from cdimage.check_installable import check_installable
+from cdimage.deb822 import read_index
+from cdimage.debfile import ControlCache, DebFileError, read_data_file
 from cdimage.germinate import Germination
+from cdimage.launchpad import link_cache_summary
 from cdimage.livefs import (
     LiveBuildsFailed,
+    LiveDownloads,
     download_live_filesystems,
     live_output_directory,
     run_live_builds,
 )
+from cdimage.locking import Lock, LockError
 from cdimage.log import logger, reset_logging
 from cdimage.mail import get_notify_addresses, send_mail
 from cdimage.mirror import find_mirror, trigger_mirrors
 from cdimage.multipidfile import MultiPIDFile
+from cdimage.stages import StageGraph
 from cdimage.tracker import tracker_set_rebuild_status
 from cdimage.tree import Publisher, Tree
 from cdimage.config import Touch
@@ -50,6 +62,16 @@ from cdimage.config import Touch
 __metaclass__ = type
 
 
+# Maximum number of independent build stages to run at once.
+STAGE_JOBS = 4
+
+# How long to wait for the archive sync lock before syncing the mirror,
+# and how long parallel builds wait for someone else's sync to finish, in
+# seconds.
+SYNC_LOCK_TIMEOUT = 60
+SYNC_WAIT_TIMEOUT = 60 * 60
+
+
 @contextlib.contextmanager
 def lock_build_image_set(config):
     project = config.project
@@ -63,15 +85,35 @@ def lock_build_image_set(config):
         config.root, "etc",
         ".lock-build-image-set-%s-%s-%s" % (
             project, full_series, config.image_type))
+    lock = Lock(lock_path, timeout=0)
     try:
-        subprocess.check_call(["lockfile", "-l", "7200", "-r", "0", lock_path])
-    except subprocess.CalledProcessError:
+        lock.acquire()
+    except LockError:
         logger.error("Another image set is already building!")
         raise
     try:
         yield
     finally:
-        osextras.unlink_force(lock_path)
+        lock.release()
+
+
+@contextlib.contextmanager
+def admit_build_image_set(config):
+    """Wait until there are enough build slots free for this image set."""
+    controller = admission_controller(config)
+    if controller is None:
+        yield
+        return
+    description = build_description(config)
+
+    def on_wait():
+        logger.info("Waiting for a build slot for %s ..." % description)
+
+    with controller.held(
+            os.getpid(), weight=build_weight(config),
+            priority=int(config["CDIMAGE_BUILD_PRIORITY"] or 0),
+            description=description, on_wait=on_wait):
+        yield
 
 
 def configure_for_project(config):
@@ -181,10 +223,11 @@ def anonftpsync(config):
     target = os.path.join(config.root, "ftp")
     fqdn = socket.getfqdn()
     lock_base = "Archive-Update-in-Progress-%s" % fqdn
-    lock = os.path.join(target, lock_base)
     pkglist = "--include-from=" + config["RSYNC_PKGLIST_PATH"]
-    if subprocess.call(
-            ["lockfile", "-!", "-l", "43200", "-r", "0", lock]) == 0:
+    lock = Lock(os.path.join(target, lock_base), timeout=0)
+    try:
+        lock.acquire()
+    except LockError:
         raise Exception(
             "%s is unable to start rsync; lock file exists." % fqdn)
     try:
@@ -237,7 +280,7 @@ def anonftpsync(config):
                 ["savelog", log_path],
                 stdout=devnull, stderr=subprocess.STDOUT)
     finally:
-        osextras.unlink_force(lock)
+        lock.release()
 
 
 def sync_local_mirror(config, multipidfile_state):
@@ -245,43 +288,44 @@ def sync_local_mirror(config, multipidfile_state):
         return
 
     capproject = config.capproject
-    sync_lock = os.path.join(config.root, "etc", ".lock-archive-sync")
+    sync_lock = Lock(os.path.join(config.root, "etc", ".lock-archive-sync"))
     if not multipidfile_state:
         log_marker("Syncing %s mirror" % capproject)
         # Acquire lock to allow parallel builds to ensure a consistent
         # archive.
         try:
-            subprocess.check_call(["lockfile", "-r", "4", sync_lock])
-        except subprocess.CalledProcessError:
+            sync_lock.acquire(timeout=SYNC_LOCK_TIMEOUT)
+        except LockError:
             logger.error("Couldn't acquire archive sync lock!")
             raise
         try:
             anonftpsync(config)
         finally:
-            osextras.unlink_force(sync_lock)
+            sync_lock.release()
     else:
         log_marker(
             "Parallel build; waiting for %s mirror to sync" % capproject)
         try:
-            subprocess.check_call(["lockfile", "-8", "-r", "450", sync_lock])
-        except subprocess.CalledProcessError:
+            sync_lock.acquire(timeout=SYNC_WAIT_TIMEOUT)
+        except LockError:
             logger.error("Timed out waiting for archive sync lock!")
             raise
-        osextras.unlink_force(sync_lock)
-
+        sync_lock.release()
 
-def _dpkg_field(path, field):
-    return subprocess.check_output(
-        ["dpkg", "-f", path, field], universal_newlines=True).rstrip("\n")
 
+def _find_packages(path):
+    """Yield (path, name, architecture, extension) for each package in PATH.
 
-def _find_endswith(path, suffixes):
+    Packages are found by their file name, NAME_VERSION_ARCH.EXTENSION.
+    """
     for dirpath, _, filenames in os.walk(path):
         for filename in filenames:
-            for suffix in suffixes:
-                if filename.endswith(suffix):
-                    yield dirpath, filename
-                    break
+            base, extension = os.path.splitext(filename)
+            if extension not in (".deb", ".udeb") or "_" not in base:
+                continue
+            name = base.split("_", 1)[0]
+            arch = base.rsplit("_", 1)[1]
+            yield os.path.join(dirpath, filename), name, arch, extension
 
 
 def update_local_indices(config):
@@ -296,43 +340,51 @@ def update_local_indices(config):
     osextras.ensuredir(dists)
     osextras.ensuredir(indices)
 
+    # Walk the pool and read each package's control fields only once,
+    # whichever architectures it applies to.  Packages for other
+    # architectures are not read at all.
+    control_cache = ControlCache(os.path.join(database, "control-cache"))
+    wanted_arches = set(config.cpuarches + ["all"])
+    debs = []
+    udebs = []
+    for path, name, arch, extension in _find_packages(pool):
+        if arch not in wanted_arches:
+            continue
+        fields = control_cache.fields(path)
+        rel_path = os.path.relpath(path, packages)
+        priority = fields.get("Priority", "")
+        if extension == ".deb":
+            section = fields.get("Section", "").split("/")[-1]
+            debs.append((
+                arch, rel_path,
+                "%s\t%s\tlocal/%s" % (name, priority, section)))
+        else:
+            udebs.append((
+                arch, rel_path,
+                "%s\t%s\tlocal/debian-installer" % (name, priority)))
+    control_cache.save()
+
     for arch in config.cpuarches:
-        binary_list_path = os.path.join(
-            dists, "%s_local_binary-%s.list" % (config.series, arch))
-        di_binary_list_path = os.path.join(
-            dists, "%s_local_debian-installer_binary-%s.list" % (
-                config.series, arch))
-        override_path = os.path.join(
-            indices, "override.%s.local.%s" % (config.series, arch))
-        di_override_path = os.path.join(
-            indices, "override.%s.local.debian-installer.%s" % (
-                config.series, arch))
-
-        with open(binary_list_path, "w") as binary_list, \
-                open(di_binary_list_path, "w") as di_binary_list, \
-                open(override_path, "w") as override, \
-                open(di_override_path, "w") as di_override:
-            for dirpath, deb in _find_endswith(
-                    pool, ["_%s.deb" % arch, "_all.deb"]):
-                deb_path = os.path.join(dirpath, deb)
-                print(os.path.relpath(deb_path, packages), file=binary_list)
-                name = deb.split("_", 1)[0]
-                section = _dpkg_field(deb_path, "Section").split("/")[-1]
-                priority = _dpkg_field(deb_path, "Priority")
-                print(
-                    "%s\t%s\tlocal/%s" % (name, priority, section),
-                    file=override)
-
-            for dirpath, udeb in _find_endswith(
-                    pool, ["_%s.udeb" % arch, "_all.udeb"]):
-                udeb_path = os.path.join(dirpath, udeb)
-                print(
-                    os.path.relpath(udeb_path, packages), file=di_binary_list)
-                name = udeb.split("_", 1)[0]
-                priority = _dpkg_field(udeb_path, "Priority")
-                print(
-                    "%s\t%s\tlocal/debian-installer" % (name, priority),
-                    file=di_override)
+        arch_debs = [deb for deb in debs if deb[0] in (arch, "all")]
+        arch_udebs = [udeb for udeb in udebs if udeb[0] in (arch, "all")]
+        osextras.write_lines(
+            os.path.join(
+                dists, "%s_local_binary-%s.list" % (config.series, arch)),
+            [rel_path for _, rel_path, _ in arch_debs])
+        osextras.write_lines(
+            os.path.join(
+                dists, "%s_local_debian-installer_binary-%s.list" % (
+                    config.series, arch)),
+            [rel_path for _, rel_path, _ in arch_udebs])
+        osextras.write_lines(
+            os.path.join(
+                indices, "override.%s.local.%s" % (config.series, arch)),
+            [override for _, _, override in arch_debs])
+        osextras.write_lines(
+            os.path.join(
+                indices, "override.%s.local.debian-installer.%s" % (
+                    config.series, arch)),
+            [override for _, _, override in arch_udebs])
 
         osextras.ensuredir(os.path.join(
             packages, "dists", config.series, "local", "binary-%s" % arch))
@@ -413,9 +465,9 @@ def add_android_support(config, arch, output_dir):
             os.path.join(output_dir, recovery_img))
 
 
-def build_livecd_base(config):
+def build_livecd_base(config, downloads=None):
     log_marker("Downloading live filesystem images")
-    download_live_filesystems(config)
+    download_live_filesystems(config, downloads=downloads)
 
     if (config.project in ("ubuntu-server") and
             config.image_type == "daily-preinstalled"):
@@ -526,37 +578,39 @@ def extract_debootstrap(config):
 
     osextras.ensuredir(output_dir)
 
+    # Architectures often share a udeb, so only extract from each once.
+    extracted = {}
     for fullarch in config.arches:
         arch = fullarch.split("+")[0]
         mirror = find_mirror(config, arch)
-        # TODO: This might be more sensible with python-debian or python-apt.
         packages_path = os.path.join(
             mirror, "dists", config.series, "main", "debian-installer",
             "binary-%s" % arch, "Packages.gz")
-        with gzip.GzipFile(packages_path, "rb") as packages:
-            grep_dctrl = subprocess.Popen(
-                ["grep-dctrl", "-nsFilename", "-PX", "debootstrap-udeb"],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            udeb, _ = grep_dctrl.communicate(packages.read())
-        if not isinstance(udeb, str):
-            udeb = udeb.decode()
-        udeb = udeb.rstrip("\n")
+        udeb = ""
+        for paragraph in read_index(packages_path):
+            if paragraph.get("Package") == "debootstrap-udeb":
+                udeb = paragraph.get("Filename", "")
+                break
         udeb_path = os.path.join(mirror, udeb)
         if not udeb or not os.path.exists(udeb_path):
             logger.warning(
                 "No debootstrap-udeb for %s/%s!" % (config.series, arch))
             continue
-        # TODO: With python-debian, we could extract the one file we need
-        # directly.
-        unpack_dir = os.path.join(output_dir, "unpack-%s" % fullarch)
-        try:
-            shutil.rmtree(unpack_dir)
-        except OSError:
-            pass
-        subprocess.check_call(["dpkg", "-x", udeb_path, unpack_dir])
-        shutil.copy2(
-            os.path.join(unpack_dir, _debootstrap_script(config)),
-            os.path.join(output_dir, "%s-%s" % (config.series, fullarch)))
+        target = os.path.join(
+            output_dir, "%s-%s" % (config.series, fullarch))
+        if udeb_path in extracted:
+            shutil.copy2(extracted[udeb_path], target)
+            continue
+        script = read_data_file(udeb_path, _debootstrap_script(config))
+        if script is None:
+            raise DebFileError(
+                "%s has no %s" % (udeb_path, _debootstrap_script(config)))
+        info, contents = script
+        with open(target, "wb") as f:
+            f.write(contents)
+        os.chmod(target, info.mode & 0o7777)
+        os.utime(target, (info.mtime, info.mtime))
+        extracted[udeb_path] = target
 
 
 def configure_splash(config):
@@ -662,6 +716,29 @@ def is_live_fs_only(config):
     return live_fs_only
 
 
+def write_stage_timings(config, timings):
+    """Record how long each stage of an image build took."""
+    path = os.path.join(
+        config.root, "scratch", config.project, config.full_series,
+        config.image_type, "stage-timings")
+    osextras.ensuredir(os.path.dirname(path))
+    with AtomicFile(path) as timings_file:
+        for name, seconds in timings.items():
+            print("%s\t%.1f" % (name, seconds), file=timings_file)
+
+
+def want_live_downloads(config):
+    """Will this image set download live filesystems after building them?"""
+    if config["UBUNTU_DEFAULTS_LOCALE"]:
+        return False
+    elif is_live_fs_only(config):
+        return True
+    else:
+        return bool(
+            config["CDIMAGE_LIVE"] or config["CDIMAGE_SQUASHFS_BASE"] or
+            config["CDIMAGE_PREINSTALLED"])
+
+
 def build_image_set_locked(config, options, multipidfile_state):
     image_type = config.image_type
     config["CDIMAGE_DATE"] = date = next_build_id(config, image_type)
@@ -671,51 +748,132 @@ def build_image_set_locked(config, options, multipidfile_state):
         configure_for_project(config)
         log_path = open_log(config)
 
-        if want_live_builds(options):
-            log_marker("Building live filesystems")
-            live_successful = run_live_builds(config)
-            config.limit_arches(live_successful)
-        else:
-            tracker_set_rebuild_status(config, [0, 1], 2)
+        downloads = None
+        if want_live_builds(options) and want_live_downloads(config):
+            # Start downloading each architecture's live filesystem as soon
+            # as its build succeeds.
+            downloads = LiveDownloads(config)
+
+        stages = StageGraph()
+
+        live_successful = []
+
+        def live_builds():
+            if want_live_builds(options):
+                log_marker("Building live filesystems")
+                live_successful.append(run_live_builds(
+                    config,
+                    on_success=downloads.start if downloads else None))
+            else:
+                tracker_set_rebuild_status(config, [0, 1], 2)
+
+        # Live builds wait for their child processes using SIGCHLD, which
+        # is only delivered to the main thread.
+        stages.add("live-builds", live_builds, main_thread=True)
 
         if not is_live_fs_only(config):
-            sync_local_mirror(config, multipidfile_state)
+            # Neither the mirror sync nor the britney build depend on which
+            # architectures' live filesystems built successfully.
+            stages.add(
+                "sync-mirror",
+                partial(sync_local_mirror, config, multipidfile_state))
+
+            stages.add("britney", partial(build_britney, config))
+
+        def limit_arches():
+            if live_successful:
+                config.limit_arches(live_successful[0])
+            if downloads is not None:
+                # Finding artefacts talks to Launchpad, which must stay in
+                # the main thread.
+                for arch in config.arches:
+                    downloads.start(arch)
+
+        # The configuration is shared by all stages, so only limit the
+        # architectures once nothing else is reading them.
+        stages.add(
+            "limit-arches", limit_arches,
+            requires=["live-builds", "sync-mirror", "britney"],
+            main_thread=True)
 
+        if not is_live_fs_only(config):
             if config["LOCAL"]:
-                log_marker("Updating archive of local packages")
-                update_local_indices(config)
+                def local_indices():
+                    log_marker("Updating archive of local packages")
+                    update_local_indices(config)
 
-            build_britney(config)
+                stages.add(
+                    "local-indices", local_indices,
+                    requires=["limit-arches", "sync-mirror"])
 
-            log_marker("Extracting debootstrap scripts")
-            extract_debootstrap(config)
+            def debootstrap():
+                log_marker("Extracting debootstrap scripts")
+                extract_debootstrap(config)
+
+            stages.add(
+                "debootstrap", debootstrap,
+                requires=["limit-arches", "sync-mirror", "local-indices"])
 
         if config["UBUNTU_DEFAULTS_LOCALE"]:
-            build_ubuntu_defaults_locale(config)
+            stages.add(
+                "defaults-locale",
+                partial(build_ubuntu_defaults_locale, config),
+                requires=list(stages.stages))
         elif is_live_fs_only(config):
-            build_livecd_base(config)
+            stages.add(
+                "livecd-base",
+                partial(build_livecd_base, config, downloads=downloads),
+                requires=list(stages.stages))
         else:
             if not config["CDIMAGE_PREINSTALLED"]:
-                log_marker("Germinating")
-                germination = Germination(config)
-                germination.run()
+                def germinate():
+                    log_marker("Germinating")
+                    germination = Germination(config)
+                    germination.run()
+
+                    germinate_output = germination.output(config.project)
+                    if germinate_output.tasks_are_current(
+                            germinate_output.tasks_fingerprint()):
+                        log_marker("Reusing previous task lists")
+                        germinate_output.reuse_tasks()
+                        return
+
+                    log_marker("Generating new task lists")
+                    germinate_output.write_tasks()
 
-                log_marker("Generating new task lists")
-                germinate_output = germination.output(config.project)
-                germinate_output.write_tasks()
+                    log_marker("Checking for other task changes")
+                    germinate_output.update_tasks(date)
 
-                log_marker("Checking for other task changes")
-                germinate_output.update_tasks(date)
+                stages.add(
+                    "germinate", germinate,
+                    requires=["limit-arches", "sync-mirror", "local-indices"])
 
             if (config["CDIMAGE_LIVE"] or config["CDIMAGE_SQUASHFS_BASE"] or
                     config["CDIMAGE_PREINSTALLED"]):
-                log_marker("Downloading live filesystem images")
-                download_live_filesystems(config)
+                def live_downloads():
+                    log_marker("Downloading live filesystem images")
+                    download_live_filesystems(config, downloads=downloads)
 
-            configure_splash(config)
+                stages.add(
+                    "live-downloads", live_downloads,
+                    requires=["limit-arches"])
 
-            run_debian_cd(config)
-            fix_permissions(config)
+            def debian_cd():
+                configure_splash(config)
+
+                run_debian_cd(config)
+                fix_permissions(config)
+
+            stages.add(
+                "debian-cd", debian_cd, requires=list(stages.stages))
+
+        try:
+            stages.run(jobs=int(config["CDIMAGE_STAGE_JOBS"] or STAGE_JOBS))
+        finally:
+            write_stage_timings(config, stages.timings)
+            summary = link_cache_summary()
+            if summary:
+                logger.info("Launchpad link cache: %s" % summary)
 
         # Temporarily turned off for live builds.
         if (config["CDIMAGE_INSTALL_BASE"] and
@@ -785,7 +943,7 @@ def build_image_set(config, options):
     with handle_signals():
         multipidfile = MultiPIDFile(
             os.path.join(config.root, "etc", ".build-image-set-pids"))
-        with lock_build_image_set(config):
+        with lock_build_image_set(config), admit_build_image_set(config):
             with multipidfile.held(os.getpid()) as multipidfile_state:
                 return build_image_set_locked(
                     config, options, multipidfile_state)
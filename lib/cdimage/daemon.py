@@ -0,0 +1,386 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A long-running service that runs cdimage commands on request.
+
+Requests name a project, a command, and the environment to run it in,
+exactly as for-project would.  They arrive either on a UNIX socket, where
+the client passes its standard file descriptors for the command to use and
+waits for the command's exit status, or as JSON files dropped into a spool
+directory.  Each request runs in a worker process forked
+from the daemon, so the cdimage modules are already imported; commands
+from cdimage's own bin directory run their main functions in that process
+rather than starting a new interpreter.  Builds take the same locks as
+they would when run from cron.
+
+Only the imported modules are kept warm.  Each worker still reads its
+configuration and logs in to Launchpad itself, since the configuration
+depends on the request's environment and launchpadlib connections cannot
+be shared across fork.
+
+Passing file descriptors over the socket needs Python 3; with Python 2,
+only the spool directory is available.
+"""
+
+from __future__ import print_function
+
+import array
+import fcntl
+import json
+import os
+import runpy
+import socket
+import struct
+import sys
+import traceback
+
+from cdimage import osextras
+from cdimage.log import logger
+from cdimage.project import setenv_for_project
+
+__metaclass__ = type
+
+
+# How often to look for new requests in the spool directory, in seconds.
+SPOOL_INTERVAL = 5
+
+# Python 2 has no sendmsg or recvmsg.
+fd_passing_available = hasattr(socket.socket, "sendmsg")
+
+_SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+bin_dir = os.path.realpath(os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, "bin"))
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonUnavailable(DaemonError):
+    """The daemon could not be reached, so the request was never sent."""
+
+
+def _send_message(sock, message, fds=()):
+    data = json.dumps(message).encode("UTF-8") + b"\n"
+    if fds:
+        sent = sock.sendmsg([data], [(
+            socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+
+def _receive_message(stream):
+    line = stream.readline()
+    if not line.endswith(b"\n"):
+        raise DaemonError("Connection closed unexpectedly")
+    return json.loads(line.decode("UTF-8"))
+
+
+def _receive_request(sock, max_fds=3):
+    """Receive a message from SOCK, along with any file descriptors.
+
+    Returns the message and a list of the file descriptors, which the
+    caller must close.
+    """
+    data = b""
+    fds = array.array("i")
+    ancillary_size = socket.CMSG_SPACE(max_fds * fds.itemsize)
+    try:
+        while not data.endswith(b"\n"):
+            chunk, ancillary, _, _ = sock.recvmsg(4096, ancillary_size)
+            for level, kind, fd_data in ancillary:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fd_data = fd_data[:len(fd_data) - (
+                        len(fd_data) % fds.itemsize)]
+                    fds.frombytes(fd_data)
+            if not chunk:
+                raise DaemonError("Connection closed unexpectedly")
+            data += chunk
+        return json.loads(data.decode("UTF-8")), list(fds)
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def _peer_uid(sock):
+    """Return the user ID of the process at the other end of SOCK."""
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, _SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def _find_command(name, path):
+    if "/" in name:
+        return name
+    for directory in path.split(os.pathsep):
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def _exit_status(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_request(request):
+    """Run a request in the current process, which must be a worker."""
+    os.environ.clear()
+    os.environ.update(request["env"])
+    project = request["project"]
+    if not setenv_for_project(project):
+        print("unrecognised project '%s'" % project, file=sys.stderr)
+        return 1
+    command = request["command"]
+    path = _find_command(command[0], os.environ.get("PATH", os.defpath))
+    if path is None or os.path.dirname(os.path.realpath(path)) != bin_dir:
+        os.execvp(command[0], command)
+    sys.argv = [path] + command[1:]
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        elif isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+class _Worker:
+    def __init__(self, pid, request, client=None, spool_path=None):
+        self.pid = pid
+        self.request = request
+        self.client = client
+        self.spool_path = spool_path
+
+
+class Daemon:
+    """Accept requests and run each in a worker process."""
+
+    def __init__(self, socket_path=None, spool_dir=None):
+        self.socket_path = socket_path
+        self.spool_dir = spool_dir
+        self.listener = None
+        if socket_path is not None:
+            if not fd_passing_available:
+                raise DaemonError(
+                    "Listening on a socket requires Python 3")
+            osextras.unlink_force(socket_path)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Only our own user may connect.
+            old_umask = os.umask(0o077)
+            try:
+                self.listener.bind(socket_path)
+            finally:
+                os.umask(old_umask)
+            self.listener.listen(16)
+        if spool_dir is not None:
+            osextras.ensuredir(spool_dir)
+        self.watcher = osextras.ChildWatcher()
+        self.workers = {}
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            osextras.unlink_force(self.socket_path)
+            self.listener = None
+        self.watcher.close()
+
+    def _start(self, request, client=None, spool_path=None, fds=()):
+        """Start a worker for REQUEST.
+
+        FDS are the client's file descriptors for the targets listed in
+        request["fds"]; the worker uses them in place of the daemon's own.
+        """
+        targets = request.get("fds", [])
+        if len(targets) != len(fds):
+            raise DaemonError("Expected %d file descriptors, received %d" % (
+                len(targets), len(fds)))
+        if not set(targets) <= set([0, 1, 2]):
+            raise DaemonError("Only standard file descriptors may be passed")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:  # child
+            status = 1
+            try:
+                if self.listener is not None:
+                    self.listener.close()
+                for worker in self.workers.values():
+                    if worker.client is not None:
+                        worker.client.close()
+                if client is not None:
+                    client.close()
+                # Move the received descriptors out of the way first, in
+                # case any of them were received as standard descriptors.
+                moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3) for fd in fds]
+                for fd, target in zip(moved, targets):
+                    os.dup2(fd, target)
+                for fd in (set(moved) | set(fds)) - set(targets):
+                    os.close(fd)
+                status = run_request(request)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        worker = _Worker(pid, request, client=client, spool_path=spool_path)
+        self.workers[pid] = worker
+        self.watcher.add(worker)
+        logger.info("Started %s for %s (pid %d)" % (
+            " ".join(request["command"]), request["project"], pid))
+        return worker
+
+    def _accept(self):
+        client, _ = self.listener.accept()
+        client.settimeout(30)
+        fds = []
+        try:
+            uid = _peer_uid(client)
+            if uid not in (0, os.getuid()):
+                raise DaemonError("Refusing request from uid %d" % uid)
+            request, fds = _receive_request(client)
+            worker = self._start(request, client=client, fds=fds)
+            _send_message(client, {"pid": worker.pid})
+        except Exception as e:
+            logger.warning("Rejected request: %s" % e)
+            try:
+                _send_message(client, {"error": str(e)})
+            except socket.error:
+                pass
+            client.close()
+        finally:
+            # The worker has its own copies.
+            for fd in fds:
+                os.close(fd)
+
+    def _scan_spool(self):
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            running_path = "%s.running" % path
+            try:
+                os.rename(path, running_path)
+            except OSError:
+                # Someone else picked it up.
+                continue
+            try:
+                with open(running_path) as request_file:
+                    request = json.load(request_file)
+                self._start(request, spool_path=running_path)
+            except Exception as e:
+                logger.warning("Rejected request %s: %s" % (name, e))
+                os.rename(running_path, "%s.failed" % path)
+
+    def _reap(self):
+        for pid, worker in list(self.workers.items()):
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if not wpid:
+                continue
+            del self.workers[pid]
+            self.watcher.remove(worker)
+            status = _exit_status(status)
+            logger.info("Finished %s for %s (pid %d, status %d)" % (
+                " ".join(worker.request["command"]),
+                worker.request["project"], pid, status))
+            if worker.client is not None:
+                try:
+                    _send_message(worker.client, {"status": status})
+                except socket.error:
+                    pass
+                worker.client.close()
+            if worker.spool_path is not None:
+                base = worker.spool_path[:-len(".running")]
+                os.rename(
+                    worker.spool_path,
+                    "%s.%s" % (base, "done" if status == 0 else "failed"))
+
+    def step(self, timeout=SPOOL_INTERVAL):
+        """Handle whatever requests and finished workers are pending."""
+        if self.listener is not None:
+            if self.watcher.wait(timeout, fds=[self.listener]):
+                self._accept()
+        else:
+            self.watcher.wait(timeout)
+        if self.spool_dir is not None:
+            self._scan_spool()
+        self._reap()
+
+    def serve(self):
+        try:
+            while True:
+                self.step()
+        finally:
+            self.close()
+
+
+def _standard_fds():
+    """Return whichever of the standard file descriptors are open."""
+    fds = []
+    for fd in 0, 1, 2:
+        try:
+            os.fstat(fd)
+        except OSError:
+            continue
+        fds.append(fd)
+    return fds
+
+
+def submit(socket_path, project, command, env=None, fds=None):
+    """Ask the daemon to run COMMAND for PROJECT, and wait for it.
+
+    The command's standard input, output and error are this process's,
+    unless FDS maps each of 0, 1 and 2 to a different file descriptor.
+    Returns the command's exit status.  Raises DaemonUnavailable if the
+    daemon could not be reached, in which case the command was not run.
+    """
+    if not fd_passing_available:
+        raise DaemonUnavailable("Submitting requests requires Python 3")
+    if env is None:
+        env = dict(os.environ)
+    if fds is None:
+        fds = dict((fd, fd) for fd in _standard_fds())
+    targets = sorted(fds)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            raise DaemonUnavailable(str(e))
+        try:
+            _send_message(
+                sock,
+                {"project": project, "command": command, "env": env,
+                 "fds": targets},
+                fds=[fds[target] for target in targets])
+        except socket.error:
+            # The daemon may have refused the request before reading it;
+            # if so, its reply says why.
+            pass
+        with sock.makefile("rb") as stream:
+            reply = _receive_message(stream)
+            if "error" in reply:
+                raise DaemonError(reply["error"])
+            return _receive_message(stream)["status"]
+    finally:
+        sock.close()
@@ -0,0 +1,59 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read deb822-format files such as archive indices."""
+
+import gzip
+
+__metaclass__ = type
+
+
+def iter_paragraphs(stream):
+    """Yield each paragraph of STREAM as a dictionary.
+
+    Continuation lines are kept as they are, joined to the first line of
+    the field by newlines, as apt_pkg.TagSection does.
+    """
+    paragraph = {}
+    field = None
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode("UTF-8", "replace")
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            if paragraph:
+                yield paragraph
+                paragraph = {}
+            field = None
+        elif line[0] in " \t":
+            if field is not None:
+                paragraph[field] += "\n" + line
+        elif not line.startswith("#"):
+            name, sep, value = line.partition(":")
+            if sep:
+                field = name
+                paragraph[field] = value.strip()
+    if paragraph:
+        yield paragraph
+
+
+def read_index(path):
+    """Yield each paragraph of the index at PATH, which may be gzipped."""
+    if path.endswith(".gz"):
+        index = gzip.GzipFile(path, "rb")
+    else:
+        index = open(path, "rb")
+    with index:
+        for paragraph in iter_paragraphs(index):
+            yield paragraph
@@ -0,0 +1,186 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read members of Debian binary packages without unpacking them.
+
+A .deb (or .udeb) is an ar archive holding debian-binary, control.tar.*
+and data.tar.*.  Tar members compressed with anything the tarfile module
+understands are read directly; for other compressors, such as zstd on
+older Pythons, the tar stream is taken from dpkg-deb instead.
+"""
+
+import errno
+import io
+import json
+import os
+import subprocess
+import tarfile
+
+from cdimage.atomicfile import AtomicFile
+from cdimage.deb822 import iter_paragraphs
+
+__metaclass__ = type
+
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+
+# How many links to follow when looking up a file.
+MAX_LINK_DEPTH = 8
+
+
+class DebFileError(Exception):
+    pass
+
+
+def iter_ar_members(ar_file):
+    """Yield (name, size) for each member of the ar archive AR_FILE.
+
+    After each member is yielded, AR_FILE is positioned at the start of
+    its data; the caller may read up to SIZE bytes of it.
+    """
+    if ar_file.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebFileError("%s is not an ar archive" % ar_file.name)
+    offset = len(AR_MAGIC)
+    while True:
+        ar_file.seek(offset)
+        header = ar_file.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) < AR_HEADER_SIZE or header[58:60] != b"`\n":
+            raise DebFileError("%s has a corrupt ar header" % ar_file.name)
+        name = header[:16].decode("ASCII").rstrip(" ")
+        if name.endswith("/"):
+            # GNU ar terminates names with a slash.
+            name = name[:-1]
+        size = int(header[48:58])
+        yield name, size
+        offset += AR_HEADER_SIZE + size + (size % 2)
+
+
+def open_tar_member(deb_path, prefix):
+    """Open the tar member of DEB_PATH whose name starts with PREFIX.
+
+    PREFIX is "control.tar" or "data.tar".  Returns an open TarFile.
+    """
+    with open(deb_path, "rb") as deb:
+        for name, size in iter_ar_members(deb):
+            if not name.startswith(prefix):
+                continue
+            data = deb.read(size)
+            try:
+                return tarfile.open(fileobj=io.BytesIO(data), mode="r:*")
+            except tarfile.TarError:
+                break
+        else:
+            raise DebFileError("%s has no %s member" % (deb_path, prefix))
+    # Compressed with something tarfile does not understand.
+    if prefix == "control.tar":
+        option = "--ctrl-tarfile"
+    else:
+        option = "--fsys-tarfile"
+    data = subprocess.check_output(["dpkg-deb", option, deb_path])
+    return tarfile.open(fileobj=io.BytesIO(data), mode="r:")
+
+
+def _normalise(path):
+    path = path.lstrip("/")
+    if path.startswith("./"):
+        path = path[2:]
+    return path
+
+
+def read_tar_file(tar, path):
+    """Return (TarInfo, contents) of the regular file PATH in TAR.
+
+    Symbolic and hard links within TAR are followed.  Returns None if TAR
+    has no regular file at PATH.
+    """
+    members = {}
+    for member in tar.getmembers():
+        members[_normalise(member.name)] = member
+    path = _normalise(path)
+    for _ in range(MAX_LINK_DEPTH + 1):
+        member = members.get(path)
+        if member is None:
+            return None
+        elif member.isfile():
+            return member, tar.extractfile(member).read()
+        elif member.issym():
+            if member.linkname.startswith("/"):
+                path = _normalise(member.linkname)
+            else:
+                path = os.path.normpath(os.path.join(
+                    os.path.dirname(path), member.linkname))
+        elif member.islnk():
+            # Hard link names are relative to the root of the archive.
+            path = _normalise(member.linkname)
+        else:
+            return None
+    return None
+
+
+def read_data_file(deb_path, path):
+    """Return (TarInfo, contents) of the file PATH in the package DEB_PATH.
+
+    Returns None if the package does not contain a regular file at PATH.
+    """
+    with open_tar_member(deb_path, "data.tar") as tar:
+        return read_tar_file(tar, path)
+
+
+def read_control(deb_path):
+    """Return the control fields of the package DEB_PATH as a dictionary."""
+    with open_tar_member(deb_path, "control.tar") as tar:
+        control = read_tar_file(tar, "control")
+    if control is None:
+        raise DebFileError("%s has no control file" % deb_path)
+    for paragraph in iter_paragraphs(control[1].splitlines(True)):
+        return paragraph
+    return {}
+
+
+class ControlCache:
+    """Control fields of packages, kept in CACHE_PATH between runs.
+
+    Entries are keyed by package path, and are only used while the
+    package's size and modification time are unchanged.  Saving the cache
+    drops entries for packages that were not looked up.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._entries = {}
+        self._used = {}
+        try:
+            with open(cache_path) as cache_file:
+                self._entries = json.load(cache_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # A corrupt cache is only a missed optimisation.
+            pass
+
+    def fields(self, deb_path):
+        st = os.stat(deb_path)
+        entry = self._entries.get(deb_path)
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime]:
+            entry = [st.st_size, st.st_mtime, read_control(deb_path)]
+        self._used[deb_path] = entry
+        return entry[2]
+
+    def save(self):
+        with AtomicFile(self.cache_path) as cache_file:
+            json.dump(self._used, cache_file, sort_keys=True)
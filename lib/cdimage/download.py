@@ -0,0 +1,647 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Native HTTP downloads with connection pooling."""
+
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+try:
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from urlparse import urljoin, urlsplit
+
+from cdimage.atomicfile import AtomicFile
+from cdimage.locking import Lock, LockError
+from cdimage.log import logger
+from cdimage import osextras
+from cdimage.osextras import FetchError, unlink_force
+from cdimage.proxy import _select_proxy
+
+__metaclass__ = type
+
+
+# Default limits on the number of simultaneous connections, overall and to
+# any one host.
+MAX_CONNECTIONS = 8
+MAX_CONNECTIONS_PER_HOST = 4
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 20
+_CHUNK_SIZE = 1024 * 1024
+
+# Failed downloads are retried this many times, waiting BACKOFF seconds
+# before the first retry and doubling the wait each time.
+RETRIES = 4
+BACKOFF = 5
+
+# Seconds to wait for another process to finish updating the artefact
+# cache before giving up on caching a file.
+CACHE_LOCK_TIMEOUT = 60
+
+# Default size of the live artefact cache, in MiB.
+CACHE_SIZE = 32 * 1024
+
+
+class _TransientFetchError(FetchError):
+    """A download failed in a way that may succeed if retried."""
+
+
+class _HostPool:
+    """A pool of persistent connections to a single host."""
+
+    def __init__(self, scheme, host, port, proxy, ssl_context, limit,
+                 timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+
+    def _connect(self):
+        if self.proxy is not None:
+            proxy_host, proxy_port = self.proxy
+        if self.scheme == "https":
+            if self.proxy is not None:
+                connection = httplib.HTTPSConnection(
+                    proxy_host, proxy_port, timeout=self.timeout,
+                    context=self.ssl_context)
+                connection.set_tunnel(self.host, self.port)
+            else:
+                connection = httplib.HTTPSConnection(
+                    self.host, self.port, timeout=self.timeout,
+                    context=self.ssl_context)
+        elif self.proxy is not None:
+            connection = httplib.HTTPConnection(
+                proxy_host, proxy_port, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        with self.lock:
+            self.opened += 1
+        return connection
+
+    def get(self):
+        """Return a connection and whether it has been used before."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._connect(), False
+
+    def put(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+def _read_json(path):
+    try:
+        with open(path) as info:
+            return json.load(info)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_json(path, info):
+    with AtomicFile(path) as f:
+        json.dump(info, f, sort_keys=True)
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, target)
+
+
+def _remove_partial(part):
+    unlink_force(part)
+    unlink_force("%s.json" % part)
+
+
+def _parse_content_range(content_range):
+    """Parse a Content-Range header into a (start, total) pair.
+
+    Either may be None if it is not known.
+    """
+    match = re.match(
+        r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)$", content_range or "")
+    if match is None:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start is not None else None,
+            int(total) if total != "*" else None)
+
+
+def _parse_proxy(proxy):
+    if not proxy:
+        return None
+    if "://" not in proxy:
+        proxy = "http://%s" % proxy
+    parsed = urlsplit(proxy)
+    return parsed.hostname, parsed.port or 80
+
+
+class ArtefactCache:
+    """A cache of downloaded files, for conditional re-downloading.
+
+    Each file is stored once under a name derived from its URL, its ETag
+    and Last-Modified validators, and its size, and is linked into place
+    when the server says it has not changed.  The least recently used
+    files are evicted once the cache holds more than MAX_BYTES.
+
+    The cache may be shared by several processes, so changes to it are
+    made while holding a lock on the cache directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock:
+            with Lock(os.path.join(self.directory, ".lock"),
+                      timeout=CACHE_LOCK_TIMEOUT):
+                yield
+
+    @staticmethod
+    def _hash(*args):
+        text = "\0".join("" if arg is None else str(arg) for arg in args)
+        return hashlib.sha256(text.encode("UTF-8")).hexdigest()
+
+    def _entry_path(self, url):
+        return os.path.join(self.directory, "urls", self._hash(url))
+
+    def _object_path(self, key):
+        return os.path.join(self.directory, "objects", key)
+
+    def _entries(self):
+        urls_dir = os.path.join(self.directory, "urls")
+        try:
+            names = os.listdir(urls_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(urls_dir, name)
+            entry = _read_json(path)
+            if "key" in entry:
+                yield path, entry
+
+    def lookup(self, url):
+        """Return the cache entry for URL, or None."""
+        entry = _read_json(self._entry_path(url))
+        if entry.get("url") != url or "key" not in entry:
+            return None
+        try:
+            if os.stat(self._object_path(entry["key"])).st_size != (
+                    entry["size"]):
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def materialise(self, entry, target):
+        """Link the cached file for ENTRY to TARGET.
+
+        Return False if the cached file has disappeared.
+        """
+        unlink_force(target)
+        try:
+            _link_or_copy(self._object_path(entry["key"]), target)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        entry["last_used"] = time.time()
+        try:
+            with self._locked():
+                _write_json(self._entry_path(entry["url"]), entry)
+        except (IOError, OSError, LockError) as e:
+            # Only the eviction order suffers.
+            logger.warning(
+                "Failed to update cache entry for %s: %s" % (entry["url"], e))
+        return True
+
+    def store(self, url, path, etag, last_modified):
+        """Add PATH, just downloaded from URL, to the cache."""
+        if (not etag and not last_modified) or self.max_bytes <= 0:
+            # There would be no way to tell whether it is still current.
+            return
+        size = os.path.getsize(path)
+        key = self._hash(url, etag, last_modified, size)
+        object_path = self._object_path(key)
+        with self._locked():
+            osextras.ensuredir(os.path.dirname(object_path))
+            osextras.ensuredir(os.path.dirname(self._entry_path(url)))
+            fd, new_path = tempfile.mkstemp(
+                dir=os.path.dirname(object_path), prefix=".", suffix=".new")
+            os.close(fd)
+            try:
+                os.unlink(new_path)
+                _link_or_copy(path, new_path)
+                os.rename(new_path, object_path)
+            finally:
+                unlink_force(new_path)
+            _write_json(self._entry_path(url), {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": size,
+                "key": key,
+                "last_used": time.time(),
+            })
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits.
+
+        The caller must hold the cache lock.
+        """
+        objects_dir = os.path.join(self.directory, "objects")
+        last_used = {}
+        for path, entry in self._entries():
+            last_used[entry["key"]] = max(
+                last_used.get(entry["key"], 0), entry.get("last_used", 0))
+        sizes = {}
+        try:
+            names = os.listdir(objects_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if name.endswith(".new"):
+                continue
+            try:
+                sizes[name] = os.stat(os.path.join(objects_dir, name)).st_size
+            except OSError:
+                continue
+        total = sum(sizes.values())
+        for key in sorted(sizes, key=lambda key: last_used.get(key, 0)):
+            if total <= self.max_bytes:
+                break
+            unlink_force(self._object_path(key))
+            total -= sizes[key]
+        # Forget URLs whose files have gone.
+        for path, entry in self._entries():
+            if not os.path.exists(self._object_path(entry["key"])):
+                unlink_force(path)
+
+
+class Downloader:
+    """Download files over HTTP and HTTPS.
+
+    Connections are kept alive and reused for later requests to the same
+    host.  Downloads may be made from several threads at once; the total
+    number of simultaneous transfers, and the number to any one host, are
+    bounded.
+    """
+
+    def __init__(self, http_proxy=None, https_proxy=None,
+                 check_certificate=True, max_connections=MAX_CONNECTIONS,
+                 max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 timeout=300, retries=RETRIES, backoff=BACKOFF, cache=None):
+        self.proxies = {
+            "http": _parse_proxy(http_proxy),
+            "https": _parse_proxy(https_proxy),
+        }
+        self.ssl_context = ssl.create_default_context()
+        if not check_certificate:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def _pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = _HostPool(
+                    scheme, host, port, self.proxies[scheme],
+                    self.ssl_context, self.max_connections_per_host,
+                    self.timeout)
+            return self.pools[key]
+
+    def connections_opened(self):
+        """Return the number of connections opened so far."""
+        with self.lock:
+            return sum(pool.opened for pool in self.pools.values())
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+    def _request(self, pool, url, path, headers):
+        """Send a GET request, retrying once on a stale connection."""
+        if pool.proxy is not None and pool.scheme == "http":
+            # Plain HTTP proxies want the absolute URL.
+            path = url
+        while True:
+            connection, reused = pool.get()
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # The server may have closed an idle keep-alive
+                # connection just as we tried to reuse it.
+                if not reused:
+                    raise
+
+    @contextlib.contextmanager
+    def _open(self, url, headers):
+        """Open URL, following redirects, and yield the final response.
+
+        The connection is returned to its pool afterwards if the response
+        body was read completely.
+        """
+        for _ in range(_MAX_REDIRECTS):
+            parsed = urlsplit(url)
+            if parsed.scheme not in ("http", "https"):
+                raise FetchError("unsupported URL scheme: %s" % url)
+            port = parsed.port
+            if port is None:
+                port = 443 if parsed.scheme == "https" else 80
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?%s" % parsed.query
+            pool = self._pool(parsed.scheme, parsed.hostname, port)
+            with pool.slots:
+                connection, response = self._request(
+                    pool, url, path, headers)
+                try:
+                    if response.status in _REDIRECT_STATUSES:
+                        location = response.getheader("Location")
+                        response.read()
+                        if not location:
+                            raise FetchError(
+                                "%s returned %d without a Location" %
+                                (url, response.status))
+                        url = urljoin(url, location)
+                    else:
+                        yield response
+                        return
+                finally:
+                    if response.isclosed() and not response.will_close:
+                        pool.put(connection)
+                    else:
+                        connection.close()
+        raise FetchError("too many redirects")
+
+    def _fetch_part(self, url, part, expected_size, cached):
+        """Make one attempt to complete PART from URL.
+
+        If CACHED is a cache entry for URL, ask the server to send the
+        file only if it has changed since then.  Return True if it has not.
+        """
+        info_path = "%s.json" % part
+        headers = {}
+        offset = 0
+        info = _read_json(info_path)
+        if info.get("url") == url and os.path.exists(part):
+            validator = info.get("etag") or info.get("last_modified")
+            offset = os.path.getsize(part)
+            if offset and validator:
+                headers["Range"] = "bytes=%d-" % offset
+                headers["If-Range"] = validator
+            else:
+                offset = 0
+        if not offset and cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self._open(url, headers) as response:
+            if response.status == 304 and cached is not None:
+                response.read()
+                return True
+            if response.status == 416 and offset:
+                # Perhaps we already have the whole file.
+                response.read()
+                _, total = _parse_content_range(
+                    response.getheader("Content-Range"))
+                if total == offset and expected_size in (None, offset):
+                    return
+                _remove_partial(part)
+                raise _TransientFetchError(
+                    "%s: partial download of %s no longer matches" %
+                    (part, url))
+            if response.status == 206 and offset:
+                start, total = _parse_content_range(
+                    response.getheader("Content-Range"))
+                if start != offset:
+                    response.read()
+                    _remove_partial(part)
+                    raise _TransientFetchError(
+                        "%s returned an unexpected range" % url)
+                mode = "ab"
+            elif response.status == 200:
+                length = response.getheader("Content-Length")
+                total = int(length) if length is not None else None
+                offset = 0
+                mode = "wb"
+            else:
+                response.read()
+                if response.status >= 500:
+                    error_class = _TransientFetchError
+                else:
+                    error_class = FetchError
+                raise error_class(
+                    "%s returned %d %s" %
+                    (url, response.status, response.reason))
+            if (expected_size is not None and total is not None and
+                    total != expected_size):
+                response.read()
+                raise FetchError(
+                    "%s has %d bytes, but %d were expected" %
+                    (url, total, expected_size))
+
+            # Record enough to be able to resume this download later.
+            etag = response.getheader("ETag")
+            last_modified = response.getheader("Last-Modified")
+            if etag or last_modified:
+                _write_json(info_path, {
+                    "url": url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                })
+            else:
+                unlink_force(info_path)
+            with open(part, mode) as output:
+                while True:
+                    chunk = response.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+
+        size = os.path.getsize(part)
+        if total is not None and size < total:
+            raise _TransientFetchError(
+                "%s: got %d of %d bytes" % (url, size, total))
+        if expected_size is not None and size != expected_size:
+            raise FetchError(
+                "%s: got %d bytes, but %d were expected" %
+                (url, size, expected_size))
+        return False
+
+    def _fetch_with_retries(self, url, part, expected_size, cached):
+        attempt = 0
+        while True:
+            try:
+                with self.slots:
+                    try:
+                        return self._fetch_part(
+                            url, part, expected_size, cached)
+                    except (httplib.HTTPException, socket.error,
+                            ssl.SSLError) as e:
+                        raise _TransientFetchError(
+                            "fetching %s failed: %s" % (url, e))
+            except _TransientFetchError as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                logger.warning("%s; retrying in %s seconds" % (e, delay))
+                time.sleep(delay)
+
+    def fetch(self, url, target, expected_size=None):
+        """Fetch URL to TARGET, following redirects.
+
+        The file is downloaded to TARGET.part first.  Failed attempts are
+        retried with exponential backoff, resuming from where they left off
+        if the server supports that.  If EXPECTED_SIZE is given, the
+        download must have exactly that many bytes.
+
+        If this downloader has a cache, then files that have not changed
+        since they were last downloaded are linked from the cache rather
+        than being downloaded again.
+
+        Return True if the file was linked from the cache, otherwise False.
+        Raises FetchError on failure, in which case TARGET is removed.  A
+        partial download that can be resumed is kept for the next attempt.
+        """
+        part = "%s.part" % target
+        info_path = "%s.json" % part
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.lookup(url)
+            if (cached is not None and
+                    expected_size not in (None, cached["size"])):
+                cached = None
+        try:
+            if self._fetch_with_retries(url, part, expected_size, cached):
+                if self.cache.materialise(cached, target):
+                    return True
+                # The cached copy went away under our feet.
+                self._fetch_with_retries(url, part, expected_size, None)
+            info = _read_json(info_path)
+            os.rename(part, target)
+            unlink_force(info_path)
+            if self.cache is not None:
+                try:
+                    self.cache.store(
+                        url, target, info.get("etag"),
+                        info.get("last_modified"))
+                except (IOError, OSError, LockError) as e:
+                    # The download itself succeeded.
+                    logger.warning("Failed to cache %s: %s" % (url, e))
+            return False
+        except _TransientFetchError:
+            unlink_force(target)
+            if not os.path.exists(info_path):
+                _remove_partial(part)
+            raise
+        except FetchError:
+            unlink_force(target)
+            _remove_partial(part)
+            raise
+
+
+_downloaders = {}
+_downloaders_lock = threading.Lock()
+
+
+def get_downloader(config):
+    """Return a shared Downloader configured for this config.
+
+    This honours the proxy selected for the "fetch" call site, and
+    LP_DISABLE_SSL_CERTIFICATE_VALIDATION in the same way as
+    lazr.restfulclient.  Downloads are cached in scratch/.livefs-cache,
+    limited to CDIMAGE_LIVEFS_CACHE_SIZE MiB; set that to 0 to disable
+    the cache.
+    """
+    http_proxy = _select_proxy(config, "fetch")
+    if http_proxy is None:
+        http_proxy = os.environ.get("http_proxy")
+    elif http_proxy == "unset":
+        http_proxy = None
+    https_proxy = os.environ.get("https_proxy")
+    check_certificate = not bool(
+        os.environ.get("LP_DISABLE_SSL_CERTIFICATE_VALIDATION", False))
+    max_connections = int(
+        config["CDIMAGE_DOWNLOAD_JOBS"] or MAX_CONNECTIONS)
+    max_connections_per_host = int(
+        config["CDIMAGE_DOWNLOAD_HOST_JOBS"] or MAX_CONNECTIONS_PER_HOST)
+    cache_dir = os.path.join(config.root, "scratch", ".livefs-cache")
+    cache_size = int(config["CDIMAGE_LIVEFS_CACHE_SIZE"] or CACHE_SIZE)
+    key = (http_proxy, https_proxy, check_certificate, max_connections,
+           max_connections_per_host, cache_dir, cache_size)
+    with _downloaders_lock:
+        if key not in _downloaders:
+            if cache_size > 0:
+                cache = ArtefactCache(cache_dir, cache_size * 1024 * 1024)
+            else:
+                cache = None
+            _downloaders[key] = Downloader(
+                http_proxy=http_proxy, https_proxy=https_proxy,
+                check_certificate=check_certificate,
+                max_connections=max_connections,
+                max_connections_per_host=max_connections_per_host,
+                cache=cache)
+        return _downloaders[key]
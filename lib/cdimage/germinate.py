@@ -15,35 +15,268 @@
 
 """Germinate handling."""
 
-from __future__ import print_function
+from __future__ import absolute_import, print_function
 
 from collections import OrderedDict, defaultdict
+import difflib
 import errno
+import filecmp
+from functools import partial
 import gzip
+import hashlib
+import logging
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
-import traceback
+import sys
+import threading
+import time
 
 from cdimage import osextras
+from cdimage.atomicfile import AtomicFile
+from cdimage.deb822 import read_index
 from cdimage.log import logger
 from cdimage.mail import send_mail
 from cdimage.mirror import find_mirror
-from cdimage.proxy import proxy_check_call
+from cdimage.proxy import (
+    proxy_check_call,
+    proxy_check_output,
+    proxy_env,
+)
+from cdimage.stages import StageGraph
 
 __metaclass__ = type
 
 
+# Maximum number of germinate runs at once.
+GERMINATE_JOBS = 4
+
+# Germinate's Python interface runs in a freshly spawned interpreter, which
+# needs Python 3.4 or later.
+_can_spawn = hasattr(multiprocessing, "get_context")
+
+
 class GerminateNotInstalled(Exception):
     pass
 
 
+# Configuration that varies between builds without affecting the task
+# lists.
+_VOLATILE_CONFIG = frozenset([
+    "CDIMAGE_DATE",
+    "CDIMAGE_GERMINATE_JOBS",
+    "CDIMAGE_NOLOG",
+    "CDIMAGE_STAGE_JOBS",
+    "DATE",
+    "DATE_SUFFIX",
+    "DEBUG",
+    "SSH_ORIGINAL_COMMAND",
+])
+
+
+def _file_hash(path):
+    """Return the SHA-256 of the file at PATH, or "-" if it is missing."""
+    sha256 = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return "-"
+    return sha256.hexdigest()
+
+
+def _index_hash(path):
+    """Return the SHA-256 of the index at PATH, or "-" if it is missing.
+
+    Compressed indices are hashed uncompressed, since rebuilding an index
+    changes the timestamp in its gzip header even if its contents are the
+    same.
+    """
+    if not path.endswith(".gz"):
+        return _file_hash(path)
+    sha256 = hashlib.sha256()
+    try:
+        with gzip.open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return "-"
+    return sha256.hexdigest()
+
+
+# Parsed MANIFEST.udebs files, by (path, mtime).
+_udeb_manifests = {}
+_udeb_manifests_lock = threading.Lock()
+
+
+def _read_udeb_manifest(path):
+    """Return a dictionary mapping each initrd in a MANIFEST.udebs file to
+    the frozenset of udebs it contains.
+
+    Each initrd is listed on a line of its own, followed by one indented
+    line per udeb.  Parsed manifests are kept for the life of the process
+    and are read again only if they change.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+    key = (path, mtime)
+    with _udeb_manifests_lock:
+        manifest = _udeb_manifests.get(key)
+        if manifest is None:
+            initrds = {}
+            packages = None
+            with open(path) as manifest_file:
+                for line in manifest_file:
+                    line = line.rstrip("\n")
+                    if not line.strip():
+                        continue
+                    elif not line[0].isspace():
+                        packages = initrds.setdefault(line, set())
+                    elif packages is not None:
+                        packages.add(line.split()[0])
+            manifest = {
+                initrd: frozenset(packages)
+                for initrd, packages in initrds.items()}
+            for old_key in [k for k in _udeb_manifests if k[0] == path]:
+                del _udeb_manifests[old_key]
+            _udeb_manifests[key] = manifest
+        return manifest
+
+
+def _diff_file_date(path):
+    """Format the modification time of PATH as "diff -u" does."""
+    mtime = os.stat(path).st_mtime
+    local = time.localtime(mtime)
+    return "%s.%09d %s" % (
+        time.strftime("%Y-%m-%d %H:%M:%S", local),
+        int(mtime % 1 * 1000000000), time.strftime("%z", local))
+
+
+def _update_fingerprint(fingerprint, *words):
+    line = "%s\n" % " ".join("%s" % word for word in words)
+    fingerprint.update(line.encode("UTF-8"))
+
+
+def _read_fingerprint(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+class GerminateAPI:
+    """The parts of germinate's Python interface that we use."""
+
+    def __init__(self, index_type, germinator, seed_structure):
+        self.IndexType = index_type
+        self.Germinator = germinator
+        self.SeedStructure = seed_structure
+
+
+class _GerminateArchive:
+    """The archive indices in a germinate output directory.
+
+    This works like germinate.archive.TagFile, except that the parsed
+    Sources indices are passed in rather than being parsed again.
+    """
+
+    def __init__(self, index_type, directory, dists, cpuarch, sources):
+        self.index_type = index_type
+        self.directory = directory
+        self.dists = dists
+        self.cpuarch = cpuarch
+        self.sources = sources
+
+    def sections(self):
+        for dist in self.dists:
+            dist_dir = os.path.join(self.directory, "dists", dist, "main")
+            for section in read_index(os.path.join(
+                    dist_dir, "binary-%s" % self.cpuarch, "Packages.gz")):
+                yield self.index_type.PACKAGES, section
+            for section in self.sources[dist]:
+                yield self.index_type.SOURCES, section
+            for section in read_index(os.path.join(
+                    dist_dir, "debian-installer", "binary-%s" % self.cpuarch,
+                    "Packages.gz")):
+                yield self.index_type.INSTALLER_PACKAGES, section
+
+
+def _run_germinate_api(api, output_dir, arch, dists, seed_dist,
+                       seed_sources, vcs, sources):
+    # Like the germinate command, but only writing what GerminateOutput
+    # reads.
+    cpuarch = arch.split("+")[0]
+    arch_output_dir = os.path.join(output_dir, arch)
+    germinator = api.Germinator(cpuarch)
+    germinator.parse_archive(_GerminateArchive(
+        api.IndexType, output_dir, dists, cpuarch, sources))
+    hints_path = os.path.join(arch_output_dir, "hints")
+    if os.path.isfile(hints_path):
+        with open(hints_path) as hints:
+            germinator.parse_hints(hints)
+    structure = api.SeedStructure(seed_dist, seed_sources, vcs=vcs)
+    germinator.plant_seeds(structure)
+    germinator.grow(structure)
+    germinator.add_extras(structure)
+    for seed in structure.names + ["extra"]:
+        germinator.write_full_list(
+            structure, os.path.join(arch_output_dir, seed), seed)
+        if seed in structure:
+            structure.write_seed_text(
+                os.path.join(arch_output_dir, "%s.seedtext" % seed), seed)
+    germinator.write_supported_list(
+        structure, os.path.join(arch_output_dir, "supported+build-depends"))
+    structure.write(os.path.join(arch_output_dir, "structure"))
+
+
+def _germinate_api_child(api, kwargs, env, log_path):
+    """Run germinate's Python interface in a child process."""
+    if log_path is not None:
+        log_fd = os.open(
+            log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.close(log_fd)
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(os.path.join(kwargs["output_dir"], kwargs["arch"]))
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    germinate_logger = logging.getLogger("germinate")
+    germinate_logger.addHandler(handler)
+    germinate_logger.setLevel(logging.INFO)
+    try:
+        _run_germinate_api(api, **kwargs)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
 class Germination:
     def __init__(self, config, prefer_vcs=True):
         self.config = config
         # Set to False to use old-style seed checkouts.
         self.prefer_vcs = prefer_vcs
+        # Indices built so far, keyed by target and source paths.
+        self._indices = {}
+        self._indices_lock = threading.Lock()
+        self._output_lock = threading.Lock()
+        self._sources = None
+        self._sources_lock = threading.Lock()
 
     @property
     def germinate_path(self):
@@ -106,18 +339,53 @@ class Germination:
             return self.prefer_vcs
 
     def make_index(self, project, arch, rel_target, rel_paths):
+        """Combine the archive indices REL_PATHS into REL_TARGET.
+
+        The indices are gzip files, so this just concatenates them: a
+        gzip file may consist of several members.  Indices only depend on
+        the archive, not on the project, so each one is built once per
+        Germination and hardlinked into place for other projects.  An
+        index that is already in place is left alone, since germinate may
+        be reading it for another architecture.
+        """
+        with self._indices_lock:
+            self._make_index(project, arch, rel_target, rel_paths)
+
+    def _make_index(self, project, arch, rel_target, rel_paths):
         target = os.path.join(self.output_dir(project), rel_target)
+        abs_paths = []
+        for rel_path in rel_paths:
+            if os.path.isabs(rel_path):
+                abs_paths.append(rel_path)
+            else:
+                abs_paths.append(
+                    os.path.join(find_mirror(self.config, arch), rel_path))
+        key = (rel_target, tuple(abs_paths))
+        built = self._indices.get(key)
+        if built is not None and os.path.exists(built):
+            if built == target:
+                return
+            try:
+                if os.path.samefile(built, target):
+                    return
+            except OSError:
+                pass
+            osextras.mkemptydir(os.path.dirname(target))
+            os.link(built, target)
+            return
         osextras.mkemptydir(os.path.dirname(target))
-        with gzip.GzipFile(target, "wb") as target_file:
-            for rel_path in rel_paths:
-                if os.path.isabs(rel_path):
-                    abs_path = rel_path
-                else:
-                    abs_path = os.path.join(
-                        find_mirror(self.config, arch), rel_path)
+        found = False
+        with open(target, "wb") as target_file:
+            for abs_path in abs_paths:
                 if os.path.isfile(abs_path):
-                    with gzip.GzipFile(abs_path, "rb") as source_file:
-                        target_file.write(source_file.read())
+                    with open(abs_path, "rb") as source_file:
+                        shutil.copyfileobj(source_file, target_file)
+                    found = True
+        if not found:
+            # Leave an empty index rather than an invalid gzip file.
+            with gzip.GzipFile(target, "wb"):
+                pass
+        self._indices[key] = target
 
     @property
     def germinate_dists(self):
@@ -152,8 +420,8 @@ class Germination:
             if not self.config["CDIMAGE_ONLYFREE"]:
                 yield "multiverse"
 
-    # TODO: convert to Germinate's native Python interface
-    def germinate_arch(self, project, arch):
+    def index_files(self, arch):
+        """Yield each index to build for ARCH, and the files it combines."""
         cpuarch = arch.split("+")[0]
 
         for dist in self.germinate_dists:
@@ -169,15 +437,184 @@ class Germination:
                     files.append(
                         "%s/dists/%s/local/%s" %
                         (self.config["LOCALDEBS"], dist, suffix))
-                self.make_index(project, arch, files[0], files)
+                yield files[0], files
+
+    def make_indices(self, project, arch):
+        for rel_target, files in self.index_files(arch):
+            self.make_index(project, arch, rel_target, files)
+
+    def seed_revisions(self, project):
+        """Return the current revisions of PROJECT's seed branches.
+
+        Returns None unless the seeds come from git, since other seed
+        sources cannot be checked cheaply, or if any branch cannot be
+        checked; either way, the inputs are not known and germinate output
+        must not be reused.  A branch that does not exist is recorded as
+        "-".  Seed collections may include others; as well as PROJECT's own
+        collection, this covers the ubuntu and platform collections that the
+        flavours include.
+        """
+        if not self.use_vcs:
+            return None
+        collection, branch = self.seed_dist(project).split(".", 1)
+        collections = [collection]
+        for other in "ubuntu", "platform":
+            if other not in collections:
+                collections.append(other)
+        revisions = []
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        for source in self.seed_sources(project):
+            if "git" not in source.split("/")[2]:
+                return None
+            for name in collections:
+                url = source + name
+                try:
+                    output = proxy_check_output(
+                        self.config, "germinate",
+                        ["git", "ls-remote", url, "refs/heads/%s" % branch],
+                        env=env, universal_newlines=True)
+                except (OSError, subprocess.CalledProcessError):
+                    return None
+                words = output.split()
+                revisions.append((url, words[0] if words else "-"))
+        return revisions
 
-        arch_output_dir = os.path.join(self.output_dir(project), arch)
-        osextras.mkemptydir(arch_output_dir)
-        if (self.config["GERMINATE_HINTS"] and
-                os.path.isfile(self.config["GERMINATE_HINTS"])):
-            shutil.copy2(
-                self.config["GERMINATE_HINTS"],
-                os.path.join(arch_output_dir, "hints"))
+    @property
+    def germinate_revision(self):
+        """Return the revision of the germinate checkout, or None.
+
+        This is the commit checked out if the checkout is a git branch, and
+        otherwise the version in its changelog.
+        """
+        checkout = os.path.join(self.config.root, "germinate")
+        if os.path.exists(os.path.join(checkout, ".git")):
+            try:
+                with open("/dev/null", "w") as devnull:
+                    return subprocess.check_output(
+                        ["git", "rev-parse", "HEAD"], cwd=checkout,
+                        stderr=devnull, universal_newlines=True).strip()
+            except (OSError, subprocess.CalledProcessError):
+                return None
+        try:
+            with open(os.path.join(checkout, "debian", "changelog")) as f:
+                match = re.match(r"\S+ \((.*?)\)", f.readline())
+        except IOError:
+            return None
+        return match.group(1) if match else None
+
+    def fingerprint(self, project):
+        """Return a fingerprint of everything that affects germination.
+
+        If PROJECT's germinate output was made from inputs with the same
+        fingerprint, it can be used again.  Returns None if the inputs
+        cannot be fingerprinted.
+        """
+        germinate_revision = self.germinate_revision
+        if germinate_revision is None:
+            return None
+        revisions = self.seed_revisions(project)
+        if revisions is None:
+            return None
+        fingerprint = hashlib.sha256()
+        add = partial(_update_fingerprint, fingerprint)
+        add("seed-sources", *self.seed_sources(project))
+        add("seed-dist", self.seed_dist(project))
+        add("dists", *self.germinate_dists)
+        add("arches", *self.config.arches)
+        add("components", *self.components)
+        add("image-type", self.config.image_type)
+        add("germinate", germinate_revision)
+        for url, revision in revisions:
+            add("seed-revision", url, revision)
+        paths = set()
+        for arch in self.config.arches:
+            for _, files in self.index_files(arch):
+                for rel_path in files:
+                    paths.add(os.path.join(
+                        find_mirror(self.config, arch), rel_path))
+        for path in sorted(paths):
+            add("index", path, _index_hash(path))
+        if self.config["GERMINATE_HINTS"]:
+            add("hints", _file_hash(self.config["GERMINATE_HINTS"]))
+        return fingerprint.hexdigest()
+
+    def fingerprint_path(self, project):
+        return os.path.join(self.output_dir(project), ".fingerprint")
+
+    def output_is_current(self, project, fingerprint):
+        if fingerprint is None:
+            return False
+        if not os.path.exists(
+                os.path.join(self.output_dir(project), "STRUCTURE")):
+            return False
+        return _read_fingerprint(self.fingerprint_path(project)) == fingerprint
+
+    @property
+    def germinate_api(self):
+        """Return germinate's Python interface, or None.
+
+        This is only used from the same checkout as germinate_path, so that
+        both ways of running germinate use the same code.
+        """
+        checkout = os.path.join(self.config.root, "germinate")
+        if not os.path.exists(
+                os.path.join(checkout, "germinate", "germinator.py")):
+            return None
+        if checkout not in sys.path:
+            sys.path.insert(0, checkout)
+        try:
+            from germinate.archive import IndexType
+            from germinate.germinator import Germinator
+            from germinate.seeds import SeedStructure
+        except ImportError:
+            return None
+        return GerminateAPI(IndexType, Germinator, SeedStructure)
+
+    def source_sections(self, project):
+        """Return the parsed Sources index for each dist.
+
+        The indices are the same for every architecture and project, so
+        they are only parsed once.
+        """
+        with self._sources_lock:
+            if self._sources is None:
+                self._sources = {}
+                for dist in self.germinate_dists:
+                    self._sources[dist] = list(read_index(os.path.join(
+                        self.output_dir(project), "dists", dist, "main",
+                        "source", "Sources.gz")))
+            return self._sources
+
+    def _germinate_arch_in_process(self, api, project, arch, log_path=None):
+        # Parse Sources before starting the child, so that every
+        # architecture shares the result.  The child is a fresh interpreter
+        # rather than a fork, since this may be called from one of several
+        # threads; it is only given plain values, not this object.
+        sources = self.source_sections(project)
+        env = proxy_env(
+            self.config, "germinate",
+            dict(os.environ, GIT_TERMINAL_PROMPT="0"))
+        kwargs = {
+            "output_dir": self.output_dir(project),
+            "arch": arch,
+            "dists": self.germinate_dists,
+            "seed_dist": self.seed_dist(project),
+            "seed_sources": self.seed_sources(project),
+            "vcs": "auto" if self.use_vcs else None,
+            "sources": sources,
+        }
+        sys.stdout.flush()
+        sys.stderr.flush()
+        process = multiprocessing.get_context("spawn").Process(
+            target=_germinate_api_child, args=(api, kwargs, env, log_path))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise subprocess.CalledProcessError(
+                process.exitcode, "germinate %s/%s" % (project, arch))
+
+    def _germinate_arch_command(self, project, arch, log_path=None):
+        cpuarch = arch.split("+")[0]
         command = [
             self.germinate_path,
             "--seed-source", ",".join(self.seed_sources(project)),
@@ -192,25 +629,117 @@ class Germination:
             command.append("--vcs=auto")
         if self.config.image_type == "source":
             command.append("--always-follow-build-depends")
-        proxy_check_call(
-            self.config, "germinate", command, cwd=arch_output_dir,
-            env=dict(os.environ, GIT_TERMINAL_PROMPT="0"))
-        output_structure = os.path.join(self.output_dir(project), "STRUCTURE")
-        shutil.copy2(
-            os.path.join(arch_output_dir, "structure"), output_structure)
+        kwargs = {
+            "cwd": os.path.join(self.output_dir(project), arch),
+            "env": dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+        }
+        if log_path is None:
+            proxy_check_call(self.config, "germinate", command, **kwargs)
+        else:
+            with open(log_path, "w") as log:
+                proxy_check_call(
+                    self.config, "germinate", command,
+                    stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+    def germinate_arch(self, project, arch, separate_log=False):
+        """Run germinate for PROJECT on ARCH.
+
+        Germinate runs through its Python interface in a new Python process
+        if that interface is available, and otherwise as a separate
+        command.  The Python interface has no equivalent of the command's
+        --always-follow-build-depends option, so source builds always use
+        the command.
+
+        If SEPARATE_LOG is True, germinate's output is collected in a log
+        file and only copied to standard output once it has finished, so
+        that the output of concurrent runs is not interleaved.
+        """
+        self.make_indices(project, arch)
 
-    def germinate_project(self, project):
-        osextras.mkemptydir(self.output_dir(project))
+        arch_output_dir = os.path.join(self.output_dir(project), arch)
+        osextras.mkemptydir(arch_output_dir)
+        if (self.config["GERMINATE_HINTS"] and
+                os.path.isfile(self.config["GERMINATE_HINTS"])):
+            shutil.copy2(
+                self.config["GERMINATE_HINTS"],
+                os.path.join(arch_output_dir, "hints"))
+        log_path = None
+        if separate_log:
+            log_path = os.path.join(
+                self.output_dir(project), "germinate-%s.log" % arch)
+        try:
+            api = self.germinate_api
+            if (api is not None and _can_spawn and
+                    self.config.image_type != "source"):
+                self._germinate_arch_in_process(api, project, arch, log_path)
+            else:
+                self._germinate_arch_command(project, arch, log_path)
+        finally:
+            if log_path is not None and os.path.exists(log_path):
+                with self._output_lock, open(log_path) as log:
+                    sys.stdout.flush()
+                    shutil.copyfileobj(log, sys.stdout)
+                    sys.stdout.flush()
+
+    def germinate_projects(self, projects):
+        """Germinate each of PROJECTS for each architecture.
+
+        The archive indices are built first, since they are shared between
+        projects; germinate itself then runs concurrently for each
+        combination of project and architecture.  Projects whose inputs
+        have not changed since they were last germinated keep their
+        previous output.
+        """
+        fingerprints = {}
+        for project in projects:
+            fingerprint = self.fingerprint(project)
+            if self.output_is_current(project, fingerprint):
+                logger.info(
+                    "Germinate inputs for %s are unchanged; reusing "
+                    "previous output." % project)
+            else:
+                fingerprints[project] = fingerprint
+        projects = [project for project in projects if project in fingerprints]
 
-        for arch in self.config.arches:
+        for project in projects:
+            osextras.mkemptydir(self.output_dir(project))
+            for arch in self.config.arches:
+                self.make_indices(project, arch)
+
+        jobs = int(self.config["CDIMAGE_GERMINATE_JOBS"] or GERMINATE_JOBS)
+
+        def germinate(project, arch):
             logger.info(
                 "Germinating for %s/%s ..." % (self.config.series, arch))
-            self.germinate_arch(project, arch)
+            self.germinate_arch(project, arch, separate_log=jobs > 1)
+
+        stages = StageGraph()
+        for project in projects:
+            for arch in self.config.arches:
+                stages.add(
+                    "%s/%s" % (project, arch),
+                    partial(germinate, project, arch))
+        stages.run(jobs=jobs)
+
+        # Every architecture has the same structure; copy the last one, as
+        # germinating the architectures in turn used to.
+        for project in projects:
+            if self.config.arches:
+                shutil.copy2(
+                    os.path.join(
+                        self.output_dir(project), self.config.arches[-1],
+                        "structure"),
+                    os.path.join(self.output_dir(project), "STRUCTURE"))
+            if fingerprints[project] is not None:
+                with AtomicFile(self.fingerprint_path(project)) as f:
+                    print(fingerprints[project], file=f)
+
+    def germinate_project(self, project):
+        self.germinate_projects([project])
 
     def run(self):
         if self.config.image_type == "source":
-            for project in self.config.all_projects:
-                self.germinate_project(project)
+            self.germinate_projects(self.config.all_projects)
         else:
             self.germinate_project(self.config.project)
 
@@ -237,6 +766,10 @@ class GerminateOutput:
         self.directory = directory
         self.structure = os.path.join(directory, "STRUCTURE")
         self._parse_structure()
+        # Parsed seed output and seedtext headers, by (arch, seed).
+        self._seed_packages = {}
+        self._task_headers = {}
+        self._common_initrd_packages = {}
 
     def _parse_structure(self):
         self._seeds = OrderedDict()
@@ -247,24 +780,67 @@ class GerminateOutput:
                     continue
                 seed, inherit = line.split(":", 1)
                 self._seeds[seed] = inherit.split()
-
-    def _expand_inheritance(self, seed, inherit):
-        for s in self._seeds.get(seed, ()):
-            self._expand_inheritance(s, inherit)
-        if seed not in inherit:
-            inherit.append(seed)
+        # Each seed's inheritance closure, with the seeds it inherits from
+        # before the seeds that inherit from them.
+        self._closures = {}
+        self._expanding = []
+        for seed in self._seeds:
+            self._closure(seed)
+        self._list_seeds_cache = {}
+
+    def _closure(self, seed):
+        """Return the seeds that SEED inherits from, and SEED itself.
+
+        Some real STRUCTURE files contain cycles.  These are broken at
+        the point where a seed is reached again while it is still being
+        expanded, and closures that depend on where the cycle was broken
+        are not cached.
+        """
+        closure = self._closures.get(seed)
+        if closure is not None:
+            return closure
+        if seed in self._expanding:
+            self._cycle_depth = min(
+                self._cycle_depth, self._expanding.index(seed))
+            return ()
+        if not self._expanding:
+            self._cycle_depth = sys.maxsize
+        self._expanding.append(seed)
+        try:
+            inherit = OrderedDict()
+            for parent in self._seeds.get(seed, ()):
+                for s in self._closure(parent):
+                    inherit[s] = None
+            inherit[seed] = None
+            closure = tuple(inherit)
+        finally:
+            self._expanding.pop()
+        depth = len(self._expanding)
+        if self._cycle_depth > depth:
+            self._closures[seed] = closure
+        return closure
 
     def _inheritance(self, seed):
-        inherit = []
-        self._expand_inheritance(seed, inherit)
-        return inherit
+        return list(self._closure(seed))
 
     def _without_inheritance(self, subtract, seeds):
-        subtract_inherit = self._inheritance(subtract)
-        remaining = set(seeds) - set(subtract_inherit)
-        return [seed for seed in seeds if seed in remaining]
+        subtract_inherit = set(self._closure(subtract))
+        return [seed for seed in seeds if seed not in subtract_inherit]
 
     def list_seeds(self, mode):
+        # The seeds listed depend on some configuration as well as on the
+        # structure, so include that in the cache key.
+        key = (
+            mode, self.config.project, "%s" % self.config["DIST"],
+            self.config["CDIMAGE_SQUASHFS_BASE"], self.config["CDIMAGE_DVD"],
+            self.config["CDIMAGE_INSTALL_BASE"])
+        seeds = self._list_seeds_cache.get(key)
+        if seeds is None:
+            seeds = self._list_seeds_cache[key] = tuple(
+                self._list_seeds(mode))
+        return iter(seeds)
+
+    def _list_seeds(self, mode):
         project = self.config.project
         series = self.config["DIST"]
 
@@ -317,8 +893,8 @@ class GerminateOutput:
             else:
                 yield "ship-live"
         elif mode == "addon":
-            ship = self._inheritance("ship")
-            ship_addon = self._inheritance("ship-addon")
+            ship = set(self._closure("ship"))
+            ship_addon = self._closure("ship-addon")
             for seed in ship_addon:
                 if seed not in ship:
                     yield seed
@@ -343,10 +919,33 @@ class GerminateOutput:
     def seed_path(self, arch, seed):
         return os.path.join(self.directory, arch, seed)
 
+    def _read_seed_packages(self, arch, seed):
+        """Return the packages in a seed's output, or None if it is missing.
+
+        Seed output files have two lines of header and two of footer
+        around one line per package.
+        """
+        key = (arch, seed)
+        if key not in self._seed_packages:
+            try:
+                with open(self.seed_path(arch, seed)) as seed_file:
+                    lines = seed_file.read().splitlines()[2:-2]
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                packages = None
+            else:
+                packages = tuple(line.split(None, 1)[0] for line in lines)
+            self._seed_packages[key] = packages
+        return self._seed_packages[key]
+
     def seed_packages(self, arch, seed):
-        with open(self.seed_path(arch, seed)) as seed_file:
-            lines = seed_file.read().splitlines()[2:-2]
-            return [line.split(None, 1)[0] for line in lines]
+        packages = self._read_seed_packages(arch, seed)
+        if packages is None:
+            raise IOError(
+                errno.ENOENT, os.strerror(errno.ENOENT),
+                self.seed_path(arch, seed))
+        return list(packages)
 
     def master_seeds(self):
         if self.config["CDIMAGE_ADDON"]:
@@ -451,44 +1050,36 @@ class GerminateOutput:
         else:
             return ["."]
 
-    def initrd_packages(self, initrd, arch):
-        manifest_path = os.path.join(
+    def udeb_manifest_path(self, arch):
+        return os.path.join(
             find_mirror(self.config, arch), "dists", self.config.series,
             "main", "installer-%s" % arch, "current", "images",
             "MANIFEST.udebs")
-        if not os.path.exists(manifest_path):
-            return set()
+
+    def initrd_packages(self, initrd, arch):
         if initrd.startswith("./"):
             initrd = initrd[2:]
-        packages = set()
-        with open(manifest_path) as manifest:
-            found_initrd = False
-            for line in manifest:
-                line = line.rstrip("\n")
-                if line == initrd:
-                    found_initrd = True
-                elif found_initrd:
-                    if line and not line[0].isspace():
-                        break
-                    else:
-                        packages.add(line.split()[0])
-        return packages
+        manifest = _read_udeb_manifest(self.udeb_manifest_path(arch))
+        return manifest.get(initrd, frozenset())
 
     def common_initrd_packages(self, arch):
-        initrd_packages_sets = []
         # Remove installer packages that are in both the cdrom and
         # netboot initrds; there's no point duplicating these.
         cpuarch = arch.split("+")[0]
-        initrds = self.installer_initrds(cpuarch)
-        subarches = self.installer_subarches(cpuarch)
-        for initrd in initrds:
-            for subarch in subarches:
-                initrd_packages_sets.append(self.initrd_packages(
-                    "%s/%s" % (subarch, initrd), cpuarch))
-        if initrd_packages_sets:
-            return set.intersection(*initrd_packages_sets)
-        else:
-            return set()
+        if cpuarch not in self._common_initrd_packages:
+            initrd_packages_sets = []
+            initrds = self.installer_initrds(cpuarch)
+            subarches = self.installer_subarches(cpuarch)
+            for initrd in initrds:
+                for subarch in subarches:
+                    initrd_packages_sets.append(self.initrd_packages(
+                        "%s/%s" % (subarch, initrd), cpuarch))
+            if initrd_packages_sets:
+                common = frozenset.intersection(*initrd_packages_sets)
+            else:
+                common = frozenset()
+            self._common_initrd_packages[cpuarch] = common
+        return self._common_initrd_packages[cpuarch]
 
     def task_project(self, project):
         # ubuntu-server really wants ubuntu-* tasks.
@@ -498,6 +1089,12 @@ class GerminateOutput:
             return project
 
     def task_headers(self, arch, seed):
+        key = (arch, seed)
+        if key not in self._task_headers:
+            self._task_headers[key] = self._read_task_headers(arch, seed)
+        return dict(self._task_headers[key])
+
+    def _read_task_headers(self, arch, seed):
         headers = {}
         try:
             with open("%s.seedtext" % self.seed_path(arch, seed)) as seedtext:
@@ -544,6 +1141,9 @@ class GerminateOutput:
         output_dir = self.tasks_output_dir(master_project)
         osextras.ensuredir(output_dir)
 
+        # Task files collect every architecture's packages, so build them
+        # up in memory and write each one once at the end.
+        task_lines = OrderedDict()
         for arch in self.config.arches:
             initrd_packages = self.common_initrd_packages(arch)
             packages = defaultdict(list)
@@ -553,17 +1153,16 @@ class GerminateOutput:
                     seedsource = "%s+build-depends" % seed
                 else:
                     seedsource = seed
-                seed_path = self.seed_path(arch, seedsource)
-                if not os.path.exists(seed_path):
+                if self._read_seed_packages(arch, seedsource) is None:
                     continue
-                with open(os.path.join(output_dir, seed), "a") as task_file:
-                    print("#ifdef ARCH_%s" % cpparch, file=task_file)
-                    for package in sorted(
-                            self.task_packages(arch, seed, seedsource)):
-                        if package not in initrd_packages:
-                            packages[seed].append(package)
-                            print(package, file=task_file)
-                    print("#endif /* ARCH_%s */" % cpparch, file=task_file)
+                lines = task_lines.setdefault(seed, [])
+                lines.append("#ifdef ARCH_%s" % cpparch)
+                for package in sorted(
+                        self.task_packages(arch, seed, seedsource)):
+                    if package not in initrd_packages:
+                        packages[seed].append(package)
+                        lines.append(package)
+                lines.append("#endif /* ARCH_%s */" % cpparch)
 
             tasks = defaultdict(list)
             for input_seeds, task in self.seed_task_mapping(project, arch):
@@ -577,26 +1176,28 @@ class GerminateOutput:
             # Note that the results of this will be wrong for source images,
             # but that doesn't matter since they won't be used there.
             override_path = os.path.join(output_dir, "override.%s" % arch)
-            with open(override_path, "w") as override:
-                for pkg, tasknames in sorted(tasks.items()):
-                    print(
-                        "%s  Task  %s" % (pkg, ", ".join(tasknames)),
-                        file=override)
+            osextras.write_lines(override_path, [
+                "%s  Task  %s" % (pkg, ", ".join(tasknames))
+                for pkg, tasknames in sorted(tasks.items())])
             # Help debian-cd to get priorities in sync with the current base
             # system, so that debootstrap >= 0.3.1 can work out the correct
             # set of packages to install.
+            important = []
+            for seed in self.list_seeds("debootstrap"):
+                important.extend(packages.get(seed, []))
             important_path = os.path.join(output_dir, "important.%s" % arch)
-            with open(important_path, "w") as important_file:
-                important = []
-                for seed in self.list_seeds("debootstrap"):
-                    important.extend(packages.get(seed, []))
-                for pkg in sorted(important):
-                    if not re_not_base.match(pkg):
-                        print(pkg, file=important_file)
+            osextras.write_lines(important_path, [
+                pkg for pkg in sorted(important)
+                if not re_not_base.match(pkg)])
 
-            with open(os.path.join(output_dir, "MASTER"), "w") as master:
-                for entry in self.master_task_entries(project, source=source):
-                    print(entry, file=master)
+        for seed, lines in task_lines.items():
+            osextras.write_lines(
+                os.path.join(output_dir, seed), lines, mode="a")
+
+        if self.config.arches:
+            osextras.write_lines(
+                os.path.join(output_dir, "MASTER"),
+                list(self.master_task_entries(project, source=source)))
 
     def write_tasks(self):
         if self.config.image_type == "source":
@@ -633,55 +1234,118 @@ class GerminateOutput:
             osextras.mkemptydir(self.tasks_output_dir(self.config.project))
             self.write_tasks_project(self.config.project)
 
-    def diff_tasks(self, output=None):
+    def task_diff(self):
+        """Return a unified diff of the task lists against the previous ones.
+
+        Only task lists that exist both now and previously are compared,
+        and the output looks like that of "diff -u" on each pair.
+        """
         tasks_dir = self.tasks_output_dir(self.config.project)
         previous_tasks_dir = "%s-previous" % tasks_dir
+        diff = []
         for seed in ["MASTER"] + list(self.list_seeds("all")):
             old = os.path.join(previous_tasks_dir, seed)
             new = os.path.join(tasks_dir, seed)
-            if os.path.exists(old) and os.path.exists(new):
-                kwargs = {}
-                if output is not None:
-                    kwargs["stdout"] = output
-                subprocess.call(["diff", "-u", old, new], **kwargs)
+            if not os.path.exists(old) or not os.path.exists(new):
+                continue
+            if filecmp.cmp(old, new, shallow=False):
+                continue
+            with open(old) as old_file:
+                old_lines = old_file.readlines()
+            with open(new) as new_file:
+                new_lines = new_file.readlines()
+            for line in difflib.unified_diff(
+                    old_lines, new_lines, fromfile=old, tofile=new,
+                    fromfiledate=_diff_file_date(old),
+                    tofiledate=_diff_file_date(new)):
+                if not line.endswith("\n"):
+                    line += "\n\\ No newline at end of file\n"
+                diff.append(line)
+        return "".join(diff)
+
+    def diff_tasks(self, output=None, diff=None):
+        """Write the changes to the task lists to OUTPUT (default stdout)."""
+        if output is None:
+            output = sys.stdout
+        if diff is None:
+            diff = self.task_diff()
+        output.write(diff)
+        output.flush()
+
+    def debian_cd_tasks_dir(self):
+        return os.path.join(
+            self.config.root, "debian-cd", "tasks", "auto",
+            self.config.image_type, self.config.project,
+            self.config.full_series)
+
+    def tasks_fingerprint(self):
+        """Return a fingerprint of everything that affects the task lists.
+
+        This covers the germinate output that the tasks are made from, the
+        configuration, and the installer manifests.  Returns None if any
+        of the germinate output has no fingerprint.
+        """
+        if self.config.image_type == "source":
+            projects = self.config.all_projects
+        else:
+            projects = [self.config.project]
+        fingerprint = hashlib.sha256()
+        add = partial(_update_fingerprint, fingerprint)
+        for project in projects:
+            germinate_fingerprint = _read_fingerprint(os.path.join(
+                self.config.root, "scratch", project, self.config.full_series,
+                self.config.image_type, "germinate", ".fingerprint"))
+            if germinate_fingerprint is None:
+                return None
+            add("germinate", project, germinate_fingerprint)
+        for key, value in sorted(self.config.items()):
+            if value and key not in _VOLATILE_CONFIG:
+                add("config", key, value)
+        for arch in self.config.arches:
+            add("manifest", arch, _file_hash(self.udeb_manifest_path(arch)))
+        return fingerprint.hexdigest()
+
+    def tasks_fingerprint_path(self):
+        # Kept outside the tasks directory so that it is not copied along
+        # with the tasks.
+        return "%s.fingerprint" % self.tasks_output_dir(self.config.project)
+
+    def tasks_are_current(self, fingerprint):
+        if fingerprint is None:
+            return False
+        if not os.path.isdir(self.tasks_output_dir(self.config.project)):
+            return False
+        return _read_fingerprint(self.tasks_fingerprint_path()) == fingerprint
+
+    def reuse_tasks(self):
+        """Give debian-cd the task lists from the previous build again."""
+        tasks_dir = self.tasks_output_dir(self.config.project)
+        debian_cd_tasks_dir = self.debian_cd_tasks_dir()
+        osextras.mkemptydir(debian_cd_tasks_dir)
+        for entry in os.listdir(tasks_dir):
+            osextras.link_force(
+                os.path.join(tasks_dir, entry),
+                os.path.join(debian_cd_tasks_dir, entry))
 
     def update_tasks(self, date):
         tasks_dir = self.tasks_output_dir(self.config.project)
         previous_tasks_dir = "%s-previous" % tasks_dir
-        debian_cd_tasks_dir = os.path.join(
-            self.config.root, "debian-cd", "tasks", "auto",
-            self.config.image_type, self.config.project,
-            self.config.full_series)
+        debian_cd_tasks_dir = self.debian_cd_tasks_dir()
 
         task_recipients = []
         task_mail_path = os.path.join(self.config.root, "etc", "task-mail")
         if os.path.exists(task_mail_path):
             with open(task_mail_path) as task_mail:
                 task_recipients = task_mail.read().split()
+        diff = self.task_diff()
         if task_recipients:
-            read, write = os.pipe()
-            pid = os.fork()
-            if pid == 0:  # child
-                try:
-                    os.close(read)
-                    with os.fdopen(write, "w", 1) as write_file:
-                        self.diff_tasks(output=write_file)
-                    os._exit(0)
-                except Exception:
-                    traceback.print_exc()
-                finally:
-                    os._exit(1)
-            else:  # parent
-                os.close(write)
-                with os.fdopen(read) as read_file:
-                    send_mail(
-                        "Task changes for %s %s/%s on %s" % (
-                            self.config.capproject, self.config.image_type,
-                            self.config.full_series, date),
-                        "update-tasks", task_recipients, read_file)
-                os.waitpid(pid, 0)
-
-        self.diff_tasks()
+            send_mail(
+                "Task changes for %s %s/%s on %s" % (
+                    self.config.capproject, self.config.image_type,
+                    self.config.full_series, date),
+                "update-tasks", task_recipients, diff)
+
+        self.diff_tasks(diff=diff)
 
         osextras.mkemptydir(debian_cd_tasks_dir)
         osextras.mkemptydir(previous_tasks_dir)
@@ -692,3 +1356,8 @@ class GerminateOutput:
             shutil.copy2(
                 os.path.join(tasks_dir, entry),
                 os.path.join(previous_tasks_dir, entry))
+
+        fingerprint = self.tasks_fingerprint()
+        if fingerprint is not None:
+            with AtomicFile(self.tasks_fingerprint_path()) as f:
+                print(fingerprint, file=f)
@@ -0,0 +1,138 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Journal of completed publication operations."""
+
+from __future__ import print_function
+
+import json
+import os
+
+from cdimage.atomicfile import AtomicFile
+
+__metaclass__ = type
+
+
+def _stat_record(path):
+    st = os.stat(path)
+    return {"ino": st.st_ino, "size": st.st_size, "mtime": st.st_mtime}
+
+
+class PublishJournal:
+    """Record which publication operations have been completed.
+
+    Each entry is keyed by target path, and records the identity (inode,
+    size, and modification time) of both the source and the target at the
+    time the operation finished.  If publication is interrupted and rerun,
+    operations whose source and target are both unchanged since then can be
+    skipped.
+
+    The journal is a version line followed by one JSON line per change, so
+    that recording an operation only appends to it.  It is compacted when
+    loaded.
+    """
+
+    version = 2
+
+    def __init__(self, path, dry_run=False):
+        self.path = path
+        self.dry_run = dry_run
+        self.entries = {}
+        self.read()
+
+    def read(self):
+        """Load the journal, and compact it."""
+        self.entries = {}
+        try:
+            with open(self.path) as journal:
+                lines = journal.readlines()
+        except (IOError, OSError):
+            lines = []
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            header = {}
+        if isinstance(header, dict) and header.get("version") == self.version:
+            for line in lines[1:]:
+                try:
+                    change = json.loads(line)
+                    target = change.pop("target")
+                except (ValueError, AttributeError, KeyError):
+                    # Probably cut short by an interruption.
+                    continue
+                if change.get("forget"):
+                    self.entries.pop(target, None)
+                else:
+                    self.entries[target] = change
+        self.write()
+
+    def write(self):
+        """Rewrite the whole journal."""
+        if self.dry_run:
+            return
+        # Drop entries for targets that have since been removed.
+        for target in list(self.entries):
+            if not os.path.lexists(target):
+                del self.entries[target]
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with AtomicFile(self.path) as journal:
+            print(json.dumps({"version": self.version}), file=journal)
+            for target in sorted(self.entries):
+                self._write_change(journal, target, self.entries[target])
+
+    @staticmethod
+    def _write_change(journal, target, change):
+        change = dict(change, target=target)
+        print(json.dumps(change, sort_keys=True), file=journal)
+
+    def _append(self, target, change):
+        if not os.path.exists(self.path):
+            self.write()
+            return
+        with open(self.path, "a") as journal:
+            self._write_change(journal, target, change)
+
+    def is_complete(self, operation, source, target):
+        """Has this operation already been completed with these files?"""
+        entry = self.entries.get(target)
+        if entry is None:
+            return False
+        if entry.get("operation") != operation:
+            return False
+        if entry.get("source") != source:
+            return False
+        try:
+            return (entry.get("source_stat") == _stat_record(source) and
+                    entry.get("target_stat") == _stat_record(target))
+        except OSError:
+            return False
+
+    def record(self, operation, source, target):
+        """Record that an operation has been completed, and save."""
+        if self.dry_run:
+            return
+        self.entries[target] = {
+            "operation": operation,
+            "source": source,
+            "source_stat": _stat_record(source),
+            "target_stat": _stat_record(target),
+        }
+        self._append(target, self.entries[target])
+
+    def forget(self, target):
+        """Forget any completed operation for a target."""
+        if self.entries.pop(target, None) is not None and not self.dry_run:
+            self._append(target, {"forget": True})
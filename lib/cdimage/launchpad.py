@@ -18,30 +18,148 @@
 from __future__ import print_function
 
 from collections import defaultdict, Mapping
+from functools import partial
+import json
+import os
+import sqlite3
+import threading
+import time
 
 try:
     from launchpadlib.launchpad import Launchpad
+    from lazr.restfulclient.errors import NotFound
     from lazr.restfulclient.resource import Resource
     launchpad_available = True
 except ImportError:
+    class NotFound(Exception):
+        pass
+
     Resource = type
     launchpad_available = False
 
+from cdimage.atomicfile import AtomicFile
+
 __metaclass__ = type
 
 
+# Launchpad object URLs rarely change, but re-resolve them daily anyway.
+LINK_CACHE_TTL = 24 * 60 * 60
+
+
+class _LinkCache:
+    """Cross-process cache of the URLs of Launchpad objects.
+
+    This maps lookup keys (such as a distribution and series name) to the
+    self_link of the object they resolved to, so that later processes can
+    load objects directly from their URLs rather than traversing to them.
+    Entries expire after TTL seconds.  The cache may be used from several
+    threads; each has its own database connection, since SQLite connections
+    cannot be shared between threads.
+    """
+
+    def __init__(self, path, lp, ttl=LINK_CACHE_TTL):
+        self.path = path
+        self.lp = lp
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS links "
+                    "(key TEXT PRIMARY KEY, link TEXT NOT NULL, "
+                    "expires REAL NOT NULL)")
+            self._local.db = db
+        return db
+
+    def _key(self, parts):
+        return "\t".join([str(self.lp._root_uri)] + list(parts))
+
+    def get(self, *parts):
+        """Return the cached URL for a key, or None."""
+        try:
+            row = self._connect().execute(
+                "SELECT link FROM links WHERE key = ? AND expires > ?",
+                (self._key(parts), time.time())).fetchone()
+        except sqlite3.Error:
+            row = None
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def set(self, link, *parts):
+        try:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO links VALUES (?, ?, ?)",
+                    (self._key(parts), link, time.time() + self.ttl))
+        except sqlite3.Error:
+            pass
+
+    def _forget(self, *parts):
+        try:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "DELETE FROM links WHERE key = ?", (self._key(parts),))
+        except sqlite3.Error:
+            pass
+
+    def summary(self):
+        """Summarise how many lookups were answered from the cache."""
+        with self._stats_lock:
+            return "%d hits, %d misses" % (self.hits, self.misses)
+
+    def resolve(self, lookup, *parts):
+        """Return the object for a key, calling LOOKUP if it is not cached.
+
+        Cached URLs that no longer exist are forgotten.
+        """
+        link = self.get(*parts)
+        if link is not None:
+            try:
+                return self.lp.load(link)
+            except NotFound:
+                self._forget(*parts)
+        item = lookup()
+        if item is not None:
+            self.set(item.self_link, *parts)
+        return item
+
+
+def _resolve(link_cache, lookup, *parts):
+    if link_cache is None:
+        return lookup()
+    return link_cache.resolve(lookup, *parts)
+
+
 class _CachingDict(Mapping):
-    def __init__(self, lp_mapping, item_factory=None):
+    def __init__(self, lp_mapping, item_factory=None, link_cache=None,
+                 kind=None):
         self._lp_mapping = lp_mapping
         if item_factory is None:
             def item_factory(v):
                 return v
         self._item_factory = item_factory
+        self._link_cache = link_cache
+        self._kind = kind
         self._cache = {}
 
     def __getitem__(self, key):
         if key not in self._cache:
-            self._cache[key] = self._item_factory(self._lp_mapping[key])
+            self._cache[key] = self._item_factory(_resolve(
+                self._link_cache, partial(self._lp_mapping.__getitem__, key),
+                self._kind, key))
         return self._cache[key]
 
     def __iter__(self):
@@ -52,9 +170,10 @@ class _CachingDict(Mapping):
 
 
 class _CachingDistroSeries(Resource):
-    def __init__(self, lp_distribution, lp_distroseries):
+    def __init__(self, lp_distribution, lp_distroseries, link_cache=None):
         self._lp_distribution = lp_distribution
         self._lp_distroseries = lp_distroseries
+        self._link_cache = link_cache
         self._das_cache = {}
 
     def __getattr__(self, name):
@@ -66,14 +185,20 @@ class _CachingDistroSeries(Resource):
 
     def getDistroArchSeries(self, archtag=None):
         if archtag not in self._das_cache:
-            self._das_cache[archtag] = (
-                self._lp_distroseries.getDistroArchSeries(archtag=archtag))
+            self._das_cache[archtag] = _resolve(
+                self._link_cache,
+                partial(
+                    self._lp_distroseries.getDistroArchSeries,
+                    archtag=archtag),
+                "distroarchseries", self._lp_distribution.name,
+                self._lp_distroseries.name, archtag)
         return self._das_cache[archtag]
 
 
 class _CachingDistribution(Resource):
-    def __init__(self, lp_distribution):
+    def __init__(self, lp_distribution, link_cache=None):
         self._lp_distribution = lp_distribution
+        self._link_cache = link_cache
         self._series_cache = {}
 
     def __getattr__(self, name):
@@ -83,17 +208,103 @@ class _CachingDistribution(Resource):
         if name_or_version not in self._series_cache:
             self._series_cache[name_or_version] = _CachingDistroSeries(
                 self,
-                self._lp_distribution.getSeries(
-                    name_or_version=name_or_version))
+                _resolve(
+                    self._link_cache,
+                    partial(
+                        self._lp_distribution.getSeries,
+                        name_or_version=name_or_version),
+                    "distroseries", self._lp_distribution.name,
+                    name_or_version),
+                link_cache=self._link_cache)
         return self._series_cache[name_or_version]
 
 
+def _build_duration(lp_build):
+    try:
+        return float(
+            (lp_build.date_finished - lp_build.date_started).total_seconds())
+    except (AttributeError, TypeError):
+        return None
+
+
+class _LatestBuildCache:
+    """Persistent record of the latest successful live filesystem builds.
+
+    Entries are keyed by live filesystem, distroarchseries, and unique key,
+    and record the build's URL and how long it took.
+    """
+
+    def __init__(self, path, lp):
+        self.path = path
+        self.lp = lp
+        self._entries = None
+
+    @staticmethod
+    def _key(lp_livefs, distro_arch_series, unique_key):
+        return " ".join([
+            lp_livefs.self_link, distro_arch_series.self_link,
+            unique_key or ""])
+
+    def _load(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, lp_livefs, distro_arch_series, unique_key=None):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries.get(
+            self._key(lp_livefs, distro_arch_series, unique_key))
+
+    def load(self, lp_livefs, distro_arch_series, unique_key=None):
+        """Return the recorded latest build, or None.
+
+        The build is fetched from Launchpad, and only returned if it is
+        still a successful build for this distroarchseries and unique key.
+        """
+        entry = self.get(lp_livefs, distro_arch_series, unique_key=unique_key)
+        if entry is None:
+            return None
+        try:
+            lp_build = self.lp.load(entry["build"])
+        except NotFound:
+            return None
+        if (lp_build.distro_arch_series_link !=
+                distro_arch_series.self_link or
+                (unique_key and lp_build.unique_key != unique_key) or
+                lp_build.buildstate != "Successfully built"):
+            return None
+        return lp_build
+
+    def set(self, lp_livefs, distro_arch_series, unique_key, lp_build):
+        key = self._key(lp_livefs, distro_arch_series, unique_key)
+        entry = {
+            "build": lp_build.self_link,
+            "duration": _build_duration(lp_build),
+        }
+        # Merge with anything written by other processes in the meantime.
+        self._entries = self._load()
+        if self._entries.get(key) == entry:
+            return
+        self._entries[key] = entry
+        try:
+            with AtomicFile(self.path) as cache_file:
+                json.dump(self._entries, cache_file, sort_keys=True)
+        except (IOError, OSError):
+            pass
+
+
 class _CachingLiveFS(Resource):
-    def __init__(self, lp_distroseries, lp_livefs):
+    def __init__(self, lp_distroseries, lp_livefs, latest_builds=None):
         self._lp_distroseries = lp_distroseries
         self._lp_livefs = lp_livefs
+        self._latest_builds = latest_builds
         # [architecture][subarchitecture]
         self._current_build_cache = defaultdict(dict)
+        # build URL -> (distroarchseries, unique key)
+        self._requested_builds = {}
 
     def __getattr__(self, name):
         return getattr(self._lp_livefs, name)
@@ -104,31 +315,67 @@ class _CachingLiveFS(Resource):
 
     def requestBuild(self, distro_arch_series=None, unique_key=None, **kwargs):
         archtag = distro_arch_series.architecture_tag
-        self._current_build_cache[archtag][unique_key] = (
-            self._lp_livefs.requestBuild(
-                distro_arch_series=distro_arch_series, unique_key=unique_key,
-                **kwargs))
-        return self._current_build_cache[archtag][unique_key]
+        build = self._lp_livefs.requestBuild(
+            distro_arch_series=distro_arch_series, unique_key=unique_key,
+            **kwargs)
+        self._current_build_cache[archtag][unique_key] = build
+        self._requested_builds[build.self_link] = (
+            distro_arch_series, unique_key)
+        return build
+
+    def getExpectedDuration(self, distro_arch_series, unique_key=None):
+        """Return how long the last successful build took, if known."""
+        if self._latest_builds is None:
+            return None
+        entry = self._latest_builds.get(
+            self, distro_arch_series, unique_key=unique_key)
+        if entry is None:
+            return None
+        return entry["duration"]
+
+    def buildSucceeded(self, build):
+        """Remember that a build requested by this process succeeded."""
+        if (self._latest_builds is not None and
+                build.self_link in self._requested_builds):
+            distro_arch_series, unique_key = (
+                self._requested_builds[build.self_link])
+            self._latest_builds.set(
+                self, distro_arch_series, unique_key, build)
 
     def getLatestBuild(self, distro_arch_series, unique_key=None):
         archtag = distro_arch_series.architecture_tag
         if unique_key not in self._current_build_cache[archtag]:
             # If we didn't run the build ourselves, then use the latest
-            # completed build for this DAS.
-            for build in self.completed_builds:
-                if (build.distro_arch_series == distro_arch_series and
-                        (not unique_key or build.unique_key == unique_key) and
-                        build.buildstate == "Successfully built"):
-                    self._current_build_cache[archtag][unique_key] = build
-                    break
-            else:
-                raise Exception("No successful builds found")
+            # successful build recorded by a previous run, which is updated
+            # whenever a build we request succeeds.  Checking it takes a
+            # single request, whereas scanning the completed builds may
+            # page through many.
+            build = None
+            if self._latest_builds is not None:
+                build = self._latest_builds.load(
+                    self, distro_arch_series, unique_key=unique_key)
+            if build is None:
+                for build in self.completed_builds:
+                    if (build.distro_arch_series_link ==
+                            distro_arch_series.self_link and
+                            (not unique_key or
+                             build.unique_key == unique_key) and
+                            build.buildstate == "Successfully built"):
+                        break
+                else:
+                    raise Exception("No successful builds found")
+                if self._latest_builds is not None:
+                    self._latest_builds.set(
+                        self, distro_arch_series, unique_key, build)
+            self._current_build_cache[archtag][unique_key] = build
         return self._current_build_cache[archtag][unique_key]
 
 
 class _CachingLiveFSes:
-    def __init__(self, lp_livefses):
+    def __init__(self, lp_livefses, latest_builds=None, link_cache=None):
         self._lp_livefses = lp_livefses
+        self._latest_builds = latest_builds
+        self._link_cache = link_cache
         # [owner][distribution][distroseries][livefs]
         self._cache = defaultdict(
             lambda: defaultdict(lambda: defaultdict(dict)))
@@ -140,19 +387,80 @@ class _CachingLiveFSes:
         cache = self._cache[owner.name][distro_series.distribution.name][
             distro_series.name]
         if name not in cache:
+            lp_livefs = _resolve(
+                self._link_cache,
+                partial(
+                    self._lp_livefses.getByName,
+                    owner=owner, distro_series=distro_series, name=name),
+                "livefs", owner.name, distro_series.distribution.name,
+                distro_series.name, name)
+            if lp_livefs is None:
+                return None
             cache[name] = _CachingLiveFS(
-                distro_series,
-                self._lp_livefses.getByName(
-                    owner=owner, distro_series=distro_series, name=name))
+                distro_series, lp_livefs, latest_builds=self._latest_builds)
         return cache[name]
 
 
+class LiveFSBuildPoller:
+    """Keep track of the state of a set of live filesystem builds.
+
+    Rather than refreshing every build on each poll, this fetches the
+    pending builds of each live filesystem in one collection query and only
+    refreshes builds that have dropped out of it.  The polling interval
+    backs off while builds are still well short of their expected duration.
+    """
+
+    pending_states = (
+        "Needs building", "Currently building", "Uploading build")
+
+    def __init__(self, min_interval=15, max_interval=300):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # build URL -> (live filesystem, build, expected finish time)
+        self._builds = {}
+
+    def add(self, lp_livefs, lp_build, expected_duration=None):
+        if expected_duration:
+            expected_finish = time.time() + expected_duration
+        else:
+            expected_finish = None
+        self._builds[lp_build.self_link] = (
+            lp_livefs, lp_build, expected_finish)
+
+    def remove(self, lp_build):
+        self._builds.pop(lp_build.self_link, None)
+
+    def refresh(self):
+        """Bring the state of all watched builds up to date."""
+        by_livefs = defaultdict(list)
+        for lp_livefs, lp_build, _ in self._builds.values():
+            by_livefs[lp_livefs.self_link].append((lp_livefs, lp_build))
+        for items in by_livefs.values():
+            pending_links = set(
+                pending.self_link for pending in items[0][0].pending_builds)
+            for _, lp_build in items:
+                if (lp_build.self_link not in pending_links or
+                        lp_build.buildstate not in self.pending_states):
+                    lp_build.lp_refresh()
+
+    def interval(self):
+        """Return how long to wait before the next call to refresh."""
+        now = time.time()
+        interval = self.max_interval
+        for _, _, expected_finish in self._builds.values():
+            if expected_finish is None:
+                return self.min_interval
+            # Halve the distance to the expected finish on each poll.
+            interval = min(interval, (expected_finish - now) / 2)
+        return max(self.min_interval, interval)
+
+
 def login(instance):
     return Launchpad.login_with("ubuntu-cdimage", instance, version="devel")
 
 
 class _LaunchpadCache:
-    def __init__(self, instance=None):
+    def __init__(self, instance=None, cache_dir=None):
         assert launchpad_available
         if not instance:
             instance = "production"
@@ -160,10 +468,23 @@ class _LaunchpadCache:
             # Work around old service root in some versions of launchpadlib.
             instance = "https://api.dogfood.paddev.net/"
         self.lp = login(instance)
-        self.people = _CachingDict(self.lp.people)
+        if cache_dir is not None:
+            self.link_cache = _LinkCache(
+                os.path.join(cache_dir, ".launchpad-links.sqlite"), self.lp)
+            latest_builds = _LatestBuildCache(
+                os.path.join(cache_dir, ".livefs-latest-builds"), self.lp)
+        else:
+            self.link_cache = None
+            latest_builds = None
+        self.people = _CachingDict(
+            self.lp.people, link_cache=self.link_cache, kind="person")
         self.distributions = _CachingDict(
-            self.lp.distributions, _CachingDistribution)
-        self.livefses = _CachingLiveFSes(self.lp.livefses)
+            self.lp.distributions,
+            partial(_CachingDistribution, link_cache=self.link_cache),
+            link_cache=self.link_cache, kind="distribution")
+        self.livefses = _CachingLiveFSes(
+            self.lp.livefses, latest_builds=latest_builds,
+            link_cache=self.link_cache)
 
     def __getattr__(self, name):
         return getattr(self.lp, name)
@@ -172,8 +493,16 @@ class _LaunchpadCache:
 launchpad_cache = None
 
 
-def get_launchpad(instance=None):
+def link_cache_summary():
+    """Summarise the use of the link cache in this process, if any."""
+    if launchpad_cache is None or launchpad_cache.link_cache is None:
+        return None
+    return launchpad_cache.link_cache.summary()
+
+
+def get_launchpad(instance=None, cache_dir=None):
     global launchpad_cache
     if launchpad_cache is None:
-        launchpad_cache = _LaunchpadCache(instance=instance)
+        launchpad_cache = _LaunchpadCache(
+            instance=instance, cache_dir=cache_dir)
     return launchpad_cache
@@ -25,9 +25,9 @@ import os
 import re
 import subprocess
 from textwrap import dedent
+import threading
 import time
 import shutil
-import errno
 try:
     from urllib.error import URLError
     from urllib.parse import unquote
@@ -37,14 +37,20 @@ except ImportError:
 
 from cdimage import osextras, sign
 from cdimage.config import Touch
-from cdimage.launchpad import get_launchpad
+from cdimage.launchpad import LiveFSBuildPoller, get_launchpad
 from cdimage.log import logger
 from cdimage.mail import get_notify_addresses, send_mail
 from cdimage.tracker import tracker_set_rebuild_status
+from cdimage.transport import transfer_stats
 
 __metaclass__ = type
 
 
+# Maximum number of architectures whose live filesystems are downloaded at
+# once.
+LIVE_DOWNLOAD_JOBS = 4
+
+
 class UnknownArchitecture(Exception):
     pass
 
@@ -344,7 +350,7 @@ def get_lp_livefs(config, arch):
     else:
         instance = None
         owner, name = lp_info
-    lp = get_launchpad(instance)
+    lp = get_launchpad(instance, cache_dir=os.path.join(config.root, "etc"))
     lp_owner = lp.people[owner]
     lp_distribution = lp.distributions[config.distribution]
     lp_ds = lp_distribution.getSeries(name_or_version=config.series)
@@ -357,9 +363,17 @@ def get_lp_livefs(config, arch):
     return lp, livefs
 
 
-def run_live_builds(config):
+def run_live_builds(config, on_success=None):
+    """Build live filesystems for all architectures.
+
+    If ON_SUCCESS is given, it is called with each architecture as soon as
+    its build succeeds, so that work depending only on that architecture
+    can start while other builds are still running.
+    """
     builds = {}
     lp_builds = []
+    watcher = osextras.ChildWatcher()
+    poller = LiveFSBuildPoller()
     for arch in config.arches:
         if arch == "amd64+mac":
             # Use normal amd64 live image on amd64+mac.
@@ -378,10 +392,17 @@ def run_live_builds(config):
             lp_kwargs = live_build_lp_kwargs(config, lp, lp_livefs, arch)
             lp_build = lp_livefs.requestBuild(**lp_kwargs)
             logger.info("%s: %s" % (full_name, lp_build.web_link))
-            lp_builds.append((lp_build, arch, full_name, machine, None))
+            poller.add(
+                lp_livefs, lp_build,
+                expected_duration=lp_livefs.getExpectedDuration(
+                    lp_kwargs["distro_arch_series"],
+                    unique_key=lp_kwargs.get("unique_key")))
+            lp_builds.append(
+                (lp_livefs, lp_build, arch, full_name, machine, None))
         else:
             proc = subprocess.Popen(live_build_command(config, arch))
             builds[proc.pid] = (proc, arch, full_name, machine)
+            watcher.add(proc)
 
     successful = set()
 
@@ -392,54 +413,72 @@ def run_live_builds(config):
             full_name, machine, timestamp, text_status))
         tracker_set_rebuild_status(config, [0, 1, 2], 3, arch)
         if status == 0:
-            successful.add(arch)
+            finished = [arch]
             if arch == "amd64" and "amd64+mac" in config.arches:
-                successful.add("amd64+mac")
+                finished.append("amd64+mac")
+            for finished_arch in finished:
+                successful.add(finished_arch)
+                if on_success is not None:
+                    on_success(finished_arch)
         else:
             live_build_notify_failure(config, arch, lp_build=lp_build)
 
-    while builds or lp_builds:
-        # Check for non-Launchpad build results.
-        for pid, (proc, arch, full_name, machine) in list(builds.items()):
-            status = proc.poll()
-            if status is not None:
-                del builds[pid]
-                live_build_finished(
-                    arch, full_name, machine, status,
-                    "success" if status == 0 else "failed")
-
-        # Check for Launchpad build results.
-        pending_lp_builds = []
-        for lp_item in lp_builds:
-            lp_build, arch, full_name, machine, log_timeout = lp_item
-            lp_build.lp_refresh()
-            if lp_build.buildstate in (
-                    "Needs building", "Currently building", "Uploading build"):
-                pending_lp_builds.append(lp_item)
-            elif lp_build.buildstate == "Successfully built":
-                live_build_finished(
-                    arch, full_name, machine, 0, lp_build.buildstate,
-                    lp_build=lp_build)
-            elif (lp_build.build_log_url is None and
-                  (log_timeout is None or time.time() < log_timeout)):
-                # Wait up to five minutes for Launchpad to fetch the build
-                # log from the slave.  We need a timeout since in rare cases
-                # this might fail.
-                if log_timeout is None:
-                    log_timeout = time.time() + 300
-                pending_lp_builds.append(
-                    (lp_build, arch, full_name, machine, log_timeout))
-            else:
-                live_build_finished(
-                    arch, full_name, machine, 1, lp_build.buildstate,
-                    lp_build=lp_build)
-        lp_builds = pending_lp_builds
-
-        if lp_builds:
-            # Wait a while before polling Launchpad again.  If a
-            # non-Launchpad build completes in the meantime, it will
-            # interrupt this sleep with SIGCHLD.
-            time.sleep(15)
+    next_lp_poll = time.time()
+    try:
+        while builds or lp_builds:
+            # Check for non-Launchpad build results.
+            for pid, (proc, arch, full_name, machine) in list(builds.items()):
+                status = proc.poll()
+                if status is not None:
+                    del builds[pid]
+                    watcher.remove(proc)
+                    live_build_finished(
+                        arch, full_name, machine, status,
+                        "success" if status == 0 else "failed")
+
+            # Check for Launchpad build results.
+            if lp_builds and time.time() >= next_lp_poll:
+                poller.refresh()
+                pending_lp_builds = []
+                for lp_item in lp_builds:
+                    (lp_livefs, lp_build, arch, full_name, machine,
+                     log_timeout) = lp_item
+                    if lp_build.buildstate in poller.pending_states:
+                        pending_lp_builds.append(lp_item)
+                    elif lp_build.buildstate == "Successfully built":
+                        poller.remove(lp_build)
+                        lp_livefs.buildSucceeded(lp_build)
+                        live_build_finished(
+                            arch, full_name, machine, 0, lp_build.buildstate,
+                            lp_build=lp_build)
+                    elif (lp_build.build_log_url is None and
+                          (log_timeout is None or time.time() < log_timeout)):
+                        # Wait up to five minutes for Launchpad to fetch the
+                        # build log from the slave.  We need a timeout since
+                        # in rare cases this might fail.
+                        if log_timeout is None:
+                            log_timeout = time.time() + 300
+                        pending_lp_builds.append(
+                            (lp_livefs, lp_build, arch, full_name, machine,
+                             log_timeout))
+                    else:
+                        poller.remove(lp_build)
+                        live_build_finished(
+                            arch, full_name, machine, 1, lp_build.buildstate,
+                            lp_build=lp_build)
+                lp_builds = pending_lp_builds
+                # Wait a while before polling Launchpad again.
+                next_lp_poll = time.time() + poller.interval()
+
+            if builds or lp_builds:
+                # Sleep until a local build exits or it is time to poll
+                # Launchpad again, whichever comes first.
+                if lp_builds:
+                    watcher.wait(max(0, next_lp_poll - time.time()))
+                else:
+                    watcher.wait()
+    finally:
+        watcher.close()
 
     if not successful:
         raise LiveBuildsFailed("No live filesystem builds succeeded.")
@@ -532,10 +571,136 @@ def flavours(config, arch):
             "No live filesystem source known for %s" % arch)
 
 
-def live_item_paths(config, arch, item):
+# Items named after the live filesystem project, with no kernel flavour.
+live_filesystem_items = (
+    "cloop", "squashfs", "manifest", "manifest-desktop", "manifest-remove",
+    "manifest-minimal-remove", "size", "ext2", "ext3", "ext4",
+    "rootfs.tar.gz", "custom.tar.gz", "device.tar.gz",
+    "azure.device.tar.gz", "raspi2.device.tar.gz", "plano.device.tar.gz",
+    "tar.xz", "iso", "os.snap", "kernel.snap", "disk1.img.xz",
+    "dragonboard.kernel.snap", "raspi2.kernel.snap",
+    "img.xz", "model-assertion"
+)
+
+# Items with one artefact per kernel flavour.
+live_kernel_items = ("kernel", "initrd", "bootimg", "modules.squashfs")
+
+# Other items fetched from elsewhere.
+live_other_items = (
+    "kernel-efi-signed", "wubi", "usb-creator", "ltsp-squashfs")
+
+
+class ArtefactCatalog:
+    """The live filesystem artefacts available for a single architecture.
+
+    The set of available artefacts is listed at most once, when it is first
+    needed, and lookups of artefacts by base name and item suffix are
+    memoised.  A single catalog can therefore answer all the item queries
+    made while downloading live filesystems for an architecture.
+
+    Catalogs for other architectures (such as the i386 LTSP image used on
+    amd64) are found through for_arch(), which shares them between all the
+    catalogs created from the same CATALOGS mapping.
+    """
+
+    def __init__(self, config, arch, catalogs=None):
+        self.config = config
+        self.arch = arch
+        self.root = ""
+        # Were the available artefacts actually listed, rather than guessed?
+        self.listed = False
+        self._filenames = None
+        self._matches = {}
+        self._touch_items = None
+        if catalogs is None:
+            catalogs = {}
+        self._catalogs = catalogs
+        self._catalogs.setdefault(arch, self)
+
+    def for_arch(self, arch):
+        """Return the catalog for ARCH, sharing this catalog's siblings."""
+        if arch not in self._catalogs:
+            ArtefactCatalog(self.config, arch, catalogs=self._catalogs)
+        return self._catalogs[arch]
+
+    def load(self):
+        """List the available artefacts, if not already listed.
+
+        This talks to Launchpad, so must be called from the thread that
+        owns the Launchpad connection before handing the catalog to
+        another thread.
+        """
+        if self._filenames is None:
+            self._list_artefacts()
+
+    def _list_artefacts(self):
+        lp, lp_livefs = get_lp_livefs(self.config, self.arch)
+        uris = []
+        if lp_livefs is not None:
+            lp_kwargs = live_build_lp_kwargs(
+                self.config, lp, lp_livefs, self.arch)
+            lp_build = lp_livefs.getLatestBuild(
+                lp_kwargs["distro_arch_series"],
+                unique_key=lp_kwargs.get("unique_key"))
+            uris = list(lp_build.getFileUrls())
+            self.listed = True
+        else:
+            self.root = livecd_base(self.config, self.arch)
+            try:
+                uris = [
+                    os.path.join(self.root, u) for u in os.listdir(self.root)]
+                self.listed = True
+            except OSError:
+                # fallback to exact given uri (for http://) in urls_for as
+                # we can't list content.
+                pass
+        self._filenames = [
+            (unquote(os.path.basename(uri)), uri) for uri in uris]
+
+    def urls_for(self, base, item):
+        """Return the URLs of artefacts named BASE.*.ITEM."""
+        key = (base, item)
+        if key not in self._matches:
+            self.load()
+            if self._filenames:
+                self._matches[key] = [
+                    uri for filename, uri in self._filenames
+                    if (filename.startswith(base + '.') and
+                        filename.endswith('.' + item))]
+            else:
+                self._matches[key] = [
+                    os.path.join(self.root, base + '.' + item)]
+        return list(self._matches[key])
+
+    @property
+    def touch_items(self):
+        """Map Touch image item names to their kinds."""
+        if self._touch_items is None:
+            self._touch_items = {}
+            for target in Touch.list_targets_by_ubuntu_arch(self.arch):
+                self._touch_items["boot-%s+%s.img" % (
+                    target.ubuntu_arch, target.subarch)] = "boot"
+                self._touch_items["recovery-%s+%s.img" % (
+                    target.android_arch, target.subarch)] = "recovery"
+                self._touch_items["system-%s+%s.img" % (
+                    target.android_arch, target.subarch)] = "system"
+        return self._touch_items
+
+    def all_items(self):
+        """Return all the items that can be looked up for this catalog."""
+        return (
+            list(live_filesystem_items) + list(live_kernel_items) +
+            sorted(self.touch_items) + list(live_other_items))
+
+
+def live_item_paths(config, arch, item, catalog=None):
     if item == "ltsp-squashfs" and arch == "amd64":
         # use i386 LTSP image on amd64 too
         arch = "i386"
+    if catalog is None:
+        catalog = ArtefactCatalog(config, arch)
+    else:
+        catalog = catalog.for_arch(arch)
     cpuarch, subarch = split_arch(arch)
     project = config.project
     series = config["DIST"]
@@ -544,44 +709,9 @@ def live_item_paths(config, arch, item):
         liveproject_subarch = "%s-%s" % (liveproject, subarch)
     else:
         liveproject_subarch = liveproject
+    urls_for = catalog.urls_for
 
-    lp, lp_livefs = get_lp_livefs(config, arch)
-    uris = []
-    root = ""
-    if lp_livefs is not None:
-        lp_kwargs = live_build_lp_kwargs(config, lp, lp_livefs, arch)
-        lp_build = lp_livefs.getLatestBuild(
-            lp_kwargs["distro_arch_series"],
-            unique_key=lp_kwargs.get("unique_key"))
-        uris = list(lp_build.getFileUrls())
-    else:
-        root = livecd_base(config, arch)
-        try:
-            uris = [os.path.join(root, u) for u in os.listdir(root)]
-        except OSError:
-            # fallback to exact given uri (for http://) in url_for as we can't
-            # list content.
-            pass
-
-    def urls_for(base, item):
-        if uris:
-            for uri in uris:
-                filename = unquote(os.path.basename(uri))
-                if (filename.startswith(base + '.') and
-                        filename.endswith('.' + item)):
-                    yield uri
-        else:
-            yield os.path.join(root, base + '.' + item)
-
-    if item in (
-        "cloop", "squashfs", "manifest", "manifest-desktop", "manifest-remove",
-        "manifest-minimal-remove", "size", "ext2", "ext3", "ext4",
-        "rootfs.tar.gz", "custom.tar.gz", "device.tar.gz",
-        "azure.device.tar.gz", "raspi2.device.tar.gz", "plano.device.tar.gz",
-        "tar.xz", "iso", "os.snap", "kernel.snap", "disk1.img.xz",
-        "dragonboard.kernel.snap", "raspi2.kernel.snap",
-        "img.xz", "model-assertion"
-    ):
+    if item in live_filesystem_items:
         if item == "ext4" and arch == "armhf+nexus7":
             for url in urls_for(
                     "livecd." + liveproject_subarch, item + "-nexus7"):
@@ -596,25 +726,14 @@ def live_item_paths(config, arch, item):
                 if url.endswith("modules.squashfs"):
                     continue
                 yield url
-    elif item in (
-        "kernel", "initrd", "bootimg", "modules.squashfs"
-    ):
+    elif item in live_kernel_items:
         our_flavours = flavours(config, arch)
         our_flavours.extend(["%s-hwe" % (f,) for f in our_flavours])
         for flavour in our_flavours:
             for url in urls_for("livecd." + liveproject_subarch,
                                 item + "-" + flavour):
                 yield url
-    elif item in (
-        "boot-%s+%s.img" % (target.ubuntu_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ) or item in (
-        "recovery-%s+%s.img" % (target.android_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ) or item in (
-        "system-%s+%s.img" % (target.android_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ):
+    elif item in catalog.touch_items:
         for flavour in flavours(config, arch):
             for url in urls_for("livecd." + liveproject_subarch, item):
                 yield url
@@ -649,13 +768,18 @@ def live_output_directory(config):
         "live")
 
 
-def download_live_items(config, arch, item):
+def download_live_items(config, arch, item, catalog=None):
     output_dir = live_output_directory(config)
     found = False
 
-    urls = list(live_item_paths(config, arch, item))
+    if catalog is None:
+        catalog = ArtefactCatalog(config, arch)
+    else:
+        catalog = catalog.for_arch(arch)
+    urls = list(live_item_paths(config, arch, item, catalog=catalog))
     if not urls:
         return False
+    touch_item = catalog.touch_items.get(item)
 
     if item in (
         "kernel", "initrd", "bootimg"
@@ -670,18 +794,7 @@ def download_live_items(config, arch, item):
                 found = True
             except osextras.FetchError:
                 pass
-            try:
-                shutil.copy2(url, target)
-                found = True
-            except shutil.Error:
-                pass
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    pass
-    elif item in (
-        "boot-%s+%s.img" % (target.ubuntu_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ):
+    elif touch_item == "boot":
         for url in urls:
             target = os.path.join(output_dir, item)
             try:
@@ -701,10 +814,7 @@ def download_live_items(config, arch, item):
                 found = True
             except osextras.FetchError:
                 pass
-    elif item in (
-        "recovery-%s+%s.img" % (target.android_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ):
+    elif touch_item == "recovery":
         for url in urls:
             target = os.path.join(output_dir, item)
             try:
@@ -712,10 +822,7 @@ def download_live_items(config, arch, item):
                 found = True
             except osextras.FetchError:
                 pass
-    elif item in (
-        "system-%s+%s.img" % (target.android_arch, target.subarch)
-            for target in Touch.list_targets_by_ubuntu_arch(arch)
-    ):
+    elif touch_item == "system":
         for url in urls:
             target = os.path.join(output_dir, item)
             try:
@@ -755,16 +862,6 @@ def download_live_items(config, arch, item):
                 found = True
             except osextras.FetchError:
                 pass
-            try:
-                shutil.copy2(url, target)
-                if target.endswith("squashfs"):
-                    sign.sign_cdimage(config, target)
-                found = True
-            except shutil.Error:
-                pass
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    pass
     return found
 
 
@@ -790,147 +887,262 @@ def write_autorun(config, arch, name, label):
             VideoFiles=false""")) % (u(name), u(name), u(label)), file=autorun)
 
 
-def download_live_filesystems(config):
+def clean_live_output_directory(output_dir):
+    """Empty the live output directory, keeping partial downloads.
+
+    Interrupted downloads can then be resumed by the next build.
+    """
+    if not os.path.isdir(output_dir):
+        osextras.mkemptydir(output_dir)
+        return
+    for name in os.listdir(output_dir):
+        if name.endswith((".part", ".part.json")):
+            continue
+        path = os.path.join(output_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+
+def live_catalog_arches(config, arch):
+    """Return the architectures whose artefacts are downloaded for ARCH."""
+    arches = [arch]
+    if (config.project == "edubuntu" and config["CDIMAGE_DVD"] and
+            arch == "amd64"):
+        # The i386 LTSP image is used on amd64 too.
+        arches.append("i386")
+    return arches
+
+
+def _live_filesystem_downloader(config, catalogs=None):
+    """Return a function that downloads the live filesystem for an arch.
+
+    The returned function returns True if it found a filesystem image.
+    CATALOGS maps architectures to ArtefactCatalog objects; catalogs that
+    are already loaded are used without listing their artefacts again.
+    """
     project = config.project
     series = config["DIST"]
-
     output_dir = live_output_directory(config)
-    osextras.mkemptydir(output_dir)
 
-    if (config["CDIMAGE_LIVE"] or config["CDIMAGE_SQUASHFS_BASE"] or
-            config["CDIMAGE_PREINSTALLED"]):
-        got_image = False
-        for arch in config.arches:
-            if config["CDIMAGE_PREINSTALLED"]:
-                if project == "ubuntu-server":
-                    if download_live_items(config, arch, "disk1.img.xz"):
-                        got_image = True
-                    else:
-                        continue
-                elif download_live_items(config, arch, "ext4"):
-                    got_image = True
-                elif download_live_items(config, arch, "ext3"):
-                    got_image = True
-                elif download_live_items(config, arch, "ext2"):
-                    got_image = True
-                elif download_live_items(config, arch, "rootfs.tar.gz"):
-                    got_image = True
-                else:
-                    continue
-            elif config["UBUNTU_DEFAULTS_LOCALE"]:
-                if download_live_items(config, arch, "iso"):
-                    got_image = True
-                else:
-                    continue
-            elif download_live_items(config, arch, "img.xz"):
-                got_image = True
-            elif download_live_items(config, arch, "cloop"):
-                got_image = True
-            elif download_live_items(config, arch, "squashfs"):
-                download_live_items(config, arch, "modules.squashfs")
-                got_image = True
-            elif download_live_items(config, arch, "rootfs.tar.gz"):
-                got_image = True
-            elif download_live_items(config, arch, "tar.xz"):
-                got_image = True
+    # Artefacts are only listed once per architecture.
+    if catalogs is None:
+        catalogs = {}
+
+    def download(arch, item):
+        if arch not in catalogs:
+            ArtefactCatalog(config, arch, catalogs=catalogs)
+        return download_live_items(config, arch, item, catalog=catalogs[arch])
+
+    def download_image(arch):
+        if config["CDIMAGE_PREINSTALLED"]:
+            if project == "ubuntu-server":
+                if not download(arch, "disk1.img.xz"):
+                    return False
+            elif download(arch, "ext4"):
+                pass
+            elif download(arch, "ext3"):
+                pass
+            elif download(arch, "ext2"):
+                pass
+            elif download(arch, "rootfs.tar.gz"):
+                pass
             else:
-                continue
-            if (project != "ubuntu-base" and
-                    not config["CDIMAGE_SQUASHFS_BASE"] and
-                    config.subproject != "wubi"):
-                download_live_items(config, arch, "kernel")
-                download_live_items(config, arch, "initrd")
-                download_live_items(config, arch, "kernel-efi-signed")
-                if config["CDIMAGE_PREINSTALLED"]:
-                    download_live_items(config, arch, "bootimg")
-
-            download_live_items(config, arch, "manifest")
-            if not download_live_items(config, arch, "manifest-remove"):
-                download_live_items(config, arch, "manifest-desktop")
-            download_live_items(config, arch, "manifest-minimal-remove")
-            download_live_items(config, arch, "size")
-
-            if (config["UBUNTU_DEFAULTS_LOCALE"] or
-                    config["CDIMAGE_PREINSTALLED"] or
-                    config.subproject == "wubi"):
-                continue
-
-            if (project not in ("livecd-base", "ubuntu-base", "ubuntu-core",
-                                "kubuntu-active") and
-                    (project != "edubuntu" or series >= "precise") and
-                    (project != "ubuntukylin" or series <= "trusty")):
-                if series <= "trusty":
-                    # TODO: We still have to do something about not
-                    # including Wubi on the DVDs.
-                    download_live_items(config, arch, "wubi")
-                    wubi_path = os.path.join(output_dir, "%s.wubi.exe" % arch)
-                    if os.path.exists(wubi_path):
-                        # Nicely format the distribution name.
-                        def upper_first(m):
-                            text = m.group(0)
-                            return text[0].upper() + text[1:]
-
-                        autorun_project = re.sub(
-                            r"(\b[a-z])", upper_first,
-                            project.replace("-", " "))
-                        write_autorun(
-                            config, arch, "wubi.exe",
-                            "Install %s" % autorun_project)
-
-            if project not in ("livecd-base", "ubuntu-base", "ubuntu-core",
-                               "edubuntu"):
-                download_live_items(config, arch, "usb-creator")
-            if project == "ubuntu-core" and config["CDIMAGE_LIVE"]:
-                download_live_items(config, arch, "model-assertion")
-
-        if not got_image:
-            raise NoFilesystemImages("No filesystem images found.")
-
-    if config.project == "ubuntu-touch":
-        for arch in config.arches:
+                return False
+        elif config["UBUNTU_DEFAULTS_LOCALE"]:
+            if not download(arch, "iso"):
+                return False
+        elif download(arch, "img.xz"):
+            pass
+        elif download(arch, "cloop"):
+            pass
+        elif download(arch, "squashfs"):
+            download(arch, "modules.squashfs")
+        elif download(arch, "rootfs.tar.gz"):
+            pass
+        elif download(arch, "tar.xz"):
+            pass
+        else:
+            return False
+        if (project != "ubuntu-base" and
+                not config["CDIMAGE_SQUASHFS_BASE"] and
+                config.subproject != "wubi"):
+            download(arch, "kernel")
+            download(arch, "initrd")
+            download(arch, "kernel-efi-signed")
+            if config["CDIMAGE_PREINSTALLED"]:
+                download(arch, "bootimg")
+
+        download(arch, "manifest")
+        if not download(arch, "manifest-remove"):
+            download(arch, "manifest-desktop")
+        download(arch, "manifest-minimal-remove")
+        download(arch, "size")
+
+        if (config["UBUNTU_DEFAULTS_LOCALE"] or
+                config["CDIMAGE_PREINSTALLED"] or
+                config.subproject == "wubi"):
+            return True
+
+        if (project not in ("livecd-base", "ubuntu-base", "ubuntu-core",
+                            "kubuntu-active") and
+                (project != "edubuntu" or series >= "precise") and
+                (project != "ubuntukylin" or series <= "trusty")):
+            if series <= "trusty":
+                # TODO: We still have to do something about not
+                # including Wubi on the DVDs.
+                download(arch, "wubi")
+                wubi_path = os.path.join(output_dir, "%s.wubi.exe" % arch)
+                if os.path.exists(wubi_path):
+                    # Nicely format the distribution name.
+                    def upper_first(m):
+                        text = m.group(0)
+                        return text[0].upper() + text[1:]
+
+                    autorun_project = re.sub(
+                        r"(\b[a-z])", upper_first,
+                        project.replace("-", " "))
+                    write_autorun(
+                        config, arch, "wubi.exe",
+                        "Install %s" % autorun_project)
+
+        if project not in ("livecd-base", "ubuntu-base", "ubuntu-core",
+                           "edubuntu"):
+            download(arch, "usb-creator")
+        if project == "ubuntu-core" and config["CDIMAGE_LIVE"]:
+            download(arch, "model-assertion")
+        return True
+
+    def download_extras(arch):
+        if config.project == "ubuntu-touch":
             for abootimg in (
                 "boot-%s+%s.img" % (target.ubuntu_arch, target.subarch)
                     for target in Touch.list_targets_by_ubuntu_arch(arch)
             ):
-                download_live_items(
-                    config, arch, abootimg
-                )
+                download(arch, abootimg)
             for recoveryimg in (
                 "recovery-%s+%s.img" % (target.android_arch, target.subarch)
                     for target in Touch.list_targets_by_ubuntu_arch(arch)
             ):
-                download_live_items(
-                    config, arch, recoveryimg
-                )
+                download(arch, recoveryimg)
             for systemimg in (
                 "system-%s+%s.img" % (target.android_arch, target.subarch)
                     for target in Touch.list_targets_by_ubuntu_arch(arch)
             ):
-                download_live_items(
-                    config, arch, systemimg
-                )
-            download_live_items(config, arch, "custom.tar.gz")
-
-    if config.project == "ubuntu-core":
-        for arch in config.arches:
-            download_live_items(config, arch, "device.tar.gz")
-
-    if config.project == "ubuntu-core":
-        for arch in config.arches:
-            download_live_items(config, arch, "os.snap")
-            download_live_items(config, arch, "kernel.snap")
+                download(arch, systemimg)
+            download(arch, "custom.tar.gz")
+
+        if config.project == "ubuntu-core":
+            download(arch, "device.tar.gz")
+            download(arch, "os.snap")
+            download(arch, "kernel.snap")
             if arch == "amd64":
                 for devarch in ("azure", "plano"):
-                    download_live_items(config, arch, "%s.device.tar.gz" %
-                                        devarch)
+                    download(arch, "%s.device.tar.gz" % devarch)
             if arch == "armhf":
-                download_live_items(config, arch, "raspi2.device.tar.gz")
-                download_live_items(config, arch, "raspi2.kernel.snap")
+                download(arch, "raspi2.device.tar.gz")
+                download(arch, "raspi2.kernel.snap")
             if arch == "arm64":
-                download_live_items(config, arch, "dragonboard.kernel.snap")
+                download(arch, "dragonboard.kernel.snap")
 
-    if project == "edubuntu" and config["CDIMAGE_DVD"]:
-        for arch in config.arches:
+        if project == "edubuntu" and config["CDIMAGE_DVD"]:
             if arch in ("amd64", "i386"):
                 # Fetch the i386 LTSP chroot for Edubuntu Terminal Server.
-                download_live_items(config, arch, "ltsp-squashfs")
+                download(arch, "ltsp-squashfs")
+
+    def download_arch(arch):
+        got_image = False
+        if (config["CDIMAGE_LIVE"] or config["CDIMAGE_SQUASHFS_BASE"] or
+                config["CDIMAGE_PREINSTALLED"]):
+            got_image = download_image(arch)
+        download_extras(arch)
+        return got_image
+
+    return download_arch
+
+
+class LiveDownloads:
+    """Live filesystem downloads, with one background job per architecture.
+
+    Downloads for an architecture can be started early with start(), for
+    instance as soon as its live filesystem build has succeeded, so that
+    they overlap with builds for slower architectures.  At most
+    CDIMAGE_LIVE_DOWNLOAD_JOBS architectures download at once; the rest
+    wait for a free slot.  finish() starts any architectures that have not
+    been started yet and waits for all of them.
+
+    launchpadlib is not thread-safe, so the artefacts for each architecture
+    are listed in the calling thread before its job starts, and the jobs
+    themselves only fetch plain URLs.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        clean_live_output_directory(live_output_directory(config))
+        transfer_stats.reset()
+        self.catalogs = {}
+        self.download_arch = _live_filesystem_downloader(
+            config, catalogs=self.catalogs)
+        self.slots = threading.BoundedSemaphore(int(
+            config["CDIMAGE_LIVE_DOWNLOAD_JOBS"] or LIVE_DOWNLOAD_JOBS))
+        self.threads = {}
+        self.results = {}
+        self.errors = {}
+
+    def _run(self, arch):
+        try:
+            with self.slots:
+                self.results[arch] = self.download_arch(arch)
+        except Exception as e:
+            self.errors[arch] = e
+
+    def start(self, arch):
+        """Start downloading the live filesystem for ARCH."""
+        if arch in self.threads or arch in self.errors:
+            return
+        try:
+            for catalog_arch in live_catalog_arches(self.config, arch):
+                if catalog_arch not in self.catalogs:
+                    ArtefactCatalog(
+                        self.config, catalog_arch, catalogs=self.catalogs)
+                self.catalogs[catalog_arch].load()
+        except Exception as e:
+            self.errors[arch] = e
+            return
+        thread = threading.Thread(target=self._run, args=(arch,))
+        thread.start()
+        self.threads[arch] = thread
+
+    def finish(self):
+        """Download any remaining live filesystems and wait for them all."""
+        arches = self.config.arches
+        for arch in arches:
+            self.start(arch)
+        for arch in arches:
+            if arch in self.threads:
+                self.threads[arch].join()
+        for arch in arches:
+            if arch in self.errors:
+                raise self.errors[arch]
+
+        if (self.config["CDIMAGE_LIVE"] or
+                self.config["CDIMAGE_SQUASHFS_BASE"] or
+                self.config["CDIMAGE_PREINSTALLED"]):
+            if not any(self.results.get(arch) for arch in arches):
+                raise NoFilesystemImages("No filesystem images found.")
+
+        summary = transfer_stats.summary()
+        if summary:
+            logger.info("Fetched live filesystems (%s)" % summary)
+
+
+def download_live_filesystems(config, downloads=None):
+    """Download live filesystems for all architectures.
+
+    DOWNLOADS may be a LiveDownloads object for which some architectures
+    have already been started.
+    """
+    if downloads is None:
+        downloads = LiveDownloads(config)
+    downloads.finish()
@@ -0,0 +1,222 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lock files.
+
+A lock is an flock(2) lock on a file that exists exactly while the lock is
+held, so scripts that only look for the file keep working.  Waiting for a
+lock sleeps in the kernel until it is released rather than polling, and a
+lock held by a process that dies is released automatically.  The holder
+writes its PID and boot ID into the file, which helps to explain who is
+holding a lock when waiting for it times out.
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import os
+import threading
+import time
+
+from cdimage import osextras
+from cdimage.log import logger
+
+__metaclass__ = type
+
+
+# Waits for a lock at least this long, in seconds, are logged.
+LOG_WAIT_THRESHOLD = 1
+
+
+class LockError(Exception):
+    pass
+
+
+class LockTimeout(LockError):
+    pass
+
+
+def _boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot_id:
+            return boot_id.read().strip()
+    except IOError:
+        return ""
+
+
+def _flock_with_timeout(fd, timeout):
+    """Wait up to TIMEOUT seconds for an exclusive lock on FD.
+
+    The wait happens in a helper thread blocked in flock(2), so that the
+    lock is taken as soon as it is released.  Returns True if the lock was
+    taken.  Otherwise FD now belongs to the helper thread, which closes it
+    once its flock call returns; the caller must not use it again.
+    """
+    state = {"acquired": False, "abandoned": False, "error": None}
+    mutex = threading.Lock()
+    done = threading.Event()
+
+    def waiter():
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except Exception as e:
+            state["error"] = e
+        with mutex:
+            if state["abandoned"]:
+                os.close(fd)
+            elif state["error"] is None:
+                state["acquired"] = True
+        done.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.daemon = True
+    thread.start()
+    done.wait(timeout)
+    with mutex:
+        if state["error"] is not None:
+            raise state["error"]
+        if not state["acquired"]:
+            state["abandoned"] = True
+        return state["acquired"]
+
+
+class Lock:
+    """An exclusive lock on PATH.
+
+    TIMEOUT is the default number of seconds to wait for the lock: None
+    waits for ever, and 0 does not wait at all.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def __str__(self):
+        return "lock %s" % self.path
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+    def holder(self):
+        """Return the (PID, boot ID) recorded by the holder, if any."""
+        try:
+            with open(self.path) as lock_file:
+                pid, boot_id = lock_file.read().split()
+            return int(pid), boot_id
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _describe_holder(self):
+        holder = self.holder()
+        if holder is None:
+            return "unknown process"
+        pid, boot_id = holder
+        if boot_id == _boot_id() and osextras.pid_exists(pid):
+            return "pid %d" % pid
+        # flock locks belong to open files, so a child that inherited the
+        # file from a holder that has since died still holds the lock.
+        return "a child of pid %d, which is no longer running" % pid
+
+    def _open(self):
+        osextras.ensuredir(os.path.dirname(self.path))
+        flags = os.O_CREAT | getattr(os, "O_CLOEXEC", 0)
+        try:
+            return os.open(self.path, os.O_RDWR | flags, 0o664)
+        except OSError as e:
+            if e.errno != errno.EACCES:
+                raise
+            # Someone else's lock file; we can still lock it, but not
+            # record ourselves as the holder.
+            return os.open(self.path, os.O_RDONLY | flags)
+
+    def _lock(self, fd, timeout):
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if timeout <= 0:
+            return False
+        return _flock_with_timeout(fd, timeout)
+
+    def acquire(self, timeout=-1):
+        """Take the lock, waiting up to TIMEOUT seconds.
+
+        Raises LockTimeout if the lock could not be taken in time.
+        """
+        assert self.fd is None, "%s is already held" % self
+        if timeout == -1:
+            timeout = self.timeout
+        start = time.time()
+        while True:
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = max(0, timeout - (time.time() - start))
+            fd = self._open()
+            try:
+                locked = self._lock(fd, remaining)
+            except Exception:
+                os.close(fd)
+                raise
+            if not locked:
+                # _lock only fails after handing fd to a waiting thread,
+                # or without waiting at all.
+                if remaining <= 0:
+                    os.close(fd)
+                raise LockTimeout(
+                    "Timed out waiting for %s, held by %s" % (
+                        self, self._describe_holder()))
+            # The previous holder removes the lock file before releasing
+            # the lock, so we may have locked a file that no longer has a
+            # name.  If so, try again with the current file.
+            try:
+                path_stat = os.stat(self.path)
+            except OSError:
+                path_stat = None
+            fd_stat = os.fstat(fd)
+            if (path_stat is not None and
+                    (path_stat.st_dev, path_stat.st_ino) ==
+                    (fd_stat.st_dev, fd_stat.st_ino)):
+                break
+            os.close(fd)
+        try:
+            os.ftruncate(fd, 0)
+            os.write(fd, ("%d %s\n" % (os.getpid(), _boot_id())).encode())
+        except (IOError, OSError):
+            pass
+        self.fd = fd
+        waited = time.time() - start
+        if waited >= LOG_WAIT_THRESHOLD:
+            logger.info("Waited %.0f seconds for %s" % (waited, self))
+
+    def release(self):
+        assert self.fd is not None, "%s is not held" % self
+        osextras.unlink_force(self.path)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, unused_exc_type, unused_exc_value, unused_exc_tb):
+        self.release()
@@ -19,14 +19,17 @@ from __future__ import print_function
 
 import contextlib
 import errno
-import os
-import subprocess
 
 from cdimage import osextras
+from cdimage.locking import Lock, LockError
 
 __metaclass__ = type
 
 
+# How long to wait for the lock, in seconds.
+LOCK_TIMEOUT = 60
+
+
 class MultiPIDFileError(Exception):
     pass
 
@@ -37,22 +40,23 @@ class MultiPIDFile:
     def __init__(self, path):
         self.path = path
         self.lock_path = "%s.lock" % path
+        self.lock = Lock(self.lock_path, timeout=LOCK_TIMEOUT)
 
     def __str__(self):
         return "multipidfile %s" % self.path
 
     def __enter__(self):
-        command = ["lockfile", "-r", "4", self.lock_path]
-        if subprocess.call(command) != 0:
+        try:
+            self.lock.acquire()
+        except LockError:
             raise MultiPIDFileError("Cannot acquire lock on %s!" % self)
 
     def __exit__(self, unused_exc_type, unused_exc_value, unused_exc_tb):
-        osextras.unlink_force(self.lock_path)
+        self.lock.release()
 
     def _read(self):
         # Must be called within context manager lock.
-        assert os.path.exists(self.lock_path), (
-            "Called _read on %s without locking!" % self)
+        assert self.lock.held, "Called _read on %s without locking!" % self
         try:
             with open(self.path) as fd:
                 pids = set(int(line) for line in fd)
@@ -64,8 +68,7 @@ class MultiPIDFile:
 
     def _write(self, pids):
         # Must be called within context manager lock.
-        assert os.path.exists(self.lock_path), (
-            "Called _write on %s without locking!" % self)
+        assert self.lock.held, "Called _write on %s without locking!" % self
         if pids:
             with open(self.path, "w") as fd:
                 for pid in sorted(pids):
@@ -15,16 +15,22 @@
 
 """Extra OS-level utility functions."""
 
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import os
+import select
 try:
     from shlex import quote as shell_quote
 except ImportError:
     from pipes import quote as shell_quote
 import shutil
+import signal
 import subprocess
+import sys
 
-from cdimage.proxy import proxy_call
+__metaclass__ = type
 
 
 def ensuredir(directory):
@@ -70,6 +76,38 @@ def link_force(source, link_name):
     os.link(source, link_name)
 
 
+def write_lines(path, lines, mode="w"):
+    """Write LINES to PATH, each followed by a newline, in a single write."""
+    with open(path, mode) as f:
+        f.write("".join("%s\n" % line for line in lines))
+
+
+def rename_exchange(old, new):
+    """Atomically exchange the paths old and new, which must both exist.
+
+    This uses renameat2(RENAME_EXCHANGE).  If the C library, kernel, or
+    file system does not support that, OSError is raised with errno set to
+    ENOSYS or EINVAL.
+    """
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 1 << 1
+    libc_name = ctypes.util.find_library("c")
+    renameat2 = None
+    if libc_name is not None:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        renameat2 = getattr(libc, "renameat2", None)
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, "renameat2 is not available")
+    encoding = sys.getfilesystemencoding()
+    if not isinstance(old, bytes):
+        old = old.encode(encoding)
+    if not isinstance(new, bytes):
+        new = new.encode(encoding)
+    if renameat2(AT_FDCWD, old, AT_FDCWD, new, RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
 def find_on_path(command):
     """Is command on the executable search path?"""
     if 'PATH' not in os.environ:
@@ -94,6 +132,92 @@ def waitpid_retry(*args):
                 raise
 
 
+class ChildWatcher:
+    """Wait until one of a set of child processes might have exited.
+
+    This uses a pidfd for each child where the kernel and Python support
+    them, and otherwise a SIGCHLD handler that writes to a pipe.  If
+    neither is possible (for instance, outside the main thread), it falls
+    back to polling once a second.
+    """
+
+    def __init__(self):
+        self.pidfds = {}
+        self.wakeup = None
+        self.old_handler = None
+        self.old_wakeup_fd = None
+
+    def _use_sigchld(self):
+        if self.wakeup is not None:
+            return
+        read_fd, write_fd = os.pipe()
+        for fd in read_fd, write_fd:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            self.old_wakeup_fd = signal.set_wakeup_fd(write_fd)
+        except ValueError:
+            os.close(read_fd)
+            os.close(write_fd)
+            return
+        self.old_handler = signal.signal(
+            signal.SIGCHLD, lambda signum, frame: None)
+        self.wakeup = (read_fd, write_fd)
+
+    def add(self, proc):
+        if hasattr(os, "pidfd_open"):
+            try:
+                self.pidfds[proc.pid] = os.pidfd_open(proc.pid)
+                return
+            except OSError:
+                pass
+        self._use_sigchld()
+
+    def remove(self, proc):
+        pidfd = self.pidfds.pop(proc.pid, None)
+        if pidfd is not None:
+            os.close(pidfd)
+
+    def wait(self, timeout=None, fds=()):
+        """Wait until a child exits or TIMEOUT seconds pass.
+
+        If FDS is given, also wait until any of those file descriptors (or
+        objects with a fileno method) are readable, and return the ones
+        that are.
+        """
+        extra_fds = list(fds)
+        wait_fds = extra_fds + list(self.pidfds.values())
+        if self.wakeup is not None:
+            wait_fds.append(self.wakeup[0])
+        elif not self.pidfds:
+            timeout = 1 if timeout is None else min(timeout, 1)
+        try:
+            readable = select.select(wait_fds, [], [], timeout)[0]
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if self.wakeup is not None:
+            try:
+                while os.read(self.wakeup[0], 4096):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        return [fd for fd in extra_fds if fd in readable]
+
+    def close(self):
+        for pidfd in self.pidfds.values():
+            os.close(pidfd)
+        self.pidfds = {}
+        if self.wakeup is not None:
+            signal.signal(signal.SIGCHLD, self.old_handler)
+            signal.set_wakeup_fd(self.old_wakeup_fd)
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+
+
 class FetchError(Exception):
     """An attempt to fetch a file from a remote system failed."""
 
@@ -103,28 +227,8 @@ def fetch(config, source, target):
     if not source:
         raise FetchError("empty source URL (downloading to %s)" % target)
 
-    if source.startswith("/"):
-        os.link(source, target)
-        return
-
-    # Match lazr.restfulclient, for convenience when working with
-    # development instances of Launchpad.
-    no_check_certificate = bool(
-        os.environ.get('LP_DISABLE_SSL_CERTIFICATE_VALIDATION', False))
-
-    # This should arguably use urllib2/urllib.request or similar instead.
-    command = ["wget", "-nv"]
-    if no_check_certificate:
-        command.append("--no-check-certificate")
-    command.extend([source, "-O", target])
-    ret = proxy_call(config, "fetch", command)
-    if ret != 0:
-        unlink_force(target)
-        command_str = "wget -nv"
-        if no_check_certificate:
-            command_str += " --no-check-certificate"
-        command_str += " '%s' -O '%s'" % (source, target)
-        raise FetchError("%s returned %d" % (command_str, ret))
+    from cdimage.transport import resolve_transport
+    resolve_transport(config, source, target).fetch(source, target)
 
 
 def _read_nullsep_output(command):
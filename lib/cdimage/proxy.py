@@ -58,3 +58,19 @@ def proxy_call(config, call_site, *args, **kwargs):
 def proxy_check_call(config, call_site, *args, **kwargs):
     _set_preexec_fn(config, call_site, kwargs)
     subprocess.check_call(*args, **kwargs)
+
+
+def proxy_check_output(config, call_site, *args, **kwargs):
+    _set_preexec_fn(config, call_site, kwargs)
+    return subprocess.check_output(*args, **kwargs)
+
+
+def proxy_env(config, call_site, env):
+    """Return a copy of the environment ENV with the proxy for CALL_SITE."""
+    env = dict(env)
+    http_proxy = _select_proxy(config, call_site)
+    if http_proxy == "unset":
+        env.pop("http_proxy", None)
+    elif http_proxy is not None:
+        env["http_proxy"] = http_proxy
+    return env
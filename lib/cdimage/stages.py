@@ -0,0 +1,182 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run the stages of an image build, concurrently where possible."""
+
+from collections import OrderedDict
+import os
+import signal
+import threading
+import time
+
+__metaclass__ = type
+
+
+# How long to wait for stages to finish once they have been stopped, in
+# seconds.
+STOP_TIMEOUT = 30
+
+
+class Stage:
+    def __init__(self, name, function, requires, main_thread=False):
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.main_thread = main_thread
+
+
+class StageGraph:
+    """A set of build stages and the dependencies between them.
+
+    Stages must be added after the stages they require, so the order in
+    which they are added is always a valid order in which to run them.
+    Requirements naming stages that were never added are ignored, which
+    makes it easy to leave out stages that are not needed for a build.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.timings = OrderedDict()
+
+    def add(self, name, function, requires=(), main_thread=False):
+        """Add a stage.
+
+        Stages added with MAIN_THREAD=True always run in the thread that
+        calls run(), for example because they rely on receiving signals.
+        """
+        assert name not in self.stages, "Duplicate stage %s" % name
+        self.stages[name] = Stage(
+            name, function,
+            [required for required in requires if required in self.stages],
+            main_thread=main_thread)
+
+    def _run_stage(self, stage):
+        start = time.time()
+        try:
+            stage.function()
+        finally:
+            self.timings[stage.name] = time.time() - start
+
+    def run(self, jobs=1):
+        """Run all stages, each as soon as its requirements have finished.
+
+        At most JOBS stages run at once.  If a stage fails, or run() is
+        interrupted (for instance by a signal), no further stages are
+        started and the running stages are stopped; the exception from the
+        first stage to fail, or the interruption, is then raised.
+        """
+        if jobs <= 1:
+            for stage in self.stages.values():
+                self._run_stage(stage)
+            return
+
+        pending = list(self.stages.values())
+        finished = set()
+        running = set()
+        errors = []
+        threads = []
+        condition = threading.Condition()
+
+        def run_stage(stage):
+            try:
+                self._run_stage(stage)
+            except Exception as e:
+                with condition:
+                    errors.append(e)
+            finally:
+                with condition:
+                    running.discard(stage.name)
+                    finished.add(stage.name)
+                    condition.notify_all()
+
+        try:
+            with condition:
+                while not errors:
+                    main_stage = None
+                    for stage in list(pending):
+                        if len(running) >= jobs:
+                            break
+                        if not all(
+                                name in finished for name in stage.requires):
+                            continue
+                        if stage.main_thread and main_stage is not None:
+                            continue
+                        pending.remove(stage)
+                        running.add(stage.name)
+                        if stage.main_thread:
+                            # This blocks the loop, so it runs once the
+                            # other ready stages have started.
+                            main_stage = stage
+                            continue
+                        thread = threading.Thread(
+                            target=run_stage, args=(stage,))
+                        # Stopped stages are abandoned rather than waited
+                        # for; see _stop.
+                        thread.daemon = True
+                        threads.append(thread)
+                        thread.start()
+                    if main_stage is not None:
+                        condition.release()
+                        try:
+                            run_stage(main_stage)
+                        finally:
+                            condition.acquire()
+                        continue
+                    if not running:
+                        break
+                    condition.wait()
+        except BaseException:
+            _stop(threads)
+            raise
+
+        if errors:
+            _stop(threads)
+            raise errors[0]
+
+
+def _terminate_children():
+    """Send SIGTERM to each child process of this process."""
+    pid = os.getpid()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", entry, "stat")) as stat:
+                # The command name is in parentheses and may contain
+                # spaces; the parent PID is the second field after it.
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if int(fields[1]) != pid:
+            continue
+        try:
+            os.kill(int(entry), signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def _stop(threads):
+    """Stop running stages.
+
+    Stages spend most of their time waiting for subprocesses, so those are
+    terminated.  Stages still running STOP_TIMEOUT seconds later are
+    abandoned; their threads are daemon threads, so they do not keep the
+    process alive.
+    """
+    if not any(thread.is_alive() for thread in threads):
+        return
+    _terminate_children()
+    deadline = time.time() + STOP_TIMEOUT
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
@@ -83,7 +83,7 @@ class TestCase(unittest.TestCase):
     def assertLogEqual(self, expected):
         self.assertEqual(expected, self.captured_log_messages())
 
-    def make_deb(self, path, section, priority, files={}):
+    def make_deb(self, path, section, priority, files={}, symlinks={}):
         osextras.ensuredir(os.path.dirname(path))
         build_dir = os.path.join(self.temp_dir, "make_deb")
         try:
@@ -106,6 +106,11 @@ class TestCase(unittest.TestCase):
                     build_dir, os.path.relpath(file_path, "/"))
                 with mkfile(rel_path, mode="wb") as fp:
                     fp.write(file_contents)
+            for link_path, link_target in symlinks.items():
+                rel_path = os.path.join(
+                    build_dir, os.path.relpath(link_path, "/"))
+                osextras.ensuredir(os.path.dirname(rel_path))
+                os.symlink(link_target, rel_path)
             with open("/dev/null", "w") as devnull:
                 subprocess.check_call(
                     ["dpkg-deb", "-b", build_dir, path], stdout=devnull)
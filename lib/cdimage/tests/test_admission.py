@@ -0,0 +1,151 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.admission."""
+
+import os
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.admission import (
+    AdmissionController,
+    admission_controller,
+    build_weight,
+)
+from cdimage.config import Config
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+class TestAdmissionController(TestCase):
+    def setUp(self):
+        super(TestAdmissionController, self).setUp()
+        self.use_temp_dir()
+        self.controller = AdmissionController(
+            os.path.join(self.temp_dir, ".build-slots"), 3)
+        patcher = mock.patch(
+            "cdimage.osextras.pid_exists", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_admit_within_slots(self):
+        self.controller.enqueue(1, weight=1)
+        self.controller.enqueue(2, weight=2)
+        self.assertTrue(self.controller.try_admit(1))
+        self.assertTrue(self.controller.try_admit(2))
+        running, queued = self.controller.status()
+        self.assertEqual([1, 2], [entry.pid for entry in running])
+        self.assertEqual([], queued)
+
+    def test_weight_limit(self):
+        self.controller.enqueue(1, weight=2)
+        self.controller.enqueue(2, weight=2)
+        self.assertTrue(self.controller.try_admit(1))
+        self.assertFalse(self.controller.try_admit(2))
+        self.controller.release(1)
+        self.assertTrue(self.controller.try_admit(2))
+
+    def test_oversized_runs_alone(self):
+        self.controller.enqueue(1, weight=5)
+        self.assertTrue(self.controller.try_admit(1))
+
+    def test_fifo(self):
+        self.controller.enqueue(1, weight=3)
+        self.controller.enqueue(2, weight=2)
+        self.controller.enqueue(3, weight=1)
+        self.assertTrue(self.controller.try_admit(1))
+        self.assertFalse(self.controller.try_admit(2))
+        # 3 would fit alongside nothing else, but 2 is ahead of it.
+        self.controller.release(1)
+        self.assertFalse(self.controller.try_admit(3))
+        self.assertTrue(self.controller.try_admit(2))
+        self.assertTrue(self.controller.try_admit(3))
+
+    def test_priority(self):
+        self.controller.enqueue(1, weight=3)
+        self.assertTrue(self.controller.try_admit(1))
+        self.controller.enqueue(2, description="low")
+        self.controller.enqueue(3, priority=10, description="high")
+        running, queued = self.controller.status()
+        self.assertEqual(
+            ["high", "low"], [entry.description for entry in queued])
+        self.controller.release(1)
+        self.assertFalse(self.controller.try_admit(2))
+        self.assertTrue(self.controller.try_admit(3))
+
+    def test_dead_processes_dropped(self):
+        self.controller.enqueue(1, weight=3)
+        self.assertTrue(self.controller.try_admit(1))
+        self.controller.enqueue(2)
+        with mock.patch(
+                "cdimage.osextras.pid_exists",
+                side_effect=lambda pid: pid != 1):
+            self.assertTrue(self.controller.try_admit(2))
+
+    def test_malformed_lines_ignored(self):
+        self.capture_logging()
+        self.controller.enqueue(1)
+        with open(self.controller.path, "a") as slots:
+            slots.write("garbage\n")
+            slots.write("2\tx\t1\t0\tqueued\tbad ticket\n")
+        self.assertTrue(self.controller.try_admit(1))
+        running, queued = self.controller.status()
+        self.assertEqual([1], [entry.pid for entry in running])
+        self.assertEqual([], queued)
+        self.assertIn(
+            "Ignoring malformed line in %s: 'garbage\\n'" %
+            self.controller.path,
+            self.captured_log_messages())
+
+    @mock.patch("time.sleep")
+    def test_held(self, mock_sleep):
+        self.controller.enqueue(1, weight=3)
+        self.assertTrue(self.controller.try_admit(1))
+        on_wait = mock.Mock()
+        mock_sleep.side_effect = lambda seconds: self.controller.release(1)
+        with self.controller.held(2, description="dvd", on_wait=on_wait):
+            running, _ = self.controller.status()
+            self.assertEqual(
+                ["dvd"], [entry.description for entry in running])
+        on_wait.assert_called_once_with()
+        self.assertEqual(1, mock_sleep.call_count)
+        self.assertEqual(([], []), self.controller.status())
+        self.assertFalse(os.path.exists(self.controller.path))
+
+
+class TestAdmissionConfig(TestCase):
+    def setUp(self):
+        super(TestAdmissionConfig, self).setUp()
+        self.config = Config(read=False)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(admission_controller(self.config))
+
+    def test_slots(self):
+        self.config["CDIMAGE_BUILD_SLOTS"] = "4"
+        self.assertEqual(4, admission_controller(self.config).slots)
+
+    def test_weights(self):
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.assertEqual(1, build_weight(self.config))
+        self.config["IMAGE_TYPE"] = "dvd"
+        self.assertEqual(2, build_weight(self.config))
+        self.config["CDIMAGE_BUILD_WEIGHT"] = "3"
+        self.assertEqual(3, build_weight(self.config))
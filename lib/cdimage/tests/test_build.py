@@ -28,6 +28,7 @@ import stat
 import subprocess
 import sys
 from textwrap import dedent
+import threading
 import time
 import traceback
 
@@ -62,6 +63,8 @@ from cdimage.build import (
     want_live_builds,
 )
 from cdimage.config import Config, Touch
+from cdimage.debfile import read_control, read_data_file
+from cdimage.locking import Lock, LockError
 from cdimage.log import logger
 from cdimage.mail import text_file_type
 from cdimage.tests.helpers import TestCase, mkfile, touch
@@ -159,6 +162,35 @@ class TestUpdateLocalIndices(TestCase):
             self.packages, "dists", "trusty", "local", "debian-installer",
             "binary-i386")))
 
+    def test_reads_each_package_once(self):
+        self.config["CPUARCHES"] = "amd64 i386"
+        fake_dir = os.path.join(self.pool, "f", "fake")
+        self.make_deb(
+            os.path.join(fake_dir, "fake_1_amd64.deb"), "misc", "optional")
+        self.make_deb(
+            os.path.join(fake_dir, "fake-indep_1_all.deb"), "misc", "extra")
+        # Packages for other architectures are not read.
+        self.make_deb(
+            os.path.join(fake_dir, "fake_1_arm64.deb"), "misc", "optional")
+
+        with mock.patch("subprocess.call", return_value=0), \
+                mock.patch(
+                    "cdimage.debfile.read_control",
+                    wraps=read_control) as mock_read_control:
+            update_local_indices(self.config)
+            self.assertEqual(2, mock_read_control.call_count)
+            update_local_indices(self.config)
+            self.assertEqual(2, mock_read_control.call_count)
+
+        for arch, expected in (
+            ("amd64", ["fake\toptional\tlocal/misc",
+                       "fake-indep\textra\tlocal/misc"]),
+            ("i386", ["fake-indep\textra\tlocal/misc"]),
+        ):
+            with open(os.path.join(
+                    self.indices, "override.trusty.local.%s" % arch)) as f:
+                self.assertCountEqual(expected, f.read().splitlines())
+
 
 class TestBuildUbuntuDefaultsLocale(TestCase):
     def setUp(self):
@@ -444,7 +476,7 @@ class TestExtractDebootstrap(TestCase):
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "trusty"
         self.config["IMAGE_TYPE"] = "daily"
-        self.config["ARCHES"] = "amd64+mac"
+        self.config["ARCHES"] = "amd64 amd64+mac"
         mirror_dir = os.path.join(self.temp_dir, "ftp")
         packages_path = os.path.join(
             mirror_dir, "dists", "trusty", "main", "debian-installer",
@@ -452,24 +484,50 @@ class TestExtractDebootstrap(TestCase):
         udeb_path = os.path.join(
             mirror_dir, "pool", "main", "d", "debootstrap",
             "debootstrap-udeb_1_all.udeb")
+        # Series scripts are usually symlinks to an older series' script.
         self.make_deb(
             udeb_path, "debian-installer", "extra",
-            files={"/usr/share/debootstrap/scripts/trusty": b"sentinel"})
+            files={"/usr/share/debootstrap/scripts/gutsy": b"sentinel"},
+            symlinks={"/usr/share/debootstrap/scripts/trusty": "gutsy"})
         os.makedirs(os.path.dirname(packages_path))
         with gzip.GzipFile(packages_path, "wb") as packages:
-            ftparchive = subprocess.Popen(
-                ["apt-ftparchive", "packages", "pool"],
-                stdout=subprocess.PIPE, cwd=mirror_dir)
-            data, _ = ftparchive.communicate()
-            packages.write(data)
-            self.assertEqual(0, ftparchive.returncode)
-        extract_debootstrap(self.config)
-        output_path = os.path.join(
+            packages.write(dedent("""\
+                Package: anna
+                Filename: pool/main/a/anna/anna_1_amd64.udeb
+
+                Package: debootstrap-udeb
+                Filename: pool/main/d/debootstrap/debootstrap-udeb_1_all.udeb
+                """).encode())
+        with mock.patch(
+                "cdimage.build.read_data_file",
+                wraps=read_data_file) as mock_read_data_file:
+            extract_debootstrap(self.config)
+        self.assertEqual(1, mock_read_data_file.call_count)
+        for fullarch in "amd64", "amd64+mac":
+            output_path = os.path.join(
+                self.temp_dir, "scratch", "ubuntu", "trusty", "daily",
+                "debootstrap", "trusty-%s" % fullarch)
+            self.assertTrue(os.path.exists(output_path))
+            with open(output_path, "rb") as output:
+                self.assertEqual(b"sentinel", output.read())
+        self.assertFalse(os.path.exists(os.path.join(
             self.temp_dir, "scratch", "ubuntu", "trusty", "daily",
-            "debootstrap", "trusty-amd64+mac")
-        self.assertTrue(os.path.exists(output_path))
-        with open(output_path, "rb") as output:
-            self.assertEqual(b"sentinel", output.read())
+            "debootstrap", "unpack-amd64")))
+
+    def test_extract_debootstrap_missing(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["ARCHES"] = "i386"
+        packages_path = os.path.join(
+            self.temp_dir, "ftp", "dists", "trusty", "main",
+            "debian-installer", "binary-i386", "Packages.gz")
+        osextras.ensuredir(os.path.dirname(packages_path))
+        with gzip.GzipFile(packages_path, "wb") as packages:
+            packages.write(b"Package: anna\n")
+        self.capture_logging()
+        extract_debootstrap(self.config)
+        self.assertLogEqual(["No debootstrap-udeb for trusty/i386!"])
 
 
 class TestBuildImageSet(TestCase):
@@ -484,9 +542,7 @@ class TestBuildImageSet(TestCase):
         self.addCleanup(mock_gmtime.stop)
         self.epoch_date = "Thu Jan  1 00:00:00 UTC 1970"
 
-    @mock.patch("subprocess.check_call")
-    @mock.patch("cdimage.osextras.unlink_force")
-    def test_lock_build_image_set(self, mock_unlink_force, mock_check_call):
+    def test_lock_build_image_set(self):
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "trusty"
         self.config["IMAGE_TYPE"] = "daily"
@@ -494,15 +550,10 @@ class TestBuildImageSet(TestCase):
             self.temp_dir, "etc", ".lock-build-image-set-ubuntu-trusty-daily")
         self.assertFalse(os.path.exists(expected_lock_path))
         with lock_build_image_set(self.config):
-            mock_check_call.assert_called_once_with([
-                "lockfile", "-l", "7200", "-r", "0", expected_lock_path])
-            self.assertEqual(0, mock_unlink_force.call_count)
-        mock_unlink_force.assert_called_once_with(expected_lock_path)
+            self.assertTrue(os.path.exists(expected_lock_path))
+        self.assertFalse(os.path.exists(expected_lock_path))
 
-    @mock.patch("subprocess.check_call")
-    @mock.patch("cdimage.osextras.unlink_force")
-    def test_lock_build_image_set_chinese(self, mock_unlink_force,
-                                          mock_check_call):
+    def test_lock_build_image_set_chinese(self):
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "trusty"
         self.config["IMAGE_TYPE"] = "daily"
@@ -512,10 +563,21 @@ class TestBuildImageSet(TestCase):
             ".lock-build-image-set-ubuntu-chinese-edition-trusty-daily")
         self.assertFalse(os.path.exists(expected_lock_path))
         with lock_build_image_set(self.config):
-            mock_check_call.assert_called_once_with([
-                "lockfile", "-l", "7200", "-r", "0", expected_lock_path])
-            self.assertEqual(0, mock_unlink_force.call_count)
-        mock_unlink_force.assert_called_once_with(expected_lock_path)
+            self.assertTrue(os.path.exists(expected_lock_path))
+        self.assertFalse(os.path.exists(expected_lock_path))
+
+    def test_lock_build_image_set_already_held(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.capture_logging()
+        with Lock(os.path.join(
+                self.temp_dir, "etc",
+                ".lock-build-image-set-ubuntu-trusty-daily")):
+            with self.assertRaises(LockError):
+                with lock_build_image_set(self.config):
+                    pass
+        self.assertLogEqual(["Another image set is already building!"])
 
     def test_configure_onlyfree_unsupported(self):
         for project, series, onlyfree, unsupported in (
@@ -678,10 +740,9 @@ class TestBuildImageSet(TestCase):
     @mock.patch("subprocess.call")
     def test_anonftpsync(self, mock_call, *args):
         def call_side_effect(command, *args, **kwargs):
-            if command[0] == "lockfile":
-                return 1
-            else:
-                return 0
+            if command[0] == "rsync":
+                self.assertTrue(os.path.exists(lock))
+            return 0
 
         mock_call.side_effect = call_side_effect
         path = os.path.join(self.temp_dir, "etc", "anonftpsync")
@@ -699,7 +760,7 @@ class TestBuildImageSet(TestCase):
         trace = os.path.join(target, "project", "trace", "cdimage.example.org")
         log = os.path.join(self.temp_dir, "log", "rsync.log")
         anonftpsync(self.config)
-        self.assertEqual(5, mock_call.call_count)
+        self.assertEqual(4, mock_call.call_count)
         expected_rsync_base = [
             "rsync", "--recursive", "--links", "--hard-links", "--times",
             "--verbose", "--stats", "--chmod=Dg+s,g+rwX",
@@ -707,7 +768,6 @@ class TestBuildImageSet(TestCase):
             "--exclude", "project/trace/cdimage.example.org",
         ]
         mock_call.assert_has_calls([
-            mock.call(["lockfile", "-!", "-l", "43200", "-r", "0", lock]),
             mock.call(expected_rsync_base + [
                 "--exclude", "Packages*", "--exclude", "Sources*",
                 "--exclude", "Release*", "--exclude", "InRelease",
@@ -724,9 +784,9 @@ class TestBuildImageSet(TestCase):
             mock.call(["savelog", log], stdout=mock.ANY, stderr=mock.ANY),
         ])
         self.assertEqual(
-            "secret", mock_call.call_args_list[1][1]["env"]["RSYNC_PASSWORD"])
+            "secret", mock_call.call_args_list[0][1]["env"]["RSYNC_PASSWORD"])
         self.assertEqual(
-            "secret", mock_call.call_args_list[2][1]["env"]["RSYNC_PASSWORD"])
+            "secret", mock_call.call_args_list[1][1]["env"]["RSYNC_PASSWORD"])
         self.assertFalse(os.path.exists(lock))
         self.assertTrue(os.path.exists(trace))
         self.assertTrue(os.path.exists(log))
@@ -736,31 +796,36 @@ class TestBuildImageSet(TestCase):
         self.assertFalse(
             os.path.lexists(os.path.join(target, "dir", "broken-link")))
 
-    def check_call_make_sync_lock(self, mock_check_call, *args, **kwargs):
-        if mock_check_call.call_count == 1:
-            self.assertEqual("lockfile", args[0][0])
-            touch(self.expected_sync_lock)
+    @mock.patch("socket.getfqdn", return_value="cdimage.example.org")
+    @mock.patch("subprocess.call")
+    def test_anonftpsync_lock_held(self, mock_call, *args):
+        with mkfile(os.path.join(self.temp_dir, "etc", "anonftpsync")) as f:
+            print("RSYNC_SRC=rsync.example.org::ubuntu", file=f)
+        lock = os.path.join(
+            self.temp_dir, "ftp",
+            "Archive-Update-in-Progress-cdimage.example.org")
+        with Lock(lock):
+            self.assertRaisesRegex(
+                Exception, "unable to start rsync; lock file exists",
+                anonftpsync, self.config)
+        self.assertEqual(0, mock_call.call_count)
 
     def anonftpsync_sync_lock_exists(self, *args, **kwargs):
         self.assertTrue(os.path.exists(self.expected_sync_lock))
 
-    @mock.patch("subprocess.check_call")
     @mock.patch("cdimage.build.anonftpsync")
-    def test_config_nosync(self, mock_anonftpsync, mock_check_call):
+    def test_config_nosync(self, mock_anonftpsync):
         self.config["CAPPROJECT"] = "Ubuntu"
         self.config["CDIMAGE_NOSYNC"] = "1"
         self.capture_logging()
         sync_local_mirror(self.config, 0)
         self.assertLogEqual([])
-        self.assertEqual(0, mock_check_call.call_count)
         self.assertEqual(0, mock_anonftpsync.call_count)
+        self.assertFalse(os.path.exists(self.expected_sync_lock))
 
-    @mock.patch("subprocess.check_call")
     @mock.patch("cdimage.build.anonftpsync")
-    def test_sync(self, mock_anonftpsync, mock_check_call):
+    def test_sync(self, mock_anonftpsync):
         self.config["CAPPROJECT"] = "Ubuntu"
-        mock_check_call.side_effect = partial(
-            self.check_call_make_sync_lock, mock_check_call)
         mock_anonftpsync.side_effect = self.anonftpsync_sync_lock_exists
         self.capture_logging()
         sync_local_mirror(self.config, 0)
@@ -768,58 +833,57 @@ class TestBuildImageSet(TestCase):
             "===== Syncing Ubuntu mirror =====",
             self.epoch_date,
         ])
-        mock_check_call.assert_called_once_with(
-            ["lockfile", "-r", "4", self.expected_sync_lock])
         mock_anonftpsync.assert_called_once_with(self.config)
         self.assertFalse(os.path.exists(self.expected_sync_lock))
 
-    @mock.patch("subprocess.check_call")
+    @mock.patch("cdimage.build.SYNC_LOCK_TIMEOUT", 0)
     @mock.patch("cdimage.build.anonftpsync")
-    def test_sync_lock_failure(self, mock_anonftpsync, mock_check_call):
+    def test_sync_lock_failure(self, mock_anonftpsync):
         self.config["CAPPROJECT"] = "Ubuntu"
-        mock_check_call.side_effect = subprocess.CalledProcessError(1, "")
         self.capture_logging()
-        self.assertRaises(
-            subprocess.CalledProcessError, sync_local_mirror, self.config, 0)
+        with Lock(self.expected_sync_lock):
+            self.assertRaises(
+                LockError, sync_local_mirror, self.config, 0)
         self.assertLogEqual([
             "===== Syncing Ubuntu mirror =====",
             self.epoch_date,
             "Couldn't acquire archive sync lock!"
         ])
-        mock_check_call.assert_called_once_with(
-            ["lockfile", "-r", "4", self.expected_sync_lock])
         self.assertEqual(0, mock_anonftpsync.call_count)
         self.assertFalse(os.path.exists(self.expected_sync_lock))
 
-    @mock.patch("subprocess.check_call")
-    def test_parallel(self, mock_check_call):
+    def test_parallel(self):
         self.config["CAPPROJECT"] = "Ubuntu"
-        mock_check_call.side_effect = partial(
-            self.check_call_make_sync_lock, mock_check_call)
         self.capture_logging()
         sync_local_mirror(self.config, 1)
         self.assertLogEqual([
             "===== Parallel build; waiting for Ubuntu mirror to sync =====",
             self.epoch_date,
         ])
-        mock_check_call.assert_called_once_with(
-            ["lockfile", "-8", "-r", "450", self.expected_sync_lock])
         self.assertFalse(os.path.exists(self.expected_sync_lock))
 
-    @mock.patch("subprocess.check_call")
-    def test_parallel_lock_failure(self, mock_check_call):
+    def test_parallel_waits_for_sync(self):
+        self.config["CAPPROJECT"] = "Ubuntu"
+        lock = Lock(self.expected_sync_lock)
+        lock.acquire()
+        timer = threading.Timer(0.1, lock.release)
+        timer.start()
+        self.addCleanup(timer.join)
+        sync_local_mirror(self.config, 1)
+        self.assertFalse(lock.held)
+        self.assertFalse(os.path.exists(self.expected_sync_lock))
+
+    @mock.patch("cdimage.build.SYNC_WAIT_TIMEOUT", 0)
+    def test_parallel_lock_failure(self):
         self.config["CAPPROJECT"] = "Ubuntu"
-        mock_check_call.side_effect = subprocess.CalledProcessError(1, "")
         self.capture_logging()
-        self.assertRaises(
-            subprocess.CalledProcessError, sync_local_mirror, self.config, 1)
+        with Lock(self.expected_sync_lock):
+            self.assertRaises(LockError, sync_local_mirror, self.config, 1)
         self.assertLogEqual([
             "===== Parallel build; waiting for Ubuntu mirror to sync =====",
             self.epoch_date,
             "Timed out waiting for archive sync lock!"
         ])
-        mock_check_call.assert_called_once_with(
-            ["lockfile", "-8", "-r", "450", self.expected_sync_lock])
         self.assertFalse(os.path.exists(self.expected_sync_lock))
 
     @mock.patch("subprocess.check_call")
@@ -1059,6 +1123,8 @@ class TestBuildImageSet(TestCase):
                     "Traceback (most recent call last):\n", log.readline())
                 self.assertIn("Exception: Artificial exception", log.read())
 
+    @mock.patch(
+        "cdimage.germinate.Germination.seed_revisions", return_value=None)
     @mock.patch("subprocess.call", return_value=0)
     @mock.patch("cdimage.build.tracker_set_rebuild_status")
     @mock.patch("cdimage.build.anonftpsync")
@@ -1070,13 +1136,18 @@ class TestBuildImageSet(TestCase):
     def test_build_image_set_locked(
             self, mock_purge, mock_publish, mock_update_tasks,
             mock_write_tasks, mock_extract_debootstrap, mock_anonftpsync,
-            mock_tracker_set_rebuild_status, mock_call):
+            mock_tracker_set_rebuild_status, mock_call,
+            mock_seed_revisions):
         self.config["PROJECT"] = "ubuntu"
         self.config["CAPPROJECT"] = "Ubuntu"
         self.config["DIST"] = "trusty"
         self.config["IMAGE_TYPE"] = "daily"
         self.config["ARCHES"] = "amd64 i386"
         self.config["CPUARCHES"] = "amd64 i386"
+        # Run stages and germinate one at a time so that the log is in a
+        # stable order.
+        self.config["CDIMAGE_STAGE_JOBS"] = "1"
+        self.config["CDIMAGE_GERMINATE_JOBS"] = "1"
 
         britney_makefile = os.path.join(
             self.temp_dir, "britney", "update_out", "Makefile")
@@ -1181,6 +1252,14 @@ class TestBuildImageSet(TestCase):
                     ===== Finished =====
                     DATE
                     """.replace("DATE", self.epoch_date)), log.read())
+            timings_path = os.path.join(
+                self.temp_dir, "scratch", "ubuntu", "trusty", "daily",
+                "stage-timings")
+            with open(timings_path) as timings:
+                self.assertEqual(
+                    ["live-builds", "sync-mirror", "britney", "limit-arches",
+                     "debootstrap", "germinate", "debian-cd"],
+                    [line.split("\t")[0] for line in timings])
 
     @mock.patch(
         "cdimage.build.build_image_set_locked", side_effect=KeyboardInterrupt)
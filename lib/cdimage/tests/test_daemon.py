@@ -0,0 +1,205 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.daemon."""
+
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+from unittest import skipUnless
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.daemon import (
+    Daemon,
+    DaemonError,
+    DaemonUnavailable,
+    fd_passing_available,
+    submit,
+)
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class TestDaemon(TestCase):
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+        self.use_temp_dir()
+        self.capture_logging()
+        self.env = {"PATH": os.environ.get("PATH", os.defpath)}
+
+    def step_until(self, predicate, daemon):
+        start = time.time()
+        while not predicate():
+            self.assertLess(time.time() - start, 10)
+            daemon.step(timeout=0.1)
+
+    def submit_in_thread(self, socket_path, project, command, fds=None):
+        result = {}
+
+        def client():
+            try:
+                result["status"] = submit(
+                    socket_path, project, command, env=self.env, fds=fds)
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        return thread, result
+
+    def test_spool(self):
+        spool = os.path.join(self.temp_dir, "spool")
+        daemon = Daemon(spool_dir=spool)
+        self.addCleanup(daemon.close)
+        for name, command in ("good", ["true"]), ("bad", ["false"]):
+            with mkfile(os.path.join(spool, "%s.json" % name)) as request:
+                json.dump({
+                    "project": "ubuntu", "command": command,
+                    "env": self.env}, request)
+        self.step_until(
+            lambda: sorted(os.listdir(spool)) == [
+                "bad.json.failed", "good.json.done"],
+            daemon)
+        self.assertEqual({}, daemon.workers)
+
+    def test_spool_invalid_request(self):
+        spool = os.path.join(self.temp_dir, "spool")
+        daemon = Daemon(spool_dir=spool)
+        self.addCleanup(daemon.close)
+        with mkfile(os.path.join(spool, "broken.json")) as request:
+            request.write("not JSON")
+        daemon.step(timeout=0)
+        self.assertEqual(["broken.json.failed"], os.listdir(spool))
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_socket(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        thread, result = self.submit_in_thread(
+            socket_path, "ubuntu", ["sh", "-c", "exit 3"])
+        self.step_until(lambda: not thread.is_alive(), daemon)
+        thread.join()
+        self.assertEqual({"status": 3}, result)
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_socket_unknown_project(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        thread, result = self.submit_in_thread(
+            socket_path, "nonexistent", ["true"])
+        self.step_until(lambda: not thread.is_alive(), daemon)
+        thread.join()
+        self.assertEqual({"status": 1}, result)
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_runs_bin_scripts_in_process(self):
+        bin_dir = os.path.join(self.temp_dir, "bin")
+        script = os.path.join(bin_dir, "cron.test")
+        marker = os.path.join(self.temp_dir, "marker")
+        with mkfile(script) as f:
+            print("import sys", file=f)
+            print("with open(%r, 'w') as marker:" % marker, file=f)
+            print(
+                "    print('cdimage.daemon' in sys.modules, sys.argv[1:],"
+                " file=marker)", file=f)
+            print("sys.exit(4)", file=f)
+        os.chmod(script, 0o755)
+        self.env["PATH"] = bin_dir
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        with mock.patch("cdimage.daemon.bin_dir", bin_dir):
+            thread, result = self.submit_in_thread(
+                socket_path, "ubuntu", ["cron.test", "--live"])
+            self.step_until(lambda: not thread.is_alive(), daemon)
+        thread.join()
+        self.assertEqual({"status": 4}, result)
+        with open(marker) as f:
+            self.assertEqual("True ['--live']", f.read().strip())
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_submit_error(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        with mock.patch(
+                "cdimage.daemon.Daemon._start",
+                side_effect=Exception("no workers")):
+            thread, result = self.submit_in_thread(
+                socket_path, "ubuntu", ["true"])
+            self.step_until(lambda: not thread.is_alive(), daemon)
+        thread.join()
+        self.assertIsInstance(result["error"], DaemonError)
+        self.assertEqual("no workers", str(result["error"]))
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_socket_client_fds(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        input_path = os.path.join(self.temp_dir, "input")
+        output_path = os.path.join(self.temp_dir, "output")
+        with mkfile(input_path) as f:
+            print("input", file=f)
+        with open(input_path) as stdin, open(output_path, "w") as stdout:
+            thread, result = self.submit_in_thread(
+                socket_path, "ubuntu",
+                ["sh", "-c", "cat; echo output; echo error >&2"],
+                fds={0: stdin.fileno(), 1: stdout.fileno(),
+                     2: stdout.fileno()})
+            self.step_until(lambda: not thread.is_alive(), daemon)
+            thread.join()
+        self.assertEqual({"status": 0}, result)
+        with open(output_path) as f:
+            self.assertEqual("input\noutput\nerror\n", f.read())
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_socket_mode(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        self.assertEqual(0, os.stat(socket_path).st_mode & 0o077)
+
+    @skipUnless(fd_passing_available, "requires sendmsg and recvmsg")
+    def test_socket_other_user(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        daemon = Daemon(socket_path=socket_path)
+        self.addCleanup(daemon.close)
+        with mock.patch("cdimage.daemon._peer_uid", return_value=12345):
+            thread, result = self.submit_in_thread(
+                socket_path, "ubuntu", ["true"])
+            self.step_until(lambda: not thread.is_alive(), daemon)
+        thread.join()
+        self.assertIsInstance(result["error"], DaemonError)
+        self.assertEqual(
+            "Refusing request from uid 12345", str(result["error"]))
+        self.assertEqual({}, daemon.workers)
+
+    def test_submit_unavailable(self):
+        socket_path = os.path.join(self.temp_dir, "cdimaged.sock")
+        self.assertRaises(
+            DaemonUnavailable, submit, socket_path, "ubuntu", ["true"],
+            env=self.env)
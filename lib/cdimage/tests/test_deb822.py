@@ -0,0 +1,69 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.deb822."""
+
+import gzip
+import os
+
+from cdimage.deb822 import iter_paragraphs, read_index
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+INDEX = b"""\
+Package: hello
+Version: 2.10-1
+Description: example package
+ This is an example.
+ .
+ It has several lines.
+
+Package: coreutils
+Essential: yes
+
+
+Package: bash
+"""
+
+
+class TestDeb822(TestCase):
+    def test_iter_paragraphs(self):
+        self.assertEqual([
+            {
+                "Package": "hello",
+                "Version": "2.10-1",
+                "Description": (
+                    "example package\n This is an example.\n .\n"
+                    " It has several lines."),
+            },
+            {"Package": "coreutils", "Essential": "yes"},
+            {"Package": "bash"},
+        ], list(iter_paragraphs(INDEX.splitlines(True))))
+
+    def test_read_index(self):
+        self.use_temp_dir()
+        plain = os.path.join(self.temp_dir, "Packages")
+        with open(plain, "wb") as index:
+            index.write(INDEX)
+        compressed = os.path.join(self.temp_dir, "Packages.gz")
+        with gzip.GzipFile(compressed, "wb") as index:
+            index.write(INDEX)
+        for path in plain, compressed:
+            self.assertEqual(
+                ["hello", "coreutils", "bash"],
+                [paragraph["Package"] for paragraph in read_index(path)])
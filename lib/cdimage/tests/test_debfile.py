@@ -0,0 +1,149 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.debfile."""
+
+import os
+import tarfile
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.debfile import (
+    ControlCache,
+    DebFileError,
+    iter_ar_members,
+    open_tar_member,
+    read_control,
+    read_data_file,
+    read_tar_file,
+)
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+class TestDebFile(TestCase):
+    def setUp(self):
+        super(TestDebFile, self).setUp()
+        self.use_temp_dir()
+        self.deb_path = os.path.join(self.temp_dir, "hello_1_all.deb")
+        self.make_deb(
+            self.deb_path, "misc", "optional",
+            files={"/usr/share/hello/greeting": b"hello\n"})
+
+    def test_iter_ar_members(self):
+        with open(self.deb_path, "rb") as deb:
+            names = []
+            for name, size in iter_ar_members(deb):
+                if name == "debian-binary":
+                    self.assertEqual(b"2.0\n", deb.read(size))
+                names.append(name.split(".")[0])
+        self.assertEqual(["debian-binary", "control", "data"], names)
+
+    def test_not_ar(self):
+        not_deb = os.path.join(self.temp_dir, "not.deb")
+        with open(not_deb, "wb") as f:
+            f.write(b"not an ar archive\n")
+        self.assertRaises(DebFileError, read_data_file, not_deb, "foo")
+
+    def test_read_data_file(self):
+        info, contents = read_data_file(
+            self.deb_path, "/usr/share/hello/greeting")
+        self.assertEqual(b"hello\n", contents)
+        self.assertEqual(6, info.size)
+        self.assertIsNone(read_data_file(self.deb_path, "usr/share/hello"))
+        self.assertIsNone(read_data_file(self.deb_path, "missing"))
+
+    def test_read_data_file_links(self):
+        self.make_deb(
+            self.deb_path, "misc", "optional",
+            files={"/usr/share/hello/scripts/gutsy": b"script\n"},
+            symlinks={
+                "/usr/share/hello/scripts/noble": "gutsy",
+                "/usr/share/hello/absolute": "/usr/share/hello/scripts/noble",
+                "/usr/share/hello/loop": "loop",
+                "/usr/share/hello/outside": "../../../../etc/passwd",
+            })
+        for path in "scripts/noble", "absolute":
+            info, contents = read_data_file(
+                self.deb_path, "/usr/share/hello/%s" % path)
+            self.assertEqual(b"script\n", contents)
+            self.assertTrue(info.isfile())
+        for path in "loop", "outside":
+            self.assertIsNone(
+                read_data_file(self.deb_path, "/usr/share/hello/%s" % path))
+
+    def test_read_tar_file_hard_link(self):
+        tar_path = os.path.join(self.temp_dir, "data.tar")
+        target = os.path.join(self.temp_dir, "target")
+        with open(target, "wb") as f:
+            f.write(b"linked\n")
+        with tarfile.open(tar_path, "w") as tar:
+            tar.add(target, arcname="./usr/share/target")
+            info = tar.gettarinfo(target, arcname="./usr/share/link")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "./usr/share/target"
+            info.size = 0
+            tar.addfile(info)
+        with tarfile.open(tar_path) as tar:
+            info, contents = read_tar_file(tar, "usr/share/link")
+        self.assertEqual(b"linked\n", contents)
+
+    def test_read_control(self):
+        control = read_control(self.deb_path)
+        self.assertEqual("hello", control["Package"])
+        self.assertEqual("misc", control["Section"])
+        self.assertEqual("optional", control["Priority"])
+
+    def test_control_cache(self):
+        cache_path = os.path.join(self.temp_dir, "control-cache")
+        cache = ControlCache(cache_path)
+        self.assertEqual("misc", cache.fields(self.deb_path)["Section"])
+        cache.save()
+        with mock.patch(
+                "cdimage.debfile.read_control",
+                side_effect=Exception("cache not used")):
+            cache = ControlCache(cache_path)
+            self.assertEqual("misc", cache.fields(self.deb_path)["Section"])
+        self.make_deb(self.deb_path, "admin", "extra")
+        os.utime(self.deb_path, (0, 0))
+        self.assertEqual("admin", cache.fields(self.deb_path)["Section"])
+
+    def test_control_cache_corrupt(self):
+        cache_path = os.path.join(self.temp_dir, "control-cache")
+        with open(cache_path, "w") as cache_file:
+            cache_file.write("{")
+        cache = ControlCache(cache_path)
+        self.assertEqual("misc", cache.fields(self.deb_path)["Section"])
+
+    def test_unsupported_compression(self):
+        """Members tarfile cannot decompress are read using dpkg-deb."""
+        real_open = tarfile.open
+
+        def fake_open(*args, **kwargs):
+            if kwargs.get("mode") == "r:*":
+                raise tarfile.ReadError("unsupported compression")
+            return real_open(*args, **kwargs)
+
+        with mock.patch("tarfile.open", side_effect=fake_open):
+            with open_tar_member(self.deb_path, "control.tar") as tar:
+                self.assertIn("./control", tar.getnames())
+            info, contents = read_data_file(
+                self.deb_path, "usr/share/hello/greeting")
+        self.assertEqual(b"hello\n", contents)
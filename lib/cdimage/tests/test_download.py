@@ -0,0 +1,508 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.download."""
+
+from __future__ import print_function
+
+import errno
+import json
+import os
+import shutil
+import ssl
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.config import Config
+from cdimage.download import (
+    ArtefactCache,
+    Downloader,
+    get_downloader,
+)
+from cdimage.osextras import FetchError
+from cdimage.tests.helpers import TestCase, mkfile, touch
+
+__metaclass__ = type
+
+
+class ArtefactHandler(BaseHTTPRequestHandler):
+    """Serve made-up live filesystem artefacts."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers={}, truncate=False):
+        body = body.encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def send_artefact(self, name, truncate=False):
+        body = "contents of %s\n" % name
+        etag = '"%s"' % name
+        byte_range = self.headers.get("Range")
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+        elif byte_range and self.headers.get("If-Range") == etag:
+            start = int(byte_range[len("bytes="):-1])
+            self.send_body(206, body[start:], {
+                "ETag": etag,
+                "Content-Range": "bytes %d-%d/%d" % (
+                    start, len(body) - 1, len(body)),
+            }, truncate=truncate)
+        else:
+            self.send_body(200, body, {"ETag": etag}, truncate=truncate)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.headers.append(self.headers)
+        path = urlsplit(self.path).path
+        with self.server.lock:
+            hits = self.server.hits.get(path, 0)
+            self.server.hits[path] = hits + 1
+        if path.startswith("/file/"):
+            self.send_artefact(path[len("/file/"):])
+        elif path.startswith("/truncate/"):
+            # Drop the connection half-way through the first attempt.
+            self.send_artefact(path[len("/truncate/"):], truncate=not hits)
+        elif path.startswith("/unavailable/"):
+            if hits < int(path[len("/unavailable/"):]):
+                self.send_body(503, "try again later\n")
+            else:
+                self.send_artefact("unavailable")
+        elif path.startswith("/slow/"):
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(
+                    self.server.max_active, self.server.active)
+            time.sleep(0.1)
+            with self.server.lock:
+                self.server.active -= 1
+            self.send_body(200, "slow\n")
+        elif path == "/redirect":
+            self.send_body(302, "", {"Location": "/file/redirected"})
+        else:
+            self.send_body(404, "not found\n")
+
+
+class ArtefactServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ArtefactHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.headers = []
+        self.hits = {}
+        self.active = 0
+        self.max_active = 0
+
+
+class TestDownloader(TestCase):
+    def setUp(self):
+        super(TestDownloader, self).setUp()
+        self.use_temp_dir()
+        self.capture_logging()
+        self.server = ArtefactServer()
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.base = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def make_downloader(self, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        downloader = Downloader(**kwargs)
+        self.addCleanup(downloader.close)
+        return downloader
+
+    def assertFileContents(self, expected, path):
+        with open(path) as f:
+            self.assertEqual(expected, f.read())
+
+    def test_fetch(self):
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader().fetch("%s/file/squashfs" % self.base, target)
+        self.assertFileContents("contents of squashfs\n", target)
+
+    def test_fetch_missing(self):
+        target = os.path.join(self.temp_dir, "target")
+        touch(target)
+        self.assertRaises(
+            FetchError, self.make_downloader().fetch,
+            "%s/missing" % self.base, target)
+        self.assertFalse(os.path.exists(target))
+
+    def test_fetch_connection_refused(self):
+        self.server.server_close()
+        target = os.path.join(self.temp_dir, "target")
+        self.assertRaises(
+            FetchError, self.make_downloader().fetch,
+            "%s/file/squashfs" % self.base, target)
+        self.assertFalse(os.path.exists(target))
+
+    def test_fetch_redirect(self):
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader().fetch("%s/redirect" % self.base, target)
+        self.assertFileContents("contents of redirected\n", target)
+
+    def test_fetch_missing_removes_partial(self):
+        target = os.path.join(self.temp_dir, "target")
+        touch("%s.part" % target)
+        self.assertRaises(
+            FetchError, self.make_downloader().fetch,
+            "%s/missing" % self.base, target)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_fetch_retries_server_errors(self):
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader(retries=2).fetch(
+            "%s/unavailable/2" % self.base, target)
+        self.assertFileContents("contents of unavailable\n", target)
+        self.assertEqual(3, self.server.hits["/unavailable/2"])
+        self.assertLogEqual([
+            "%s/unavailable/2 returned 503 Service Unavailable; "
+            "retrying in 0 seconds" % self.base,
+        ] * 2)
+
+    def test_fetch_gives_up(self):
+        target = os.path.join(self.temp_dir, "target")
+        self.assertRaises(
+            FetchError, self.make_downloader(retries=1).fetch,
+            "%s/unavailable/3" % self.base, target)
+        self.assertEqual(2, self.server.hits["/unavailable/3"])
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    @mock.patch("time.sleep")
+    def test_fetch_backoff(self, mock_sleep):
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader(retries=3, backoff=5).fetch(
+            "%s/unavailable/3" % self.base, target)
+        mock_sleep.assert_has_calls([mock.call(5), mock.call(10),
+                                     mock.call(20)])
+
+    def test_fetch_resumes(self):
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader(retries=1).fetch(
+            "%s/truncate/squashfs" % self.base, target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertEqual(2, self.server.hits["/truncate/squashfs"])
+        self.assertEqual("bytes=10-", self.server.headers[1]["Range"])
+        self.assertEqual('"squashfs"', self.server.headers[1]["If-Range"])
+        self.assertEqual(["target"], os.listdir(self.temp_dir))
+
+    def test_fetch_keeps_resumable_partial(self):
+        url = "%s/truncate/squashfs" % self.base
+        target = os.path.join(self.temp_dir, "target")
+        self.assertRaises(
+            FetchError, self.make_downloader(retries=0).fetch, url, target)
+        self.assertFalse(os.path.exists(target))
+        self.assertFileContents("contents o", "%s.part" % target)
+        with open("%s.part.json" % target) as info:
+            self.assertEqual(
+                {"url": url, "etag": '"squashfs"', "last_modified": None},
+                json.load(info))
+
+        # A later run picks up where the previous one left off.
+        self.make_downloader(retries=0).fetch(url, target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertEqual("bytes=10-", self.server.headers[1]["Range"])
+        self.assertEqual(["target"], os.listdir(self.temp_dir))
+
+    def test_fetch_restarts_changed_partial(self):
+        url = "%s/file/squashfs" % self.base
+        target = os.path.join(self.temp_dir, "target")
+        with mkfile("%s.part" % target) as part:
+            part.write("stale data")
+        with mkfile("%s.part.json" % target) as info:
+            json.dump({"url": url, "etag": '"old"'}, info)
+        self.make_downloader().fetch(url, target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertEqual('"old"', self.server.headers[0]["If-Range"])
+
+    def test_fetch_already_complete(self):
+        url = "%s/file/squashfs" % self.base
+        target = os.path.join(self.temp_dir, "target")
+        with mkfile("%s.part" % target) as part:
+            part.write("contents of squashfs\n")
+        with mkfile("%s.part.json" % target) as info:
+            json.dump({"url": url, "etag": '"squashfs"'}, info)
+        self.make_downloader().fetch(url, target)
+        self.assertFileContents("contents of squashfs\n", target)
+
+    def test_fetch_expected_size(self):
+        target = os.path.join(self.temp_dir, "target")
+        url = "%s/file/squashfs" % self.base
+        self.assertRaises(
+            FetchError, self.make_downloader().fetch, url, target,
+            expected_size=100)
+        self.assertEqual([], os.listdir(self.temp_dir))
+        self.make_downloader().fetch(url, target, expected_size=21)
+        self.assertFileContents("contents of squashfs\n", target)
+
+    def test_cache_hit(self):
+        cache = ArtefactCache(os.path.join(self.temp_dir, "cache"), 1024)
+        downloader = self.make_downloader(cache=cache)
+        url = "%s/file/squashfs" % self.base
+        first = os.path.join(self.temp_dir, "first")
+        second = os.path.join(self.temp_dir, "second")
+        downloader.fetch(url, first)
+        downloader.fetch(url, second)
+        self.assertFileContents("contents of squashfs\n", second)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertNotIn("If-None-Match", self.server.headers[0])
+        self.assertEqual('"squashfs"', self.server.headers[1]["If-None-Match"])
+
+    def test_cache_changed(self):
+        cache = ArtefactCache(os.path.join(self.temp_dir, "cache"), 1024)
+        url = "%s/file/squashfs" % self.base
+        stale = os.path.join(self.temp_dir, "stale")
+        with mkfile(stale) as f:
+            f.write("old squashfs\n")
+        cache.store(url, stale, '"old"', None)
+        target = os.path.join(self.temp_dir, "target")
+        self.make_downloader(cache=cache).fetch(url, target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertEqual('"old"', self.server.headers[0]["If-None-Match"])
+        self.assertEqual('"squashfs"', cache.lookup(url)["etag"])
+
+    def test_cache_object_removed(self):
+        cache = ArtefactCache(os.path.join(self.temp_dir, "cache"), 1024)
+        downloader = self.make_downloader(cache=cache)
+        url = "%s/file/squashfs" % self.base
+        downloader.fetch(url, os.path.join(self.temp_dir, "first"))
+        shutil.rmtree(os.path.join(self.temp_dir, "cache", "objects"))
+        target = os.path.join(self.temp_dir, "second")
+        downloader.fetch(url, target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertNotIn("If-None-Match", self.server.headers[1])
+
+    def test_cache_store_fails(self):
+        # A failure to cache a file does not fail the download.
+        cache = ArtefactCache(os.path.join(self.temp_dir, "cache"), 1024)
+        url = "%s/file/squashfs" % self.base
+        target = os.path.join(self.temp_dir, "target")
+        with mock.patch.object(
+                cache, "store",
+                side_effect=OSError(errno.ENOSPC, "No space left")):
+            self.assertFalse(
+                self.make_downloader(cache=cache).fetch(url, target))
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertIsNone(cache.lookup(url))
+
+    def test_keep_alive(self):
+        downloader = self.make_downloader()
+        for name in ("squashfs", "manifest", "size"):
+            downloader.fetch(
+                "%s/file/%s" % (self.base, name),
+                os.path.join(self.temp_dir, name))
+        self.assertFileContents(
+            "contents of manifest\n", os.path.join(self.temp_dir, "manifest"))
+        self.assertEqual(1, downloader.connections_opened())
+        self.assertEqual(1, self.server.connections)
+
+    def fetch_slowly(self, downloader, count):
+        threads = [
+            threading.Thread(target=downloader.fetch, args=(
+                "%s/slow/%d" % (self.base, i),
+                os.path.join(self.temp_dir, "slow%d" % i)))
+            for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_per_host_limit(self):
+        downloader = self.make_downloader(
+            max_connections=8, max_connections_per_host=2)
+        self.fetch_slowly(downloader, 6)
+        self.assertLessEqual(self.server.max_active, 2)
+        self.assertLessEqual(downloader.connections_opened(), 2)
+
+    def test_global_limit(self):
+        downloader = self.make_downloader(
+            max_connections=1, max_connections_per_host=4)
+        self.fetch_slowly(downloader, 3)
+        self.assertLessEqual(self.server.max_active, 1)
+
+    def test_http_proxy(self):
+        downloader = self.make_downloader(http_proxy=self.base)
+        target = os.path.join(self.temp_dir, "target")
+        downloader.fetch("http://livefs.invalid/file/squashfs", target)
+        self.assertFileContents("contents of squashfs\n", target)
+        self.assertEqual(
+            ["http://livefs.invalid/file/squashfs"], self.server.requests)
+
+
+class TestArtefactCache(TestCase):
+    def setUp(self):
+        super(TestArtefactCache, self).setUp()
+        self.use_temp_dir()
+        self.cache = ArtefactCache(os.path.join(self.temp_dir, "cache"), 25)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.temp_dir, name)
+        with mkfile(path) as f:
+            f.write("x" * size)
+        return path
+
+    def test_lookup_missing(self):
+        self.assertIsNone(self.cache.lookup("http://example.org/squashfs"))
+
+    def test_store_needs_validator(self):
+        url = "http://example.org/squashfs"
+        self.cache.store(url, self.make_file("squashfs", 10), None, None)
+        self.assertIsNone(self.cache.lookup(url))
+
+    def test_store_and_materialise(self):
+        url = "http://example.org/squashfs"
+        self.cache.store(
+            url, self.make_file("squashfs", 10), '"1"',
+            "Sat, 17 Oct 2026 00:00:00 GMT")
+        entry = self.cache.lookup(url)
+        self.assertEqual('"1"', entry["etag"])
+        self.assertEqual(
+            "Sat, 17 Oct 2026 00:00:00 GMT", entry["last_modified"])
+        self.assertEqual(10, entry["size"])
+        target = os.path.join(self.temp_dir, "target")
+        touch(target)
+        self.assertTrue(self.cache.materialise(entry, target))
+        self.assertEqual(10, os.path.getsize(target))
+
+    def test_store_leaves_no_temporary_files(self):
+        url = "http://example.org/squashfs"
+        path = self.make_file("squashfs", 10)
+        self.cache.store(url, path, '"1"', None)
+        self.cache.store(url, path, '"1"', None)
+        objects = os.listdir(os.path.join(self.temp_dir, "cache", "objects"))
+        self.assertEqual([self.cache.lookup(url)["key"]], objects)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, "cache", ".lock")))
+
+    @mock.patch("time.time")
+    def test_evicts_least_recently_used(self, mock_time):
+        mock_time.side_effect = iter(range(100))
+        for name in ("one", "two"):
+            self.cache.store(
+                "http://example.org/%s" % name, self.make_file(name, 10),
+                '"%s"' % name, None)
+        # Using "one" makes "two" the least recently used.
+        self.cache.materialise(
+            self.cache.lookup("http://example.org/one"),
+            os.path.join(self.temp_dir, "target"))
+        self.cache.store(
+            "http://example.org/three", self.make_file("three", 10),
+            '"three"', None)
+        self.assertIsNotNone(self.cache.lookup("http://example.org/one"))
+        self.assertIsNone(self.cache.lookup("http://example.org/two"))
+        self.assertIsNotNone(self.cache.lookup("http://example.org/three"))
+        self.assertEqual(
+            2, len(os.listdir(os.path.join(self.temp_dir, "cache", "urls"))))
+
+
+class TestGetDownloader(TestCase):
+    def setUp(self):
+        super(TestGetDownloader, self).setUp()
+        self.config = Config(read=False)
+        self.config.root = self.use_temp_dir()
+        os.environ.pop("http_proxy", None)
+        os.environ.pop("https_proxy", None)
+        os.environ.pop("LP_DISABLE_SSL_CERTIFICATE_VALIDATION", None)
+
+    def write_proxies(self, proxy):
+        path = os.path.join(self.temp_dir, "production", "proxies")
+        with mkfile(path) as proxies:
+            print("fetch %s" % proxy, file=proxies)
+
+    def test_shared(self):
+        self.assertIs(get_downloader(self.config), get_downloader(self.config))
+
+    def test_no_proxy(self):
+        self.assertIsNone(get_downloader(self.config).proxies["http"])
+
+    def test_environment_proxy(self):
+        os.environ["http_proxy"] = "http://env-proxy:3128/"
+        self.assertEqual(
+            ("env-proxy", 3128), get_downloader(self.config).proxies["http"])
+
+    def test_selected_proxy(self):
+        os.environ["http_proxy"] = "http://env-proxy:3128/"
+        self.write_proxies("http://fetch-proxy:8080/")
+        self.assertEqual(
+            ("fetch-proxy", 8080),
+            get_downloader(self.config).proxies["http"])
+
+    def test_unset_proxy(self):
+        os.environ["http_proxy"] = "http://env-proxy:3128/"
+        self.write_proxies("unset")
+        self.assertIsNone(get_downloader(self.config).proxies["http"])
+
+    def test_certificate_validation(self):
+        downloader = get_downloader(self.config)
+        self.assertEqual(ssl.CERT_REQUIRED, downloader.ssl_context.verify_mode)
+        os.environ["LP_DISABLE_SSL_CERTIFICATE_VALIDATION"] = "1"
+        downloader = get_downloader(self.config)
+        self.assertEqual(ssl.CERT_NONE, downloader.ssl_context.verify_mode)
+
+    def test_cache(self):
+        cache = get_downloader(self.config).cache
+        self.assertEqual(
+            os.path.join(self.temp_dir, "scratch", ".livefs-cache"),
+            cache.directory)
+        self.config["CDIMAGE_LIVEFS_CACHE_SIZE"] = "0"
+        self.assertIsNone(get_downloader(self.config).cache)
+
+    def test_limits(self):
+        self.config["CDIMAGE_DOWNLOAD_HOST_JOBS"] = "1"
+        downloader = get_downloader(self.config)
+        self.assertEqual(1, downloader.max_connections_per_host)
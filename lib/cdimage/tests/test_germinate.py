@@ -22,16 +22,23 @@ from __future__ import print_function
 from functools import partial
 import gzip
 import os
+import re
+import shutil
 import subprocess
+import sys
 from textwrap import dedent
+from unittest import skipUnless
 
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+from cdimage import osextras
 from cdimage.config import Config, all_series
+from cdimage import germinate
 from cdimage.germinate import (
+    GerminateAPI,
     GerminateNotInstalled,
     GerminateOutput,
     Germination,
@@ -43,6 +50,64 @@ from cdimage.tests.helpers import TestCase, mkfile, touch
 __metaclass__ = type
 
 
+class FakeIndexType:
+    PACKAGES = "packages"
+    SOURCES = "sources"
+    INSTALLER_PACKAGES = "installer"
+
+
+class FakeGerminator:
+    def __init__(self, arch):
+        self.arch = arch
+        self.sections = []
+
+    def parse_archive(self, archive):
+        self.sections = [
+            (index_type, section["Package"])
+            for index_type, section in archive.sections()]
+
+    def parse_hints(self, hints):
+        pass
+
+    def plant_seeds(self, structure):
+        pass
+
+    def grow(self, structure):
+        pass
+
+    def add_extras(self, structure):
+        pass
+
+    def write_full_list(self, structure, filename, seedname):
+        with open(filename, "w") as full_list:
+            for index_type, package in self.sections:
+                print(index_type, package, file=full_list)
+
+    def write_supported_list(self, structure, filename):
+        with open(filename, "w") as supported_list:
+            print("supported", self.arch, file=supported_list)
+            print(
+                "http_proxy", os.environ.get("http_proxy", "-"),
+                file=supported_list)
+
+
+class FakeSeedStructure:
+    def __init__(self, branch, seed_bases=None, vcs=None):
+        self.names = ["required", "minimal"]
+
+    def __contains__(self, seedname):
+        return seedname in self.names
+
+    def write_seed_text(self, filename, seedname):
+        with open(filename, "w") as seedtext:
+            print("Task-Description: %s" % seedname, file=seedtext)
+
+    def write(self, filename):
+        with open(filename, "w") as structure:
+            print("required:", file=structure)
+            print("minimal: required", file=structure)
+
+
 class TestGermination(TestCase):
     def setUp(self):
         super(TestGermination, self).setUp()
@@ -156,6 +221,68 @@ class TestGermination(TestCase):
                 b"main\nrestricted\nuniverse\nmultiverse\n",
                 output_sources.read())
 
+    def test_make_index_missing(self):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        rel_target = "dists/trusty/main/source/Sources.gz"
+        self.germination.make_index("ubuntu", "i386", rel_target, [rel_target])
+        output_file = os.path.join(
+            self.germination.output_dir("ubuntu"), rel_target)
+        with gzip.GzipFile(output_file, "rb") as output_sources:
+            self.assertEqual(b"", output_sources.read())
+
+    def test_make_index_reuses_indices(self):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "source"
+        rel_target = "dists/trusty/main/source/Sources.gz"
+        source = os.path.join(self.temp_dir, "ftp", rel_target)
+        os.makedirs(os.path.dirname(source))
+        with gzip.GzipFile(source, "wb") as f:
+            f.write(b"Package: hello\n")
+        targets = [
+            os.path.join(self.germination.output_dir(project), rel_target)
+            for project in ("ubuntu", "kubuntu")]
+        copyfileobj = shutil.copyfileobj
+        with mock.patch("shutil.copyfileobj") as mock_copyfileobj:
+            mock_copyfileobj.side_effect = copyfileobj
+            for project, arch in (
+                    ("ubuntu", "amd64"), ("ubuntu", "i386"),
+                    ("kubuntu", "amd64")):
+                self.germination.make_index(
+                    project, arch, rel_target, [rel_target])
+        self.assertEqual(1, mock_copyfileobj.call_count)
+        self.assertTrue(os.path.samefile(targets[0], targets[1]))
+        with gzip.GzipFile(targets[1], "rb") as output_sources:
+            self.assertEqual(b"Package: hello\n", output_sources.read())
+
+    def test_make_index_leaves_linked_index(self):
+        # germinate_arch makes indices again while germinate may be reading
+        # them for another architecture of the same project.
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "source"
+        rel_target = "dists/trusty/main/source/Sources.gz"
+        source = os.path.join(self.temp_dir, "ftp", rel_target)
+        os.makedirs(os.path.dirname(source))
+        with gzip.GzipFile(source, "wb") as f:
+            f.write(b"Package: hello\n")
+        for project in "ubuntu", "kubuntu":
+            self.germination.make_index(
+                project, "amd64", rel_target, [rel_target])
+        target = os.path.join(
+            self.germination.output_dir("kubuntu"), rel_target)
+        sibling = os.path.join(os.path.dirname(target), "in-use")
+        touch(sibling)
+        target_stat = os.stat(target)
+        with mock.patch("os.link") as mock_link:
+            self.germination.make_index(
+                "kubuntu", "i386", rel_target, [rel_target])
+        mock_link.assert_not_called()
+        self.assertTrue(os.path.exists(sibling))
+        self.assertEqual(target_stat.st_ino, os.stat(target).st_ino)
+
     def test_germinate_dists_environment_override(self):
         self.config["GERMINATE_DISTS"] = "sentinel,sentinel-updates"
         self.assertEqual(
@@ -254,26 +381,340 @@ class TestGermination(TestCase):
         self.assertEqual(
             "%s/amd64+mac" % output_dir, mock_check_call.call_args[1]["cwd"])
 
+    @mock.patch("subprocess.check_call")
+    def test_germinate_arch_separate_log(self, mock_check_call):
+        self.config.root = self.use_temp_dir()
+        germinate_path = os.path.join(
+            self.temp_dir, "germinate", "bin", "germinate")
+        touch(germinate_path)
+        os.chmod(germinate_path, 0o755)
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+
+        def check_call_side_effect(*args, **kwargs):
+            print("germinate output", file=kwargs["stdout"])
+
+        mock_check_call.side_effect = check_call_side_effect
+        stdout_path = os.path.join(self.temp_dir, "stdout")
+        with open(stdout_path, "w") as stdout:
+            with mock.patch("sys.stdout", stdout):
+                self.germination.germinate_arch(
+                    "ubuntu", "amd64", separate_log=True)
+        self.assertEqual(
+            subprocess.STDOUT, mock_check_call.call_args[1]["stderr"])
+        with open(stdout_path) as stdout:
+            self.assertEqual("germinate output\n", stdout.read())
+
+    def test_germinate_api_missing(self):
+        self.config.root = self.use_temp_dir()
+        self.assertIsNone(self.germination.germinate_api)
+
+    def test_germinate_api(self):
+        self.config.root = self.use_temp_dir()
+        checkout = os.path.join(self.temp_dir, "germinate")
+        for name, contents in (
+                ("__init__", ""),
+                ("archive", "class IndexType:\n    pass\n"),
+                ("germinator", "class Germinator:\n    pass\n"),
+                ("seeds", "class SeedStructure:\n    pass\n")):
+            with mkfile(os.path.join(
+                    checkout, "germinate", "%s.py" % name)) as module:
+                module.write(contents)
+        with mock.patch.dict(sys.modules), mock.patch.object(
+                sys, "path", list(sys.path)):
+            for name in list(sys.modules):
+                if name == "germinate" or name.startswith("germinate."):
+                    del sys.modules[name]
+            api = self.germination.germinate_api
+            self.assertEqual("IndexType", api.IndexType.__name__)
+            self.assertEqual("Germinator", api.Germinator.__name__)
+            self.assertEqual("SeedStructure", api.SeedStructure.__name__)
+            self.assertEqual(
+                os.path.join(checkout, "germinate", "germinator.py"),
+                sys.modules["germinate.germinator"].__file__)
+
+    @skipUnless(germinate._can_spawn, "requires multiprocessing contexts")
+    def test_germinate_arch_in_process(self):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["GERMINATE_DISTS"] = "trusty,trusty-updates"
+        for dist in "trusty", "trusty-updates":
+            for suffix, package in (
+                    ("binary-%s/Packages.gz", "deb-%s-%%s" % dist),
+                    ("source/Sources.gz", "source-%s" % dist),
+                    ("debian-installer/binary-%s/Packages.gz",
+                     "udeb-%s-%%s" % dist)):
+                for arch in "amd64", "i386":
+                    path = os.path.join(
+                        self.temp_dir, "ftp", "dists", dist, "main",
+                        suffix.replace("%s", arch))
+                    osextras.ensuredir(os.path.dirname(path))
+                    with gzip.GzipFile(path, "wb") as index:
+                        index.write(
+                            ("Package: %s\n" % package.replace("%s", arch))
+                            .encode("UTF-8"))
+        http_proxy = "http://proxy.example.org:3128/"
+        with mkfile(os.path.join(
+                self.temp_dir, "production", "proxies")) as proxies:
+            print("germinate\t%s" % http_proxy, file=proxies)
+        api = GerminateAPI(FakeIndexType, FakeGerminator, FakeSeedStructure)
+        read_index = germinate.read_index
+        with mock.patch.object(
+                Germination, "germinate_api", new_callable=mock.PropertyMock,
+                return_value=api), mock.patch(
+                "cdimage.germinate.read_index",
+                side_effect=read_index) as mock_read_index:
+            self.germination.germinate_arch("ubuntu", "amd64")
+            self.germination.germinate_arch("ubuntu", "i386")
+        output_dir = self.germination.output_dir("ubuntu")
+        # Sources are only parsed once, before starting the children.
+        self.assertEqual([
+            mock.call(os.path.join(
+                output_dir, "dists", dist, "main", "source", "Sources.gz"))
+            for dist in ("trusty", "trusty-updates")],
+            mock_read_index.call_args_list)
+        for arch in "amd64", "i386":
+            for seed in "required", "minimal", "extra":
+                with open(os.path.join(output_dir, arch, seed)) as full_list:
+                    self.assertEqual(dedent("""\
+                        packages deb-trusty-%(arch)s
+                        sources source-trusty
+                        installer udeb-trusty-%(arch)s
+                        packages deb-trusty-updates-%(arch)s
+                        sources source-trusty-updates
+                        installer udeb-trusty-updates-%(arch)s
+                        """) % {"arch": arch}, full_list.read())
+            for seed in "required", "minimal":
+                with open(os.path.join(
+                        output_dir, arch, "%s.seedtext" % seed)) as seedtext:
+                    self.assertEqual(
+                        "Task-Description: %s\n" % seed, seedtext.read())
+            self.assertFalse(os.path.exists(
+                os.path.join(output_dir, arch, "extra.seedtext")))
+            with open(os.path.join(
+                    output_dir, arch, "supported+build-depends")) as supported:
+                self.assertEqual(
+                    "supported %s\nhttp_proxy %s\n" % (arch, http_proxy),
+                    supported.read())
+            with open(os.path.join(output_dir, arch, "structure")) as f:
+                self.assertEqual("required:\nminimal: required\n", f.read())
+
+    @skipUnless(germinate._can_spawn, "requires multiprocessing contexts")
+    def test_germinate_arch_in_process_failure(self):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["GERMINATE_DISTS"] = "trusty"
+        api = GerminateAPI(FakeIndexType, None, FakeSeedStructure)
+        stdout_path = os.path.join(self.temp_dir, "stdout")
+        with open(stdout_path, "w") as stdout, mock.patch(
+                "sys.stdout", stdout), mock.patch.object(
+                Germination, "germinate_api", new_callable=mock.PropertyMock,
+                return_value=api):
+            self.assertRaises(
+                subprocess.CalledProcessError,
+                self.germination.germinate_arch, "ubuntu", "amd64",
+                separate_log=True)
+        with open(stdout_path) as stdout:
+            self.assertIn("TypeError", stdout.read())
+
+    @mock.patch("subprocess.check_call")
+    def test_germinate_arch_without_spawn(self, mock_check_call):
+        # Without multiprocessing contexts, the command is used instead.
+        self.config.root = self.use_temp_dir()
+        germinate_path = os.path.join(
+            self.temp_dir, "germinate", "bin", "germinate")
+        touch(germinate_path)
+        os.chmod(germinate_path, 0o755)
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["GERMINATE_DISTS"] = "trusty"
+        api = GerminateAPI(FakeIndexType, FakeGerminator, FakeSeedStructure)
+        with mock.patch.object(
+                Germination, "germinate_api", new_callable=mock.PropertyMock,
+                return_value=api), mock.patch(
+                "cdimage.germinate._can_spawn", False):
+            self.germination.germinate_arch("ubuntu", "amd64")
+        self.assertEqual(1, mock_check_call.call_count)
+        self.assertEqual(germinate_path, mock_check_call.call_args[0][0][0])
+
+    def make_structure(self, project, arch, *args, **kwargs):
+        with mkfile(os.path.join(
+                self.germination.output_dir(project), arch,
+                "structure")) as structure:
+            print("%s: %s" % (project, arch), file=structure)
+
+    @mock.patch(
+        "cdimage.germinate.Germination.seed_revisions", return_value=None)
     @mock.patch("cdimage.germinate.Germination.germinate_arch")
-    def test_germinate_project(self, mock_germinate_arch):
+    def test_germinate_project(self, mock_germinate_arch, *args):
         self.config.root = self.use_temp_dir()
         self.config["DIST"] = "trusty"
         self.config["ARCHES"] = "amd64 i386"
         self.config["IMAGE_TYPE"] = "daily"
+        self.config["CDIMAGE_GERMINATE_JOBS"] = "1"
+        mock_germinate_arch.side_effect = self.make_structure
         self.capture_logging()
         self.germination.germinate_project("ubuntu")
-        self.assertTrue(os.path.isdir(os.path.join(
+        output_dir = os.path.join(
             self.temp_dir, "scratch", "ubuntu", "trusty", "daily",
-            "germinate")))
-        mock_germinate_arch.assert_has_calls(
-            [mock.call("ubuntu", "amd64"), mock.call("ubuntu", "i386")])
+            "germinate")
+        self.assertTrue(os.path.isdir(output_dir))
+        mock_germinate_arch.assert_has_calls([
+            mock.call("ubuntu", "amd64", separate_log=False),
+            mock.call("ubuntu", "i386", separate_log=False),
+        ])
         self.assertLogEqual([
             "Germinating for trusty/amd64 ...",
             "Germinating for trusty/i386 ...",
         ])
+        with open(os.path.join(output_dir, "STRUCTURE")) as structure:
+            self.assertEqual("ubuntu: i386\n", structure.read())
+
+    @mock.patch(
+        "cdimage.germinate.Germination.seed_revisions", return_value=None)
+    @mock.patch("cdimage.germinate.Germination.germinate_arch")
+    def test_germinate_projects_concurrently(self, mock_germinate_arch, *args):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["ARCHES"] = "amd64 i386"
+        self.config["IMAGE_TYPE"] = "source"
+        mock_germinate_arch.side_effect = self.make_structure
+        self.capture_logging()
+        self.germination.germinate_projects(["ubuntu", "kubuntu"])
+        mock_germinate_arch.assert_has_calls([
+            mock.call("ubuntu", "amd64", separate_log=True),
+            mock.call("ubuntu", "i386", separate_log=True),
+            mock.call("kubuntu", "amd64", separate_log=True),
+            mock.call("kubuntu", "i386", separate_log=True),
+        ], any_order=True)
+        for project in "ubuntu", "kubuntu":
+            structure_path = os.path.join(
+                self.germination.output_dir(project), "STRUCTURE")
+            with open(structure_path) as structure:
+                self.assertEqual("%s: i386\n" % project, structure.read())
+
+    @mock.patch("cdimage.germinate.proxy_check_output")
+    def test_seed_revisions(self, mock_check_output):
+        self.config["DIST"] = "trusty"
+        mock_check_output.side_effect = [
+            "1111\trefs/heads/trusty\n",
+            "",
+            "3333\trefs/heads/trusty\n",
+            "4444\trefs/heads/trusty\n",
+            "5555\trefs/heads/trusty\n",
+            "6666\trefs/heads/trusty\n",
+        ]
+        git = "https://git.launchpad.net/~%s/ubuntu-seeds/+git/"
+        self.assertEqual([
+            (git % "xubuntu-dev" + "xubuntu", "1111"),
+            (git % "xubuntu-dev" + "ubuntu", "-"),
+            (git % "xubuntu-dev" + "platform", "3333"),
+            (git % "ubuntu-core-dev" + "xubuntu", "4444"),
+            (git % "ubuntu-core-dev" + "ubuntu", "5555"),
+            (git % "ubuntu-core-dev" + "platform", "6666"),
+        ], self.germination.seed_revisions("xubuntu"))
+        mock_check_output.assert_any_call(
+            self.config, "germinate",
+            ["git", "ls-remote", git % "xubuntu-dev" + "xubuntu",
+             "refs/heads/trusty"],
+            env=mock.ANY, universal_newlines=True)
+
+    @mock.patch("cdimage.germinate.proxy_check_output")
+    def test_seed_revisions_unreachable(self, mock_check_output):
+        """If any seed branch cannot be checked, nothing is cached."""
+        self.config["DIST"] = "trusty"
+        mock_check_output.side_effect = [
+            "1111\trefs/heads/trusty\n",
+            subprocess.CalledProcessError(128, "git"),
+        ]
+        self.assertIsNone(self.germination.seed_revisions("ubuntu"))
+
+    def test_seed_revisions_not_git(self):
+        self.config["DIST"] = "trusty"
+        self.assertIsNone(self.germination.seed_revisions("kubuntu"))
+        self.config["LOCAL_SEEDS"] = "http://www.example.org/"
+        self.assertIsNone(self.germination.seed_revisions("ubuntu"))
+
+    @mock.patch("cdimage.germinate.Germination.seed_revisions")
+    def test_fingerprint(self, mock_seed_revisions):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["ARCHES"] = "amd64"
+        self.config["IMAGE_TYPE"] = "daily"
+        mock_seed_revisions.return_value = [("seeds", "1111")]
+        changelog = os.path.join(
+            self.temp_dir, "germinate", "debian", "changelog")
+        with mkfile(changelog) as f:
+            print("germinate (2.36) unstable; urgency=medium", file=f)
+        index = os.path.join(
+            self.temp_dir, "ftp", "dists", "trusty", "main",
+            "binary-amd64", "Packages.gz")
+
+        def write_index(contents, mtime):
+            osextras.ensuredir(os.path.dirname(index))
+            with gzip.GzipFile(index, "wb", mtime=mtime) as f:
+                f.write(contents)
+
+        write_index(b"", 1)
+        fingerprint = self.germination.fingerprint("ubuntu")
+        self.assertEqual(fingerprint, self.germination.fingerprint("ubuntu"))
+        # Recompressing an index with a new timestamp changes nothing.
+        write_index(b"", 2)
+        self.assertEqual(fingerprint, self.germination.fingerprint("ubuntu"))
+        write_index(b"Package: hello\n", 2)
+        new_fingerprint = self.germination.fingerprint("ubuntu")
+        self.assertNotEqual(fingerprint, new_fingerprint)
+        with mkfile(changelog) as f:
+            print("germinate (2.37) unstable; urgency=medium", file=f)
+        self.assertNotEqual(
+            new_fingerprint, self.germination.fingerprint("ubuntu"))
+        mock_seed_revisions.return_value = None
+        self.assertIsNone(self.germination.fingerprint("ubuntu"))
+
+    def test_germinate_revision(self):
+        self.config.root = self.use_temp_dir()
+        self.assertIsNone(self.germination.germinate_revision)
+        checkout = os.path.join(self.temp_dir, "germinate")
+        with mkfile(os.path.join(checkout, "debian", "changelog")) as f:
+            print("germinate (2.36) unstable; urgency=medium", file=f)
+        self.assertEqual("2.36", self.germination.germinate_revision)
+        os.mkdir(os.path.join(checkout, ".git"))
+        with mock.patch("subprocess.check_output", return_value="abcd\n"):
+            self.assertEqual("abcd", self.germination.germinate_revision)
+
+    @mock.patch("cdimage.germinate.Germination.fingerprint")
+    @mock.patch("cdimage.germinate.Germination.germinate_arch")
+    def test_germinate_projects_unchanged(
+            self, mock_germinate_arch, mock_fingerprint):
+        self.config.root = self.use_temp_dir()
+        self.config["DIST"] = "trusty"
+        self.config["ARCHES"] = "amd64"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["CDIMAGE_GERMINATE_JOBS"] = "1"
+        mock_germinate_arch.side_effect = self.make_structure
+        mock_fingerprint.return_value = "1111"
+        self.capture_logging()
+        self.germination.germinate_projects(["ubuntu"])
+        self.assertEqual(1, mock_germinate_arch.call_count)
+
+        self.germination.germinate_projects(["ubuntu"])
+        self.assertEqual(1, mock_germinate_arch.call_count)
+
+        mock_fingerprint.return_value = "2222"
+        self.germination.germinate_projects(["ubuntu"])
+        self.assertEqual(2, mock_germinate_arch.call_count)
+        self.assertLogEqual([
+            "Germinating for trusty/amd64 ...",
+            "Germinate inputs for ubuntu are unchanged; reusing previous "
+            "output.",
+            "Germinating for trusty/amd64 ...",
+        ])
 
+    @mock.patch("cdimage.germinate.Germination.germinate_projects")
     @mock.patch("cdimage.germinate.Germination.germinate_project")
-    def test_run(self, mock_germinate_project):
+    def test_run(self, mock_germinate_project, mock_germinate_projects):
         self.config["PROJECT"] = "ubuntu"
         self.config["IMAGE_TYPE"] = "daily"
         self.germination.run()
@@ -284,8 +725,8 @@ class TestGermination(TestCase):
         self.config["ALL_PROJECTS"] = "ubuntu kubuntu"
         self.config["IMAGE_TYPE"] = "source"
         self.germination.run()
-        mock_germinate_project.assert_has_calls(
-            [mock.call("ubuntu"), mock.call("kubuntu")])
+        self.assertEqual(0, mock_germinate_project.call_count)
+        mock_germinate_projects.assert_called_once_with(["ubuntu", "kubuntu"])
 
     def test_output(self):
         self.config.root = self.use_temp_dir()
@@ -408,6 +849,45 @@ class TestGerminateOutput(TestCase):
         self.assertEqual(
             ["c", "d"], output._without_inheritance("b", inheritance))
 
+    def test_inheritance_order(self):
+        """_inheritance lists seeds as a depth-first walk would."""
+        self.write_structure([
+            ["d", ["c", "a"]], ["c", ["b"]], ["b", ["a"]], ["a", []],
+            ["e", ["d", "b"]],
+        ])
+        output = GerminateOutput(self.config, self.temp_dir)
+        self.assertEqual(["a", "b", "c", "d"], output._inheritance("d"))
+        self.assertEqual(["a", "b", "c", "d", "e"], output._inheritance("e"))
+        self.assertEqual(["unknown"], output._inheritance("unknown"))
+
+    def test_inheritance_cycle(self):
+        """_inheritance copes with seeds that inherit from each other."""
+        self.write_structure([
+            ["a", []], ["b", ["a", "c"]], ["c", ["b"]], ["d", ["c"]]])
+        output = GerminateOutput(self.config, self.temp_dir)
+        for seed, expected in (
+            ("b", ["a", "c", "b"]),
+            ("c", ["a", "b", "c"]),
+            ("d", ["a", "b", "c", "d"]),
+        ):
+            self.assertEqual(expected, output._inheritance(seed))
+
+    def test_list_seeds_cached(self):
+        self.write_ubuntu_structure()
+        output = GerminateOutput(self.config, self.temp_dir)
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        with mock.patch.object(
+                output, "_list_seeds", wraps=output._list_seeds) as wrapped:
+            tasks = list(output.list_seeds("tasks"))
+            self.assertEqual(tasks, list(output.list_seeds("tasks")))
+            self.assertEqual(1, wrapped.call_count)
+            self.config["CDIMAGE_DVD"] = "1"
+            self.assertEqual(
+                tasks + ["dns-server", "lamp-server"],
+                list(output.list_seeds("tasks")))
+            self.assertEqual(2, wrapped.call_count)
+
     def test_list_seeds_all(self):
         self.write_structure([["a", []], ["b", ["a"]], ["c", []]])
         output = GerminateOutput(self.config, self.temp_dir)
@@ -536,6 +1016,15 @@ class TestGerminateOutput(TestCase):
             ["base-files", "base-passwd"],
             output.seed_packages("i386", "base"))
 
+    def test_seed_packages_cached(self):
+        self.write_structure([["base", []]])
+        self.write_seed_output("i386", "base", ["base-files"])
+        output = GerminateOutput(self.config, self.temp_dir)
+        self.assertEqual(["base-files"], output.seed_packages("i386", "base"))
+        self.write_seed_output("i386", "base", ["base-passwd"])
+        self.assertEqual(["base-files"], output.seed_packages("i386", "base"))
+        self.assertRaises(IOError, output.seed_packages, "i386", "missing")
+
     # TODO: master_seeds addon untested
 
     def test_master_seeds_onlysource(self):
@@ -704,6 +1193,29 @@ class TestGerminateOutput(TestCase):
             output.initrd_packages("./netboot/netboot.tar.gz", "i386"))
         self.assertEqual(set(), output.initrd_packages("unknown", "powerpc"))
 
+    def test_initrd_packages_cached(self):
+        self.write_ubuntu_structure()
+        manifest_path = os.path.join(
+            self.temp_dir, "ftp", "dists", "trusty", "main", "installer-i386",
+            "current", "images", "MANIFEST.udebs")
+        with mkfile(manifest_path) as manifest:
+            print("cdrom/initrd.gz\n\tanna 1.45ubuntu1 i386", file=manifest)
+        os.utime(manifest_path, (1000000000, 1000000000))
+        self.config["DIST"] = "trusty"
+        output = GerminateOutput(self.config, self.temp_dir)
+        packages = output.initrd_packages("cdrom/initrd.gz", "i386")
+        self.assertEqual(set(["anna"]), packages)
+        self.assertIs(
+            packages,
+            GerminateOutput(self.config, self.temp_dir).initrd_packages(
+                "cdrom/initrd.gz", "i386"))
+        with mkfile(manifest_path) as manifest:
+            print("cdrom/initrd.gz\n\tmain-menu 1.38 i386", file=manifest)
+        os.utime(manifest_path, (1000000001, 1000000001))
+        self.assertEqual(
+            set(["main-menu"]),
+            output.initrd_packages("cdrom/initrd.gz", "i386"))
+
     def test_common_initrd_packages(self):
         self.write_ubuntu_structure()
         manifest_path = os.path.join(
@@ -864,8 +1376,7 @@ class TestGerminateOutput(TestCase):
 
     # TODO: write_tasks untested
 
-    @mock.patch("subprocess.call", return_value=1)
-    def test_diff_tasks(self, mock_call):
+    def write_task_changes(self):
         self.write_ubuntu_structure()
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "trusty"
@@ -873,24 +1384,40 @@ class TestGerminateOutput(TestCase):
         output_dir = os.path.join(
             self.temp_dir, "scratch", "ubuntu", "trusty", "daily-live",
             "tasks")
-        touch(os.path.join(output_dir, "required"))
-        touch(os.path.join(output_dir, "minimal"))
-        touch(os.path.join(output_dir, "standard"))
-        touch(os.path.join("%s-previous" % output_dir, "minimal"))
-        touch(os.path.join("%s-previous" % output_dir, "standard"))
-        output = GerminateOutput(self.config, self.temp_dir)
-        output.diff_tasks()
-        self.assertEqual(2, mock_call.call_count)
-        mock_call.assert_has_calls([
-            mock.call([
-                "diff", "-u",
-                os.path.join("%s-previous" % output_dir, "minimal"),
-                os.path.join(output_dir, "minimal")]),
-            mock.call([
-                "diff", "-u",
-                os.path.join("%s-previous" % output_dir, "standard"),
-                os.path.join(output_dir, "standard")]),
-        ])
+        previous_dir = "%s-previous" % output_dir
+        with mkfile(os.path.join(output_dir, "required")) as f:
+            print("base-files", file=f)
+        with mkfile(os.path.join(output_dir, "minimal")) as f:
+            print("adduser\nsudo", file=f)
+        with mkfile(os.path.join(previous_dir, "minimal")) as f:
+            print("adduser", file=f)
+        with mkfile(os.path.join(output_dir, "standard")) as f:
+            print("less", file=f)
+        with mkfile(os.path.join(previous_dir, "standard")) as f:
+            print("less", file=f)
+        return output_dir, previous_dir
+
+    def test_task_diff(self):
+        output_dir, previous_dir = self.write_task_changes()
+        old = os.path.join(previous_dir, "minimal")
+        new = os.path.join(output_dir, "minimal")
+        os.utime(old, (0, 0))
+        output = GerminateOutput(self.config, self.temp_dir)
+        diff = output.task_diff().splitlines()
+        self.assertRegex(diff[0], r"^--- %s\t1970-01-01 " % re.escape(old))
+        self.assertRegex(diff[1], r"^\+\+\+ %s\t" % re.escape(new))
+        self.assertEqual(["@@ -1 +1,2 @@", " adduser", "+sudo"], diff[2:])
+
+    @mock.patch("subprocess.call")
+    def test_diff_tasks(self, mock_call):
+        self.write_task_changes()
+        output = GerminateOutput(self.config, self.temp_dir)
+        diff_path = os.path.join(self.temp_dir, "diff")
+        with open(diff_path, "w") as diff:
+            output.diff_tasks(output=diff)
+        with open(diff_path) as diff:
+            self.assertEqual(output.task_diff(), diff.read())
+        self.assertEqual(0, mock_call.call_count)
 
     @mock.patch("cdimage.germinate.GerminateOutput.diff_tasks")
     def test_update_tasks_no_mail(self, mock_diff_tasks):
@@ -913,6 +1440,55 @@ class TestGerminateOutput(TestCase):
         self.assertCountEqual(
             ["required", "minimal"], os.listdir("%s-previous" % output_dir))
 
+    @mock.patch("cdimage.germinate.GerminateOutput.diff_tasks")
+    def test_update_tasks_records_fingerprint(self, mock_diff_tasks):
+        self.write_ubuntu_structure()
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.config["ARCHES"] = "amd64"
+        output = GerminateOutput(self.config, self.temp_dir)
+        output_dir = output.tasks_output_dir("ubuntu")
+        touch(os.path.join(output_dir, "required"))
+        self.assertIsNone(output.tasks_fingerprint())
+        output.update_tasks("20130319")
+        self.assertFalse(os.path.exists(output.tasks_fingerprint_path()))
+
+        germinate_fingerprint = os.path.join(
+            self.temp_dir, "scratch", "ubuntu", "trusty", "daily-live",
+            "germinate", ".fingerprint")
+        with mkfile(germinate_fingerprint) as f:
+            print("1111", file=f)
+        fingerprint = output.tasks_fingerprint()
+        self.assertIsNotNone(fingerprint)
+        self.assertFalse(output.tasks_are_current(fingerprint))
+        output.update_tasks("20130319")
+        self.assertTrue(output.tasks_are_current(fingerprint))
+        self.config["CDIMAGE_DATE"] = "20130320"
+        self.assertEqual(fingerprint, output.tasks_fingerprint())
+        self.config["CDIMAGE_INSTALL_BASE"] = "1"
+        self.assertNotEqual(fingerprint, output.tasks_fingerprint())
+
+    def test_reuse_tasks(self):
+        self.write_ubuntu_structure()
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        output = GerminateOutput(self.config, self.temp_dir)
+        output_dir = output.tasks_output_dir("ubuntu")
+        touch(os.path.join(output_dir, "required"))
+        touch(os.path.join(output_dir, "minimal"))
+        debian_cd_tasks_dir = os.path.join(
+            self.temp_dir, "debian-cd", "tasks", "auto", "daily-live",
+            "ubuntu", "trusty")
+        touch(os.path.join(debian_cd_tasks_dir, "stale"))
+        output.reuse_tasks()
+        self.assertCountEqual(
+            ["required", "minimal"], os.listdir(debian_cd_tasks_dir))
+        self.assertEqual(
+            os.stat(os.path.join(output_dir, "required")).st_ino,
+            os.stat(os.path.join(debian_cd_tasks_dir, "required")).st_ino)
+
     @mock.patch("cdimage.germinate.send_mail")
     @mock.patch("cdimage.germinate.GerminateOutput.diff_tasks")
     def test_update_tasks_no_recipients(self, mock_diff_tasks, mock_send_mail):
@@ -945,50 +1521,25 @@ class TestGerminateOutput(TestCase):
 
     @mock.patch("cdimage.germinate.send_mail")
     def test_update_tasks_sends_mail(self, mock_send_mail):
-        original_call = subprocess.call
-
-        def call_side_effect(command, *args, **kwargs):
-            if (len(command) >= 4 and command[:2] == ["diff", "-u"] and
-                    "stdout" in kwargs):
-                old = os.path.basename(command[2])
-                new = os.path.basename(command[3])
-                original_call(
-                    ["printf", "%s\\n", "--- %s" % old], *args, **kwargs)
-                original_call(
-                    ["printf", "%s\\n", "+++ %s" % new], *args, **kwargs)
-                return 1
-            else:
-                return original_call(command, *args, **kwargs)
-
-        self.write_ubuntu_structure()
-        self.config["PROJECT"] = "ubuntu"
+        self.write_task_changes()
         self.config["CAPPROJECT"] = "Ubuntu"
-        self.config["DIST"] = "trusty"
-        self.config["IMAGE_TYPE"] = "daily-live"
-        output_dir = os.path.join(
-            self.temp_dir, "scratch", "ubuntu", "trusty", "daily-live",
-            "tasks")
-        touch(os.path.join(output_dir, "required"))
-        touch(os.path.join(output_dir, "minimal"))
-        touch(os.path.join(output_dir, "standard"))
-        touch(os.path.join("%s-previous" % output_dir, "minimal"))
-        touch(os.path.join("%s-previous" % output_dir, "standard"))
         task_mail_path = os.path.join(self.temp_dir, "etc", "task-mail")
         with mkfile(task_mail_path) as task_mail:
             print("foo@example.org", file=task_mail)
         mock_send_mail.side_effect = partial(
             self.send_mail_to_file, os.path.join(self.temp_dir, "mail"))
         output = GerminateOutput(self.config, self.temp_dir)
-        with mock.patch("subprocess.call", side_effect=call_side_effect):
-            output.update_tasks("20130319")
+        diff = output.task_diff()
+        stdout_path = os.path.join(self.temp_dir, "stdout")
+        with open(stdout_path, "w") as stdout:
+            with mock.patch("sys.stdout", stdout):
+                output.update_tasks("20130319")
         with open(os.path.join(self.temp_dir, "mail")) as mail:
             self.assertEqual(dedent("""\
                 To: foo@example.org
                 Subject: Task changes for Ubuntu daily-live/trusty on 20130319
                 X-Generated-By: update-tasks
 
-                --- minimal
-                +++ minimal
-                --- standard
-                +++ standard
-                """), mail.read())
+                """) + diff, mail.read())
+        with open(stdout_path) as stdout:
+            self.assertEqual(diff, stdout.read())
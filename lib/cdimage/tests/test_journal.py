@@ -0,0 +1,123 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.journal."""
+
+from __future__ import print_function
+
+import os
+import shutil
+
+from cdimage.journal import PublishJournal
+from cdimage.tests.helpers import TestCase, mkfile, touch
+
+__metaclass__ = type
+
+
+class TestPublishJournal(TestCase):
+    def setUp(self):
+        super(TestPublishJournal, self).setUp()
+        self.use_temp_dir()
+        self.journal_path = os.path.join(self.temp_dir, ".publish-journal")
+        self.source = os.path.join(self.temp_dir, "daily", "foo.iso")
+        self.target = os.path.join(self.temp_dir, "release", "bar.iso")
+        with mkfile(self.source) as source:
+            print("image", file=source)
+        os.makedirs(os.path.dirname(self.target))
+        shutil.copy2(self.source, self.target)
+
+    def test_missing_journal(self):
+        journal = PublishJournal(self.journal_path)
+        self.assertEqual({}, journal.entries)
+        self.assertFalse(
+            journal.is_complete("copy", self.source, self.target))
+
+    def test_corrupt_journal(self):
+        with mkfile(self.journal_path) as journal:
+            print("{truncated", file=journal)
+        self.assertEqual({}, PublishJournal(self.journal_path).entries)
+
+    def test_round_trip(self):
+        PublishJournal(self.journal_path).record(
+            "copy", self.source, self.target)
+        journal = PublishJournal(self.journal_path)
+        self.assertTrue(journal.is_complete("copy", self.source, self.target))
+        self.assertFalse(
+            journal.is_complete("zsync", self.source, self.target))
+        self.assertFalse(journal.is_complete("copy", self.target, self.target))
+
+    def test_source_changed(self):
+        journal = PublishJournal(self.journal_path)
+        journal.record("copy", self.source, self.target)
+        with mkfile(self.source, mode="a") as source:
+            print("respun", file=source)
+        self.assertFalse(
+            journal.is_complete("copy", self.source, self.target))
+
+    def test_target_changed(self):
+        journal = PublishJournal(self.journal_path)
+        journal.record("copy", self.source, self.target)
+        os.unlink(self.target)
+        self.assertFalse(
+            journal.is_complete("copy", self.source, self.target))
+        with mkfile(self.target) as target:
+            print("partial", file=target)
+        self.assertFalse(
+            journal.is_complete("copy", self.source, self.target))
+
+    def test_dry_run(self):
+        journal = PublishJournal(self.journal_path, dry_run=True)
+        journal.record("copy", self.source, self.target)
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertFalse(
+            journal.is_complete("copy", self.source, self.target))
+
+    def test_write_drops_removed_targets(self):
+        other = os.path.join(self.temp_dir, "release", "other.iso")
+        touch(other)
+        journal = PublishJournal(self.journal_path)
+        journal.record("copy", self.source, other)
+        os.unlink(other)
+        journal.record("copy", self.source, self.target)
+        self.assertEqual(
+            [self.target], list(PublishJournal(self.journal_path).entries))
+
+    def test_forget(self):
+        journal = PublishJournal(self.journal_path)
+        journal.record("copy", self.source, self.target)
+        journal.forget(self.target)
+        self.assertEqual({}, PublishJournal(self.journal_path).entries)
+
+    def test_record_appends(self):
+        journal = PublishJournal(self.journal_path)
+        with open(self.journal_path) as f:
+            before = f.read()
+        journal.record("copy", self.source, self.target)
+        with open(self.journal_path) as f:
+            after = f.read()
+        self.assertTrue(after.startswith(before))
+        self.assertEqual(1, after[len(before):].count("\n"))
+
+    def test_truncated_record(self):
+        PublishJournal(self.journal_path).record(
+            "copy", self.source, self.target)
+        with mkfile(self.journal_path, mode="a") as journal:
+            journal.write('{"target": "trunc')
+        journal = PublishJournal(self.journal_path)
+        self.assertEqual([self.target], list(journal.entries))
+        # Loading the journal compacts it.
+        with open(self.journal_path) as f:
+            self.assertEqual(2, len(f.read().splitlines()))
@@ -0,0 +1,296 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.launchpad."""
+
+from datetime import datetime, timedelta
+import os
+import threading
+from unittest import skipUnless
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.launchpad import (
+    LiveFSBuildPoller,
+    NotFound,
+    _CachingDict,
+    _CachingLiveFS,
+    _LatestBuildCache,
+    _LinkCache,
+    launchpad_available,
+    link_cache_summary,
+)
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+def make_build(self_link, buildstate="Needs building"):
+    return mock.Mock(self_link=self_link, buildstate=buildstate)
+
+
+class TestLinkCache(TestCase):
+    def setUp(self):
+        super(TestLinkCache, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, ".launchpad-links.sqlite")
+        self.lp = mock.Mock(_root_uri="https://api.launchpad.test/devel/")
+
+    def test_get_set(self):
+        cache = _LinkCache(self.path, self.lp)
+        self.assertIsNone(cache.get("person", "ubuntu-cdimage"))
+        cache.set("https://lp/~ubuntu-cdimage", "person", "ubuntu-cdimage")
+        other = _LinkCache(self.path, self.lp)
+        self.assertEqual(
+            "https://lp/~ubuntu-cdimage",
+            other.get("person", "ubuntu-cdimage"))
+        self.assertEqual("0 hits, 1 misses", cache.summary())
+        self.assertEqual("1 hits, 0 misses", other.summary())
+
+    def test_threads(self):
+        cache = _LinkCache(self.path, self.lp)
+        cache.set("https://lp/ubuntu", "distribution", "ubuntu")
+        result = {}
+
+        def other_thread():
+            result["link"] = cache.get("distribution", "ubuntu")
+            cache.set("https://lp/debian", "distribution", "debian")
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual("https://lp/ubuntu", result["link"])
+        self.assertEqual(
+            "https://lp/debian", cache.get("distribution", "debian"))
+        self.assertEqual("2 hits, 0 misses", cache.summary())
+
+    def test_separate_instances(self):
+        cache = _LinkCache(self.path, self.lp)
+        cache.set("https://lp/ubuntu", "distribution", "ubuntu")
+        dogfood = mock.Mock(_root_uri="https://api.dogfood.test/devel/")
+        self.assertIsNone(
+            _LinkCache(self.path, dogfood).get("distribution", "ubuntu"))
+
+    def test_expiry(self):
+        cache = _LinkCache(self.path, self.lp, ttl=60)
+        with mock.patch("time.time", return_value=1000):
+            cache.set("https://lp/ubuntu", "distribution", "ubuntu")
+        with mock.patch("time.time", return_value=1059):
+            self.assertIsNotNone(cache.get("distribution", "ubuntu"))
+        with mock.patch("time.time", return_value=1060):
+            self.assertIsNone(cache.get("distribution", "ubuntu"))
+
+    def test_link_cache_summary(self):
+        self.assertIsNone(link_cache_summary())
+        cache = _LinkCache(self.path, self.lp)
+        cache.get("distribution", "ubuntu")
+        with mock.patch(
+                "cdimage.launchpad.launchpad_cache",
+                mock.Mock(link_cache=cache)):
+            self.assertEqual("0 hits, 1 misses", link_cache_summary())
+
+    def test_resolve(self):
+        cache = _LinkCache(self.path, self.lp)
+        item = mock.Mock(self_link="https://lp/ubuntu")
+        lookup = mock.Mock(return_value=item)
+        self.assertIs(item, cache.resolve(lookup, "distribution", "ubuntu"))
+        lookup.assert_called_once_with()
+        self.assertEqual(0, self.lp.load.call_count)
+        self.assertEqual(
+            self.lp.load.return_value,
+            cache.resolve(lookup, "distribution", "ubuntu"))
+        self.lp.load.assert_called_once_with("https://lp/ubuntu")
+        self.assertEqual(1, lookup.call_count)
+
+    def test_resolve_stale(self):
+        cache = _LinkCache(self.path, self.lp)
+        cache.set("https://lp/old", "distribution", "ubuntu")
+        self.lp.load.side_effect = NotFound
+        item = mock.Mock(self_link="https://lp/ubuntu")
+        self.assertIs(
+            item, cache.resolve(lambda: item, "distribution", "ubuntu"))
+        self.lp.load.side_effect = None
+        self.assertEqual(
+            "https://lp/ubuntu", cache.get("distribution", "ubuntu"))
+
+    def test_resolve_gone(self):
+        cache = _LinkCache(self.path, self.lp)
+        cache.set("https://lp/old", "distribution", "ubuntu")
+        self.lp.load.side_effect = NotFound
+        self.assertIsNone(
+            cache.resolve(lambda: None, "distribution", "ubuntu"))
+        self.assertIsNone(cache.get("distribution", "ubuntu"))
+
+
+class TestCachingDict(TestCase):
+    def test_link_cache(self):
+        self.use_temp_dir()
+        lp = mock.Mock(_root_uri="https://api.launchpad.test/devel/")
+        link_cache = _LinkCache(
+            os.path.join(self.temp_dir, ".launchpad-links.sqlite"), lp)
+        person = mock.Mock(self_link="https://lp/~ubuntu-cdimage")
+        people = {"ubuntu-cdimage": person}
+        self.assertIs(
+            person,
+            _CachingDict(people, link_cache=link_cache, kind="person")[
+                "ubuntu-cdimage"])
+        self.assertEqual(
+            lp.load.return_value,
+            _CachingDict({}, link_cache=link_cache, kind="person")[
+                "ubuntu-cdimage"])
+        lp.load.assert_called_once_with("https://lp/~ubuntu-cdimage")
+
+
+class TestLatestBuildCache(TestCase):
+    def setUp(self):
+        super(TestLatestBuildCache, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, ".livefs-latest-builds")
+        self.livefs = mock.Mock(self_link="https://lp/livefs")
+        self.das = mock.Mock(self_link="https://lp/ubuntu/xenial/amd64")
+        self.lp = mock.Mock()
+
+    def test_missing(self):
+        cache = _LatestBuildCache(self.path, self.lp)
+        self.assertIsNone(cache.get(self.livefs, self.das))
+
+    def test_persists(self):
+        build = make_build("https://lp/livefs/+build/1", "Successfully built")
+        build.date_started = datetime(2026, 1, 1, 6, 0, 0)
+        build.date_finished = build.date_started + timedelta(minutes=40)
+        _LatestBuildCache(self.path, self.lp).set(
+            self.livefs, self.das, None, build)
+        cache = _LatestBuildCache(self.path, self.lp)
+        self.assertEqual(
+            {"build": "https://lp/livefs/+build/1", "duration": 2400.0},
+            cache.get(self.livefs, self.das))
+        self.assertIsNone(cache.get(self.livefs, self.das, unique_key="x"))
+
+    def test_missing_dates(self):
+        build = make_build("https://lp/livefs/+build/1", "Successfully built")
+        build.date_started = None
+        build.date_finished = None
+        cache = _LatestBuildCache(self.path, self.lp)
+        cache.set(self.livefs, self.das, None, build)
+        self.assertIsNone(cache.get(self.livefs, self.das)["duration"])
+
+    def make_latest_build(self, buildstate="Successfully built",
+                          unique_key=None):
+        build = make_build("https://lp/livefs/+build/1", buildstate)
+        build.distro_arch_series_link = self.das.self_link
+        build.unique_key = unique_key
+        build.date_started = build.date_finished = None
+        return build
+
+    def test_load(self):
+        build = self.make_latest_build()
+        cache = _LatestBuildCache(self.path, self.lp)
+        cache.set(self.livefs, self.das, None, build)
+        self.lp.load.return_value = build
+        self.assertIs(build, cache.load(self.livefs, self.das))
+        self.lp.load.assert_called_once_with("https://lp/livefs/+build/1")
+
+    def test_load_missing(self):
+        cache = _LatestBuildCache(self.path, self.lp)
+        cache.set(self.livefs, self.das, None, self.make_latest_build())
+        self.lp.load.side_effect = NotFound
+        self.assertIsNone(cache.load(self.livefs, self.das))
+
+    def test_load_no_longer_successful(self):
+        build = self.make_latest_build()
+        cache = _LatestBuildCache(self.path, self.lp)
+        cache.set(self.livefs, self.das, None, build)
+        self.lp.load.return_value = self.make_latest_build(
+            buildstate="Failed to build")
+        self.assertIsNone(cache.load(self.livefs, self.das))
+
+    @skipUnless(launchpad_available, "launchpadlib not available")
+    def test_get_latest_build_uses_cache(self):
+        build = self.make_latest_build()
+        cache = _LatestBuildCache(self.path, self.lp)
+        cache.set(self.livefs, self.das, None, build)
+        self.lp.load.return_value = build
+        self.das.architecture_tag = "amd64"
+        completed_builds = mock.PropertyMock(return_value=[])
+        type(self.livefs).completed_builds = completed_builds
+        livefs = _CachingLiveFS(
+            mock.Mock(), self.livefs, latest_builds=cache)
+        self.assertIs(build, livefs.getLatestBuild(self.das))
+        self.assertEqual(0, completed_builds.call_count)
+
+    @skipUnless(launchpad_available, "launchpadlib not available")
+    def test_get_latest_build_scans(self):
+        build = self.make_latest_build()
+        self.das.architecture_tag = "amd64"
+        self.livefs.completed_builds = [
+            self.make_latest_build(buildstate="Failed to build"), build]
+        cache = _LatestBuildCache(self.path, self.lp)
+        livefs = _CachingLiveFS(
+            mock.Mock(), self.livefs, latest_builds=cache)
+        self.assertIs(build, livefs.getLatestBuild(self.das))
+        self.assertEqual(
+            "https://lp/livefs/+build/1",
+            _LatestBuildCache(self.path, self.lp).get(
+                self.livefs, self.das)["build"])
+
+
+class TestLiveFSBuildPoller(TestCase):
+    def test_refresh_only_finished_builds(self):
+        livefs = mock.Mock(self_link="https://lp/livefs")
+        pending = make_build("https://lp/livefs/+build/1")
+        finished = make_build("https://lp/livefs/+build/2")
+        livefs.pending_builds = [make_build("https://lp/livefs/+build/1")]
+        poller = LiveFSBuildPoller()
+        poller.add(livefs, pending)
+        poller.add(livefs, finished)
+        poller.refresh()
+        self.assertEqual(0, pending.lp_refresh.call_count)
+        finished.lp_refresh.assert_called_once_with()
+
+    def test_refresh_queries_each_livefs_once(self):
+        livefses = [
+            mock.Mock(self_link="https://lp/livefs-%d" % i) for i in range(2)]
+        pending_builds = []
+        for livefs in livefses:
+            pending_builds.append(mock.PropertyMock(return_value=[]))
+            type(livefs).pending_builds = pending_builds[-1]
+        poller = LiveFSBuildPoller()
+        for i in range(6):
+            poller.add(livefses[i % 2], make_build("https://lp/+build/%d" % i))
+        poller.refresh()
+        for prop in pending_builds:
+            prop.assert_called_once_with()
+
+    def test_interval_unknown_duration(self):
+        poller = LiveFSBuildPoller(min_interval=15, max_interval=300)
+        poller.add(mock.Mock(), make_build("https://lp/+build/1"))
+        self.assertEqual(15, poller.interval())
+
+    @mock.patch("time.time", return_value=1000)
+    def test_interval_backs_off(self, mock_time):
+        poller = LiveFSBuildPoller(min_interval=15, max_interval=300)
+        build = make_build("https://lp/+build/1")
+        poller.add(mock.Mock(), build, expected_duration=3600)
+        self.assertEqual(300, poller.interval())
+        mock_time.return_value = 1000 + 3600 - 100
+        self.assertEqual(50, poller.interval())
+        mock_time.return_value = 1000 + 3600 + 100
+        self.assertEqual(15, poller.interval())
+        poller.remove(build)
+        self.assertEqual(300, poller.interval())
@@ -24,6 +24,7 @@ from itertools import chain, repeat
 import os
 import subprocess
 from textwrap import dedent
+import threading
 import time
 try:
     from urllib.request import urlopen
@@ -40,7 +41,11 @@ from cdimage import osextras
 from cdimage.config import Config, all_series
 from cdimage.launchpad import get_launchpad, launchpad_available
 from cdimage.livefs import (
+    ArtefactCatalog,
     LiveBuildsFailed,
+    LiveDownloads,
+    NoFilesystemImages,
+    clean_live_output_directory,
     download_live_filesystems,
     download_live_items,
     flavours,
@@ -559,9 +564,12 @@ class TestRunLiveBuilds(TestCase):
         mock_tracker_set_rebuild_status.assert_has_calls([
             mock.call(self.config, [0, 1], 2, "amd64"),
             mock.call(self.config, [0, 1], 2, "i386"),
+        ])
+        # Builds are reported as they finish, in whichever order that is.
+        mock_tracker_set_rebuild_status.assert_has_calls([
             mock.call(self.config, [0, 1, 2], 3, "amd64"),
             mock.call(self.config, [0, 1, 2], 3, "i386"),
-        ])
+        ], any_order=True)
         expected_command_base = [
             "ssh", "-n", "-o", "StrictHostKeyChecking=no",
             "-o", "BatchMode=yes",
@@ -655,6 +663,31 @@ class TestRunLiveBuilds(TestCase):
                 "LiveFS ubuntu/trusty/i386 failed to build on 20130315",
                 "buildlive", ["foo@example.org"], b"Log data\n")
 
+    @mock_strftime(1363355331)
+    @mock.patch("cdimage.livefs.urlopen", mock_urlopen(b"Log data\n"))
+    @mock.patch("cdimage.livefs.tracker_set_rebuild_status")
+    @mock.patch("cdimage.livefs.send_mail")
+    def test_run_live_builds_on_success(self, *args):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily"
+        self.config["ARCHES"] = "amd64 i386"
+        self.capture_logging()
+        original_Popen = subprocess.Popen
+        on_success = mock.Mock()
+        with mock.patch("subprocess.Popen") as mock_popen:
+            def Popen_side_effect(command, *args, **kwargs):
+                if "amd64" in command:
+                    return original_Popen(["true"])
+                else:
+                    return original_Popen(["false"])
+
+            mock_popen.side_effect = Popen_side_effect
+            self.assertCountEqual(
+                ["amd64"],
+                run_live_builds(self.config, on_success=on_success))
+        on_success.assert_called_once_with("amd64")
+
     @skipUnless(launchpad_available, "launchpadlib not available")
     @mock_strftime(1363355331)
     @mock.patch("time.sleep")
@@ -916,6 +949,83 @@ class TestFlavours(TestCase):
             self.assertFlavoursEqual("sparc64", "sparc", "ubuntu", series)
 
 
+class TestArtefactCatalog(TestCase):
+    def setUp(self):
+        super(TestArtefactCatalog, self).setUp()
+        self.config = Config(read=False)
+        self.config.root = self.use_temp_dir()
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "xenial"
+        self.artefacts_dir = os.path.join(self.temp_dir, "artefacts")
+        self.config["LIVECD_BASE"] = self.artefacts_dir
+        for name in (
+            "livecd.ubuntu.squashfs", "livecd.ubuntu.manifest",
+            "livecd.ubuntu.kernel-generic", "livecd.ubuntu.initrd-generic",
+        ):
+            touch(os.path.join(self.artefacts_dir, name))
+
+    def test_lists_once(self):
+        catalog = ArtefactCatalog(self.config, "amd64")
+        with mock.patch("os.listdir", side_effect=os.listdir) as listdir:
+            for item in ("squashfs", "manifest", "kernel", "initrd"):
+                list(live_item_paths(
+                    self.config, "amd64", item, catalog=catalog))
+        listdir.assert_called_once_with(self.artefacts_dir)
+
+    def test_urls_for(self):
+        catalog = ArtefactCatalog(self.config, "amd64")
+        self.assertEqual(
+            [os.path.join(self.artefacts_dir, "livecd.ubuntu.kernel-generic")],
+            catalog.urls_for("livecd.ubuntu", "kernel-generic"))
+        self.assertEqual([], catalog.urls_for("livecd.ubuntu", "ext4"))
+        # Callers may modify the returned list without affecting the cache.
+        catalog.urls_for("livecd.ubuntu", "squashfs").append("extra")
+        self.assertEqual(
+            [os.path.join(self.artefacts_dir, "livecd.ubuntu.squashfs")],
+            catalog.urls_for("livecd.ubuntu", "squashfs"))
+
+    def test_urls_for_unlistable(self):
+        self.config["LIVECD_BASE"] = "http://example.org/live"
+        catalog = ArtefactCatalog(self.config, "amd64")
+        self.assertEqual(
+            ["http://example.org/live/livecd.ubuntu.squashfs"],
+            catalog.urls_for("livecd.ubuntu", "squashfs"))
+        self.assertFalse(catalog.listed)
+
+    def test_load(self):
+        catalog = ArtefactCatalog(self.config, "amd64")
+        self.assertFalse(catalog.listed)
+        catalog.load()
+        self.assertTrue(catalog.listed)
+
+    def test_live_item_paths_catalog(self):
+        catalog = ArtefactCatalog(self.config, "amd64")
+        self.assertEqual(
+            [os.path.join(self.artefacts_dir, "livecd.ubuntu.squashfs")],
+            list(live_item_paths(
+                self.config, "amd64", "squashfs", catalog=catalog)))
+        self.assertEqual(
+            list(live_item_paths(self.config, "amd64", "kernel")),
+            list(live_item_paths(
+                self.config, "amd64", "kernel", catalog=catalog)))
+
+    def test_touch_items(self):
+        catalog = ArtefactCatalog(self.config, "armhf")
+        self.assertEqual("boot", catalog.touch_items["boot-armhf+mako.img"])
+        self.assertEqual(
+            "recovery", catalog.touch_items["recovery-armel+mako.img"])
+        self.assertEqual(
+            "system", catalog.touch_items["system-armel+mako.img"])
+        self.assertEqual({}, ArtefactCatalog(self.config, "amd64").touch_items)
+
+    def test_all_items(self):
+        items = ArtefactCatalog(self.config, "amd64").all_items()
+        self.assertIn("squashfs", items)
+        self.assertIn("kernel", items)
+        self.assertIn("wubi", items)
+        self.assertEqual(len(items), len(set(items)))
+
+
 class TestLiveItemPaths(TestCase):
     def setUp(self):
         super(TestLiveItemPaths, self).setUp()
@@ -1254,6 +1364,25 @@ class TestDownloadLiveFilesystems(TestCase):
             download_live_items(self.config, "amd64", item))
         self.assertCountEqual(mock_fetch.call_args_list, calls)
 
+    @mock.patch("cdimage.sign.sign_cdimage")
+    def test_download_live_items_local_squashfs(self, mock_sign):
+        artefacts_dir = os.path.join(self.temp_dir, "artefacts")
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "bionic"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.config["LIVECD"] = artefacts_dir
+        source = os.path.join(
+            artefacts_dir, "bionic", "ubuntu", "current",
+            "livecd.ubuntu.squashfs")
+        touch(source)
+        output_dir = os.path.join(
+            self.temp_dir, "scratch", "ubuntu", "bionic", "daily-live", "live")
+        os.makedirs(output_dir)
+        self.assertTrue(download_live_items(self.config, "amd64", "squashfs"))
+        target = os.path.join(output_dir, "amd64.squashfs")
+        self.assertEqual(os.stat(source).st_ino, os.stat(target).st_ino)
+        mock_sign.assert_called_once_with(self.config, target)
+
     def test_download_live_items_installer_squashfs(self):
         self.assert_server_live_download_items(
             "bionic", "squashfs", ["installer.squashfs"])
@@ -1313,6 +1442,20 @@ class TestDownloadLiveFilesystems(TestCase):
                 # instance
                 "amd64.squashfs"))
 
+    def test_clean_live_output_directory(self):
+        output_dir = os.path.join(self.temp_dir, "live")
+        clean_live_output_directory(output_dir)
+        self.assertEqual([], os.listdir(output_dir))
+        for name in (
+            "amd64.squashfs", "amd64.manifest", "i386.squashfs.part",
+            "i386.squashfs.part.json", "old/amd64.kernel-generic",
+        ):
+            touch(os.path.join(output_dir, name))
+        clean_live_output_directory(output_dir)
+        self.assertEqual(
+            ["i386.squashfs.part", "i386.squashfs.part.json"],
+            sorted(os.listdir(output_dir)))
+
     def test_write_autorun(self):
         self.config["PROJECT"] = "ubuntu"
         self.config["DIST"] = "trusty"
@@ -1392,3 +1535,95 @@ class TestDownloadLiveFilesystems(TestCase):
         for name in "amd64.autorun.inf", "i386.autorun.inf":
             with open(os.path.join(output_dir, name), "rb") as autorun:
                 self.assertEqual(autorun_contents, autorun.read())
+
+    @mock.patch("cdimage.osextras.fetch")
+    def test_live_downloads_start_early(self, mock_fetch):
+        def fetch_side_effect(config, source, target):
+            if target.endswith(".squashfs"):
+                touch(target)
+            else:
+                raise osextras.FetchError
+
+        mock_fetch.side_effect = fetch_side_effect
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.config["ARCHES"] = "amd64 i386"
+        self.config["CDIMAGE_LIVE"] = "1"
+        output_dir = live_output_directory(self.config)
+        downloads = LiveDownloads(self.config)
+        downloads.start("i386")
+        downloads.threads["i386"].join()
+        self.assertEqual(["i386.squashfs"], os.listdir(output_dir))
+        # Starting an architecture again does nothing.
+        downloads.start("i386")
+        download_live_filesystems(self.config, downloads=downloads)
+        self.assertCountEqual(
+            ["amd64.squashfs", "i386.squashfs"], os.listdir(output_dir))
+        squashfs_fetches = [
+            call for call in mock_fetch.call_args_list
+            if call[0][2].endswith(".squashfs")]
+        self.assertEqual(2, len(squashfs_fetches))
+
+    @mock.patch("cdimage.osextras.fetch", side_effect=osextras.FetchError)
+    def test_live_downloads_list_in_caller(self, mock_fetch):
+        # Artefacts are listed in the calling thread, not the job threads.
+        self.config["PROJECT"] = "edubuntu"
+        self.config["DIST"] = "precise"
+        self.config["IMAGE_TYPE"] = "dvd"
+        self.config["ARCHES"] = "amd64"
+        self.config["CDIMAGE_LIVE"] = "1"
+        self.config["CDIMAGE_DVD"] = "1"
+        listed = []
+
+        def list_artefacts(catalog):
+            listed.append((catalog.arch, threading.current_thread()))
+            catalog._filenames = []
+
+        with mock.patch.object(
+                ArtefactCatalog, "_list_artefacts", autospec=True,
+                side_effect=list_artefacts):
+            downloads = LiveDownloads(self.config)
+            downloads.start("amd64")
+            self.assertRaises(NoFilesystemImages, downloads.finish)
+        self.assertEqual(
+            [("amd64", threading.current_thread()),
+             ("i386", threading.current_thread())],
+            listed)
+
+    def test_live_downloads_limit(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.config["ARCHES"] = "amd64 arm64 i386"
+        self.config["CDIMAGE_LIVE_DOWNLOAD_JOBS"] = "2"
+        lock = threading.Lock()
+        active = []
+        max_active = []
+
+        def download_arch(arch):
+            with lock:
+                active.append(arch)
+                max_active.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(arch)
+            return True
+
+        downloads = LiveDownloads(self.config)
+        downloads.download_arch = download_arch
+        downloads.finish()
+        self.assertEqual(2, max(max_active))
+        self.assertEqual(
+            {"amd64": True, "arm64": True, "i386": True}, downloads.results)
+
+    @mock.patch("cdimage.osextras.fetch", side_effect=osextras.FetchError)
+    def test_live_downloads_no_images(self, mock_fetch):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = "trusty"
+        self.config["IMAGE_TYPE"] = "daily-live"
+        self.config["ARCHES"] = "amd64 i386"
+        self.config["CDIMAGE_LIVE"] = "1"
+        downloads = LiveDownloads(self.config)
+        downloads.start("amd64")
+        self.assertRaises(NoFilesystemImages, downloads.finish)
@@ -0,0 +1,91 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.locking."""
+
+from __future__ import print_function
+
+import os
+import threading
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.locking import Lock, LockTimeout, _boot_id
+from cdimage.tests.helpers import TestCase, mkfile
+
+__metaclass__ = type
+
+
+class TestLock(TestCase):
+    def setUp(self):
+        super(TestLock, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, "etc", ".lock-test")
+
+    def test_context_manager(self):
+        """The lock file exists exactly while the lock is held."""
+        lock = Lock(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        with lock:
+            self.assertTrue(lock.held)
+            self.assertTrue(os.path.exists(self.path))
+            self.assertEqual((os.getpid(), _boot_id()), lock.holder())
+        self.assertFalse(lock.held)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_held_elsewhere(self):
+        with Lock(self.path):
+            lock = Lock(self.path, timeout=0)
+            self.assertRaisesRegex(
+                LockTimeout, "held by pid %d" % os.getpid(), lock.acquire)
+            self.assertFalse(lock.held)
+            self.assertRaises(LockTimeout, lock.acquire, timeout=0.1)
+        self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch("cdimage.osextras.pid_exists", return_value=False)
+    def test_held_by_orphan(self, mock_pid_exists):
+        with Lock(self.path):
+            self.assertRaisesRegex(
+                LockTimeout,
+                "held by a child of pid %d, which is no longer running" % (
+                    os.getpid()),
+                Lock(self.path).acquire, timeout=0)
+
+    def test_stale_file(self):
+        """A lock file left behind by a dead process does not block."""
+        with mkfile(self.path) as stale:
+            print("999999 %s" % _boot_id(), file=stale)
+        with Lock(self.path, timeout=0) as lock:
+            self.assertEqual((os.getpid(), _boot_id()), lock.holder())
+
+    @mock.patch("cdimage.locking.LOG_WAIT_THRESHOLD", 0.05)
+    def test_wakes_on_release(self):
+        """Waiters take the lock as soon as it is released."""
+        self.capture_logging()
+        holder = Lock(self.path)
+        holder.acquire()
+        timer = threading.Timer(0.1, holder.release)
+        timer.start()
+        self.addCleanup(timer.join)
+        with Lock(self.path, timeout=60) as lock:
+            self.assertFalse(holder.held)
+            self.assertTrue(os.path.exists(self.path))
+            self.assertEqual((os.getpid(), _boot_id()), lock.holder())
+        # Long waits are logged.
+        self.assertLogEqual(["Waited 0 seconds for lock %s" % self.path])
@@ -26,6 +26,7 @@ try:
 except ImportError:
     import mock
 
+from cdimage.locking import Lock
 from cdimage.multipidfile import MultiPIDFile, MultiPIDFileError
 from cdimage.tests.helpers import TestCase, mkfile
 
@@ -50,10 +51,11 @@ class TestMultiPIDFile(TestCase):
             self.assertTrue(os.path.exists(self.multipidfile.lock_path))
         self.assertFalse(os.path.exists(self.multipidfile.lock_path))
 
-    @mock.patch("subprocess.call", return_value=1)
-    def test_lock_failure(self, mock_call):
+    def test_lock_failure(self):
         """__enter__ raises MultiPIDFileError if the lock is already held."""
-        self.assertRaises(MultiPIDFileError, self.multipidfile.__enter__)
+        self.multipidfile.lock.timeout = 0
+        with Lock(self.multipidfile.lock_path):
+            self.assertRaises(MultiPIDFileError, self.multipidfile.__enter__)
 
     def test_read_requires_lock(self):
         """_read must be called within the lock."""
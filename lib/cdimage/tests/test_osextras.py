@@ -21,7 +21,9 @@ from __future__ import print_function
 
 import errno
 import os
+import subprocess
 from textwrap import dedent
+import time
 
 try:
     from unittest import mock
@@ -92,6 +94,35 @@ class TestOSExtras(TestCase):
         os.mkdir(path)
         self.assertRaises(OSError, osextras.unlink_force, path)
 
+    def test_write_lines(self):
+        path = os.path.join(self.temp_dir, "file")
+        osextras.write_lines(path, ["a", "b"])
+        osextras.write_lines(path, ["c"], mode="a")
+        with open(path) as f:
+            self.assertEqual("a\nb\nc\n", f.read())
+
+    def test_rename_exchange(self):
+        old = os.path.join(self.temp_dir, "old")
+        new = os.path.join(self.temp_dir, "new")
+        touch(os.path.join(old, "a"))
+        touch(os.path.join(new, "b"))
+        try:
+            osextras.rename_exchange(old, new)
+        except OSError as e:
+            if e.errno in (errno.ENOSYS, errno.EINVAL):
+                self.skipTest("RENAME_EXCHANGE not supported")
+            raise
+        self.assertEqual(["b"], os.listdir(old))
+        self.assertEqual(["a"], os.listdir(new))
+
+    def test_rename_exchange_missing(self):
+        old = os.path.join(self.temp_dir, "old")
+        os.mkdir(old)
+        self.assertRaises(
+            OSError, osextras.rename_exchange,
+            old, os.path.join(self.temp_dir, "missing"))
+        self.assertTrue(os.path.isdir(old))
+
     def test_symlink_file_present(self):
         path = os.path.join(self.temp_dir, "link")
         touch(path)
@@ -185,19 +216,44 @@ class TestOSExtras(TestCase):
         touch(target)
         self.assertRaises(
             osextras.FetchError, osextras.fetch, config,
-            "http://example.org/source", target)
+            "ftp://example.org/source", target)
         self.assertFalse(os.path.exists(target))
 
     @mock.patch("subprocess.call", return_value=0)
     def test_fetch_url(self, mock_call):
         config = Config(read=False)
         target = os.path.join(self.temp_dir, "target")
-        osextras.fetch(config, "http://example.org/source", target)
+        osextras.fetch(config, "ftp://example.org/source", target)
         self.assertEqual(1, mock_call.call_count)
         self.assertEqual(
-            ["wget", "-nv", "http://example.org/source", "-O", target],
+            ["wget", "-nv", "ftp://example.org/source", "-O", target],
             mock_call.call_args[0][0])
 
+    @mock.patch("subprocess.call")
+    @mock.patch("cdimage.download.Downloader.fetch")
+    def test_fetch_http_url(self, mock_fetch, mock_call):
+        config = Config(read=False)
+        config.root = self.temp_dir
+        target = os.path.join(self.temp_dir, "target")
+        osextras.fetch(config, "http://example.org/source", target)
+        mock_fetch.assert_called_once_with(
+            "http://example.org/source", target)
+        self.assertEqual(0, mock_call.call_count)
+
+    def test_child_watcher(self):
+        watcher = osextras.ChildWatcher()
+        try:
+            proc = subprocess.Popen(["true"])
+            watcher.add(proc)
+            start = time.time()
+            while proc.poll() is None:
+                self.assertLess(time.time() - start, 10)
+                watcher.wait(10)
+            watcher.remove(proc)
+            self.assertEqual({}, watcher.pidfds)
+        finally:
+            watcher.close()
+
     def test_read_shell_config(self):
         os.environ["ONE"] = "one"
         config_path = os.path.join(self.temp_dir, "config")
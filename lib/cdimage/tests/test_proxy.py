@@ -23,7 +23,12 @@ import os
 import subprocess
 
 from cdimage.config import Config
-from cdimage.proxy import _select_proxy, proxy_call, proxy_check_call
+from cdimage.proxy import (
+    _select_proxy,
+    proxy_call,
+    proxy_check_call,
+    proxy_env,
+)
 from cdimage.tests.helpers import TestCase, mkfile
 
 
@@ -94,3 +99,15 @@ class TestProxy(TestCase):
         self.assertRaises(
             subprocess.CalledProcessError,
             proxy_check_call, self.config, "any-caller", ["false"])
+
+    def test_env(self):
+        env = {"http_proxy": "http://set.example.org:3128/", "HOME": "/"}
+        with mkfile(self.config_path) as f:
+            print("set\thttp://foo.example.org:3128/", file=f)
+            print("unset\tunset", file=f)
+        self.assertEqual(
+            {"http_proxy": "http://foo.example.org:3128/", "HOME": "/"},
+            proxy_env(self.config, "set", env))
+        self.assertEqual({"HOME": "/"}, proxy_env(self.config, "unset", env))
+        self.assertEqual(env, proxy_env(self.config, "other", env))
+        self.assertEqual("http://set.example.org:3128/", env["http_proxy"])
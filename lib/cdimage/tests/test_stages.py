@@ -0,0 +1,141 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.stages."""
+
+import signal
+import subprocess
+import threading
+import time
+
+from cdimage.stages import StageGraph
+from cdimage.tests.helpers import TestCase
+
+__metaclass__ = type
+
+
+class TestStageGraph(TestCase):
+    def test_serial(self):
+        calls = []
+        stages = StageGraph()
+        stages.add("one", lambda: calls.append("one"))
+        stages.add("two", lambda: calls.append("two"), requires=["one"])
+        stages.add("three", lambda: calls.append("three"))
+        stages.run(jobs=1)
+        self.assertEqual(["one", "two", "three"], calls)
+        self.assertEqual(["one", "two", "three"], list(stages.timings))
+
+    def test_missing_requirements_ignored(self):
+        stages = StageGraph()
+        stages.add("one", lambda: None, requires=["absent"])
+        self.assertEqual([], stages.stages["one"].requires)
+
+    def test_concurrent(self):
+        # "slow" can only finish once "fast" has started, so this would
+        # deadlock if independent stages were not run concurrently.
+        fast_started = threading.Event()
+        calls = []
+
+        def slow():
+            self.assertTrue(fast_started.wait(10))
+            calls.append("slow")
+
+        def fast():
+            fast_started.set()
+            calls.append("fast")
+
+        stages = StageGraph()
+        stages.add("slow", slow)
+        stages.add("fast", fast)
+        stages.add(
+            "last", lambda: calls.append("last"), requires=["slow", "fast"])
+        stages.run(jobs=4)
+        self.assertEqual(["fast", "slow", "last"], calls)
+        self.assertCountEqual(["slow", "fast", "last"], stages.timings)
+
+    def test_failure(self):
+        calls = []
+
+        def fail():
+            raise ValueError("stage failed")
+
+        stages = StageGraph()
+        stages.add("fail", fail)
+        stages.add("other", lambda: calls.append("other"))
+        stages.add("after", lambda: calls.append("after"), requires=["fail"])
+        self.assertRaisesRegex(ValueError, "stage failed", stages.run, jobs=4)
+        self.assertNotIn("after", calls)
+        self.assertIn("fail", stages.timings)
+
+    def test_main_thread(self):
+        # "other" is started before "main" blocks the calling thread.
+        other_started = threading.Event()
+        threads = {}
+
+        def main():
+            self.assertTrue(other_started.wait(10))
+            threads["main"] = threading.current_thread()
+
+        def other():
+            other_started.set()
+            threads["other"] = threading.current_thread()
+
+        stages = StageGraph()
+        stages.add("main", main, main_thread=True)
+        stages.add("other", other)
+        stages.run(jobs=4)
+        self.assertIs(threading.current_thread(), threads["main"])
+        self.assertIsNot(threading.current_thread(), threads["other"])
+
+    def test_interrupted_stops_stages(self):
+        started = threading.Event()
+        result = {}
+
+        def interrupted():
+            self.assertTrue(started.wait(10))
+            raise KeyboardInterrupt
+
+        def slow():
+            process = subprocess.Popen(["sleep", "60"])
+            started.set()
+            result["returncode"] = process.wait()
+
+        stages = StageGraph()
+        stages.add("slow", slow)
+        stages.add("interrupted", interrupted, main_thread=True)
+        start = time.time()
+        self.assertRaises(KeyboardInterrupt, stages.run, jobs=4)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(-signal.SIGTERM, result["returncode"])
+
+    def test_failure_stops_stages(self):
+        started = threading.Event()
+
+        def fail():
+            self.assertTrue(started.wait(10))
+            raise ValueError("stage failed")
+
+        def slow():
+            process = subprocess.Popen(["sleep", "60"])
+            started.set()
+            process.wait()
+
+        stages = StageGraph()
+        stages.add("slow", slow)
+        stages.add("fail", fail)
+        start = time.time()
+        self.assertRaisesRegex(ValueError, "stage failed", stages.run, jobs=4)
+        self.assertLess(time.time() - start, 10)
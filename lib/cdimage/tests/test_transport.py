@@ -0,0 +1,133 @@
+#! /usr/bin/python
+
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.transport."""
+
+import os
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from cdimage.config import Config
+from cdimage.osextras import FetchError
+from cdimage.tests.helpers import TestCase, mkfile
+from cdimage.transport import (
+    CopyTransport,
+    HTTPTransport,
+    HardlinkTransport,
+    TransferStats,
+    WgetTransport,
+    resolve_transport,
+    transfer_stats,
+)
+
+__metaclass__ = type
+
+
+class TestTransferStats(TestCase):
+    def test_summary(self):
+        stats = TransferStats()
+        self.assertEqual("", stats.summary())
+        stats.record("http", 100)
+        stats.record("hardlink", 10)
+        stats.record("http", 50)
+        self.assertEqual(
+            "hardlink: 1 files, 10 bytes, http: 2 files, 150 bytes",
+            stats.summary())
+        stats.reset()
+        self.assertEqual("", stats.summary())
+
+
+class TestTransports(TestCase):
+    def setUp(self):
+        super(TestTransports, self).setUp()
+        self.config = Config(read=False)
+        self.config.root = self.use_temp_dir()
+        self.source = os.path.join(self.temp_dir, "source")
+        with mkfile(self.source) as source:
+            source.write("squashfs")
+        self.target = os.path.join(self.temp_dir, "target")
+        transfer_stats.reset()
+        self.addCleanup(transfer_stats.reset)
+
+    def test_resolve_local_same_device(self):
+        self.assertIsInstance(
+            resolve_transport(self.config, self.source, self.target),
+            HardlinkTransport)
+
+    def test_resolve_local_other_device(self):
+        real_stat = os.stat
+
+        def stat_side_effect(path):
+            st = real_stat(path)
+            if path == self.source:
+                return mock.Mock(st_dev=st.st_dev + 1)
+            return st
+
+        with mock.patch("os.stat", side_effect=stat_side_effect):
+            self.assertIsInstance(
+                resolve_transport(self.config, self.source, self.target),
+                CopyTransport)
+
+    def test_resolve_remote(self):
+        self.assertIsInstance(
+            resolve_transport(
+                self.config, "https://example.org/source", self.target),
+            HTTPTransport)
+        self.assertIsInstance(
+            resolve_transport(
+                self.config, "ftp://example.org/source", self.target),
+            WgetTransport)
+
+    def test_hardlink(self):
+        HardlinkTransport(self.config).fetch(self.source, self.target)
+        self.assertEqual(
+            os.stat(self.source).st_ino, os.stat(self.target).st_ino)
+        self.assertEqual(
+            "hardlink: 1 files, 8 bytes", transfer_stats.summary())
+
+    def test_copy(self):
+        CopyTransport(self.config).fetch(self.source, self.target)
+        self.assertNotEqual(
+            os.stat(self.source).st_ino, os.stat(self.target).st_ino)
+        with open(self.target) as target:
+            self.assertEqual("squashfs", target.read())
+        self.assertIn(
+            transfer_stats.summary(),
+            ("copy: 1 files, 8 bytes", "reflink: 1 files, 8 bytes"))
+
+    @mock.patch("cdimage.download.Downloader.fetch")
+    def test_http(self, mock_fetch):
+        def fetch_side_effect(source, target):
+            with mkfile(target) as f:
+                f.write("downloaded")
+            return False
+
+        mock_fetch.side_effect = fetch_side_effect
+        HTTPTransport(self.config).fetch(
+            "http://example.org/source", self.target)
+        mock_fetch.assert_called_once_with(
+            "http://example.org/source", self.target)
+        self.assertEqual("http: 1 files, 10 bytes", transfer_stats.summary())
+
+    @mock.patch("subprocess.call", return_value=1)
+    def test_wget_failure(self, *args):
+        self.assertRaises(
+            FetchError, WgetTransport(self.config).fetch,
+            "ftp://example.org/source", self.target)
+        self.assertEqual("", transfer_stats.summary())
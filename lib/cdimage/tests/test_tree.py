@@ -19,6 +19,7 @@
 
 from __future__ import print_function
 
+import errno
 from functools import wraps
 try:
     from html.parser import HTMLParser
@@ -37,6 +38,7 @@ except ImportError:
 
 from cdimage import osextras
 from cdimage.config import Config, Series, all_series
+from cdimage.journal import PublishJournal
 from cdimage.tests.helpers import TestCase, date_to_time, mkfile, touch
 from cdimage.tree import (
     ChinaDailyTree,
@@ -2204,6 +2206,54 @@ class TestReleasePublisherMixin:
         self.assertLogEqual([])
         self.assertFalse(os.path.exists(md5sums_path))
 
+    def test_deferred_checksum_removals_dry_run(self):
+        other_dir = os.path.join(self.temp_dir, "other")
+        self.capture_logging()
+        publisher = self.get_publisher(dry_run=True)
+        with publisher.deferred_checksum_removals():
+            publisher.remove_checksum(self.temp_dir, "b")
+            publisher.remove_checksum(other_dir, "c")
+            publisher.remove_checksum(self.temp_dir, "a")
+            publisher.remove_checksum(self.temp_dir, "b")
+            self.assertLogEqual([])
+        self.assertLogEqual([
+            "checksum-remove --no-sign %s a b" % self.temp_dir,
+            "checksum-remove --no-sign %s c" % other_dir,
+        ])
+        self.assertIsNone(publisher.checksum_removals)
+
+    @mock.patch("cdimage.tree.ChecksumFileSet")
+    def test_deferred_checksum_removals(self, mock_checksum_file_set):
+        md5sums_path = os.path.join(self.temp_dir, "MD5SUMS")
+        with mkfile(md5sums_path) as md5sums:
+            print("checksum  a", file=md5sums)
+            print("checksum  b", file=md5sums)
+            print("checksum  c", file=md5sums)
+        publisher = self.get_publisher()
+        with publisher.deferred_checksum_removals():
+            publisher.remove_checksum(self.temp_dir, "a")
+            publisher.remove_checksum(self.temp_dir, "b")
+            self.assertEqual(0, mock_checksum_file_set.call_count)
+        mock_checksum_file_set.assert_called_once_with(
+            self.config, self.temp_dir, sign=False)
+        files = mock_checksum_file_set.return_value.__enter__.return_value
+        files.remove.assert_has_calls([mock.call("a"), mock.call("b")])
+
+    def test_deferred_checksum_removals_on_error(self):
+        md5sums_path = os.path.join(self.temp_dir, "MD5SUMS")
+        with mkfile(md5sums_path) as md5sums:
+            print("checksum  a", file=md5sums)
+            print("checksum  b", file=md5sums)
+        publisher = self.get_publisher()
+        try:
+            with publisher.deferred_checksum_removals():
+                publisher.remove_checksum(self.temp_dir, "a")
+                raise ValueError
+        except ValueError:
+            pass
+        with open(md5sums_path) as md5sums:
+            self.assertEqual("checksum *b\n", md5sums.read())
+
     def test_copy(self):
         old_path = os.path.join(self.temp_dir, "old")
         new_path = os.path.join(self.temp_dir, "new")
@@ -2213,6 +2263,23 @@ class TestReleasePublisherMixin:
         with open(new_path) as new:
             self.assertEqual("sentinel\n", new.read())
 
+    def test_copy_already_done(self):
+        old_path = os.path.join(self.temp_dir, "old")
+        new_path = os.path.join(self.temp_dir, "new")
+        touch(old_path)
+        publisher = self.get_publisher()
+        publisher.journal = PublishJournal(
+            os.path.join(self.temp_dir, ".journal"))
+        publisher.copy(old_path, new_path)
+        self.capture_logging()
+        with publisher.deferred_checksum_removals():
+            publisher.copy(old_path, new_path)
+            # The checksum is still recomputed.
+            self.assertEqual(
+                {self.temp_dir: set(["new"])}, publisher.checksum_removals)
+        self.assertLogEqual(
+            ["%s is unchanged since it was published" % new_path])
+
     def test_symlink(self):
         pool_path = os.path.join(self.temp_dir, ".pool", "foo.iso")
         touch(pool_path)
@@ -2257,6 +2324,95 @@ class TestReleasePublisherMixin:
                 "Template=ubuntu-13.04-alternate-amd64.template\n",
                 new.read())
 
+    def test_stage_directory(self):
+        live_dir = os.path.join(self.temp_dir, "live")
+        staging_dir = os.path.join(self.temp_dir, ".live.staging")
+        touch(os.path.join(live_dir, "foo.iso"))
+        touch(os.path.join(live_dir, "MD5SUMS"))
+        touch(os.path.join(live_dir, "source", "foo-src-1.iso"))
+        os.symlink("foo.iso", os.path.join(live_dir, "bar.iso"))
+        touch(os.path.join(staging_dir, "stale"))
+        self.get_publisher().stage_directory(live_dir, staging_dir)
+        self.assertCountEqual(
+            ["foo.iso", "bar.iso", "MD5SUMS", "source"],
+            os.listdir(staging_dir))
+        for name in "foo.iso", os.path.join("source", "foo-src-1.iso"):
+            self.assertEqual(
+                os.stat(os.path.join(live_dir, name)),
+                os.stat(os.path.join(staging_dir, name)))
+        self.assertNotEqual(
+            os.stat(os.path.join(live_dir, "MD5SUMS")).st_ino,
+            os.stat(os.path.join(staging_dir, "MD5SUMS")).st_ino)
+        self.assertEqual(
+            "foo.iso", os.readlink(os.path.join(staging_dir, "bar.iso")))
+
+    def test_stage_directory_resumes(self):
+        # An interrupted staging directory is reused while the live
+        # directory is unchanged.
+        live_dir = os.path.join(self.temp_dir, "live")
+        staging_dir = os.path.join(self.temp_dir, ".live.staging")
+        touch(os.path.join(live_dir, "foo.iso"))
+        publisher = self.get_publisher()
+        publisher.stage_directory(live_dir, staging_dir)
+        touch(os.path.join(staging_dir, "bar.iso"))
+        publisher.stage_directory(live_dir, staging_dir)
+        self.assertCountEqual(
+            ["foo.iso", "bar.iso"], os.listdir(staging_dir))
+        touch(os.path.join(live_dir, "baz.iso"))
+        publisher.stage_directory(live_dir, staging_dir)
+        self.assertCountEqual(
+            ["foo.iso", "baz.iso"], os.listdir(staging_dir))
+        publisher.swap_directory(staging_dir, live_dir)
+        self.assertEqual(["live"], os.listdir(self.temp_dir))
+
+    def test_stage_directory_first_publication(self):
+        live_dir = os.path.join(self.temp_dir, "live")
+        staging_dir = os.path.join(self.temp_dir, ".live.staging")
+        self.get_publisher().stage_directory(live_dir, staging_dir)
+        self.assertEqual([], os.listdir(staging_dir))
+        self.assertFalse(os.path.exists(live_dir))
+
+    def test_copy_staging(self):
+        # While staging, live files are replaced rather than rewritten.
+        source = os.path.join(self.temp_dir, "daily.iso")
+        target = os.path.join(self.temp_dir, ".pool", "foo.iso")
+        live_link = os.path.join(self.temp_dir, "live-foo.iso")
+        with mkfile(source) as f:
+            print("new", file=f)
+        with mkfile(target) as f:
+            print("old", file=f)
+        os.link(target, live_link)
+        publisher = self.get_publisher()
+        publisher.staged_dirs = {
+            os.path.join(self.temp_dir, "live"):
+                os.path.join(self.temp_dir, ".live.staging"),
+        }
+        publisher.copy(source, target)
+        with open(target) as f:
+            self.assertEqual("new\n", f.read())
+        with open(live_link) as f:
+            self.assertEqual("old\n", f.read())
+        self.assertEqual(["foo.iso"], os.listdir(os.path.dirname(target)))
+
+    @mock.patch("cdimage.osextras.rename_exchange")
+    def test_swap_directory(self, mock_rename_exchange):
+        live_dir = os.path.join(self.temp_dir, "live")
+        staging_dir = os.path.join(self.temp_dir, ".live.staging")
+        touch(os.path.join(live_dir, "old"))
+        touch(os.path.join(staging_dir, "new"))
+        mock_rename_exchange.side_effect = OSError(errno.ENOSYS, "")
+        self.get_publisher().swap_directory(staging_dir, live_dir)
+        self.assertEqual(["new"], os.listdir(live_dir))
+        self.assertEqual(["live"], os.listdir(self.temp_dir))
+
+    def test_swap_directory_new(self):
+        live_dir = os.path.join(self.temp_dir, "live")
+        staging_dir = os.path.join(self.temp_dir, ".live.staging")
+        touch(os.path.join(staging_dir, "new"))
+        self.get_publisher().swap_directory(staging_dir, live_dir)
+        self.assertEqual(["new"], os.listdir(live_dir))
+        self.assertEqual(["live"], os.listdir(self.temp_dir))
+
     def test_mkemptydir(self):
         path = os.path.join(self.temp_dir, "dir")
         touch(os.path.join(path, "name"))
@@ -2576,6 +2732,53 @@ class TestFullReleasePublisher(TestCase, TestReleasePublisherMixin):
         self.assertFalse(os.path.exists(os.path.join(
             self.temp_dir, "www", "simple")))
 
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_resume(self, mock_call, *args):
+        self.config["PROJECT"] = "kubuntu"
+        self.config["CAPPROJECT"] = "Kubuntu"
+        series = Series.latest()
+        self.config["DIST"] = series
+        self.config["ARCHES"] = "amd64 i386"
+        daily_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "daily-live", "20130327")
+        for arch in "amd64", "i386":
+            for ext in "iso", "manifest", "iso.zsync":
+                touch(os.path.join(
+                    daily_dir, "%s-desktop-%s.%s" % (series, arch, ext)))
+        target_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "releases", series.name,
+            "release")
+        self.capture_logging()
+        publisher = self.get_publisher(official="named")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertEqual(5, mock_call.call_count)
+
+        # Respin i386, then publish again.
+        with mkfile(os.path.join(
+                daily_dir, "%s-desktop-i386.iso" % series)) as iso:
+            print("respun", file=iso)
+        mock_call.reset_mock()
+        self.capture_logging()
+        publisher = self.get_publisher(official="named")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        target_base = os.path.join(
+            target_dir, "kubuntu-%s-desktop" % series.version)
+        unchanged = "%s is unchanged since it was published"
+        self.assertEqual([
+            unchanged % ("%s-amd64.iso" % target_base),
+            unchanged % ("%s-amd64.manifest" % target_base),
+            unchanged % ("%s-amd64.iso.zsync" % target_base),
+            unchanged % ("%s-amd64.iso.torrent" % target_base),
+            unchanged % ("%s-i386.manifest" % target_base),
+        ], [
+            message for message in self.captured_log_messages()
+            if message.endswith("unchanged since it was published")])
+        # zsyncmake and btmakemetafile for i386, and metalink generation.
+        self.assertEqual(3, mock_call.call_count)
+        with open("%s-i386.iso" % target_base) as iso:
+            self.assertEqual("respun\n", iso.read())
+
 
 class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
     def setUp(self):
@@ -2890,3 +3093,95 @@ class TestSimpleReleasePublisher(TestCase, TestReleasePublisherMixin):
             self.temp_dir, "www", "simple", ".manifest")))
         self.assertTrue(os.path.isdir(os.path.join(
             self.temp_dir, "www", "simple", ".trace")))
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_staging(self, mock_call, *args):
+        self.config["PROJECT"] = "kubuntu"
+        self.config["CAPPROJECT"] = "Kubuntu"
+        self.config["CDIMAGE_STAGE_RELEASE"] = "1"
+        series = Series.latest()
+        self.config["DIST"] = series
+        self.config["ARCHES"] = "amd64"
+        daily_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "daily-live", "20130327")
+        touch(os.path.join(daily_dir, "%s-desktop-amd64.iso" % series))
+        touch(os.path.join(daily_dir, "%s-desktop-amd64.manifest" % series))
+        pool_dir = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", ".pool")
+        target_dir = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", series.name)
+        staging_dir = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu",
+            ".%s.staging" % series.name)
+        beta_name = "kubuntu-%s-beta2-desktop-amd64.iso" % series.version
+        touch(os.path.join(pool_dir, beta_name))
+        os.makedirs(target_dir)
+        os.symlink(
+            os.path.join(os.pardir, ".pool", beta_name),
+            os.path.join(target_dir, beta_name))
+        other_path = os.path.join(target_dir, "kubuntu-other-amd64.iso")
+        touch(other_path)
+        other_stat = os.stat(other_path)
+        with mkfile(os.path.join(target_dir, "HEADER.html")) as header:
+            print("old header", file=header)
+        header_stat = os.stat(os.path.join(target_dir, "HEADER.html"))
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes", status="rc")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertEqual([
+            "Staging %s ..." % target_dir,
+            "Purging %s/%s" % (staging_dir, beta_name),
+            "Replacing %s ..." % target_dir,
+            "Purging %s/%s" % (pool_dir, beta_name),
+        ], [
+            message for message in self.captured_log_messages()
+            if message.startswith("Staging") or
+            message.startswith("Replacing") or
+            message.startswith("Purging")])
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertCountEqual([
+            ".htaccess", "FOOTER.html", "HEADER.html",
+            "MD5SUMS", "SHA1SUMS", "SHA256SUMS",
+            "kubuntu-other-amd64.iso",
+            "kubuntu-%s-rc-desktop-amd64.iso" % series.version,
+            "kubuntu-%s-rc-desktop-amd64.iso.torrent" % series.version,
+            "kubuntu-%s-rc-desktop-amd64.manifest" % series.version,
+        ], os.listdir(target_dir))
+        self.assertEqual(
+            os.path.join(
+                os.pardir, ".pool",
+                "kubuntu-%s-rc-desktop-amd64.iso" % series.version),
+            os.readlink(os.path.join(
+                target_dir,
+                "kubuntu-%s-rc-desktop-amd64.iso" % series.version)))
+        # Unchanged images are hard-linked; indices are rewritten in copies.
+        self.assertEqual(other_stat.st_ino, os.stat(other_path).st_ino)
+        self.assertNotEqual(
+            header_stat.st_ino,
+            os.stat(os.path.join(target_dir, "HEADER.html")).st_ino)
+        self.assertNotIn(beta_name, os.listdir(pool_dir))
+
+    @mock.patch("cdimage.osextras.find_on_path", return_value=True)
+    @mock.patch("subprocess.call", side_effect=call_btmakemetafile_zsyncmake)
+    def test_publish_release_staging_first(self, mock_call, *args):
+        self.config["PROJECT"] = "kubuntu"
+        self.config["CAPPROJECT"] = "Kubuntu"
+        self.config["CDIMAGE_STAGE_RELEASE"] = "1"
+        series = Series.latest()
+        self.config["DIST"] = series
+        self.config["ARCHES"] = "amd64"
+        daily_dir = os.path.join(
+            self.temp_dir, "www", "full", "kubuntu", "daily-live", "20130327")
+        touch(os.path.join(daily_dir, "%s-desktop-amd64.iso" % series))
+        touch(os.path.join(daily_dir, "%s-desktop-amd64.manifest" % series))
+        target_dir = os.path.join(
+            self.temp_dir, "www", "simple", "kubuntu", series.name)
+        self.capture_logging()
+        publisher = self.get_publisher(official="yes", status="rc")
+        publisher.publish_release("daily-live", "20130327", "desktop")
+        self.assertFalse(os.path.exists(os.path.join(
+            os.path.dirname(target_dir), ".%s.staging" % series.name)))
+        self.assertIn(
+            "kubuntu-%s-rc-desktop-amd64.iso" % series.version,
+            os.listdir(target_dir))
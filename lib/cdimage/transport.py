@@ -0,0 +1,168 @@
+# Copyright (C) 2026 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Strategies for fetching files into place.
+
+Each source is resolved to exactly one transport: a hardlink for local
+files on the same filesystem as the target, a copy (by reflink where the
+filesystem supports it) for other local files, the native downloader for
+HTTP and HTTPS, and wget for anything else.
+"""
+
+from collections import defaultdict
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+from cdimage.download import get_downloader
+from cdimage.osextras import FetchError, unlink_force
+from cdimage.proxy import proxy_call
+
+__metaclass__ = type
+
+
+# From <linux/fs.h>: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+
+class TransferStats:
+    """Count the files and bytes fetched by each transport."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def record(self, name, size):
+        with self.lock:
+            self.files[name] += 1
+            self.bytes[name] += size
+
+    def reset(self):
+        with self.lock:
+            self.files.clear()
+            self.bytes.clear()
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(
+                "%s: %d files, %d bytes" % (name, self.files[name],
+                                            self.bytes[name])
+                for name in sorted(self.files))
+
+
+transfer_stats = TransferStats()
+
+
+class Transport:
+    """A way of fetching a file into place."""
+
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def transfer(self, source, target):
+        """Fetch SOURCE to TARGET, returning the name to record it under."""
+        raise NotImplementedError
+
+    def fetch(self, source, target):
+        name = self.transfer(source, target)
+        try:
+            size = os.path.getsize(target)
+        except OSError:
+            size = 0
+        transfer_stats.record(name, size)
+
+
+class HardlinkTransport(Transport):
+    name = "hardlink"
+
+    def transfer(self, source, target):
+        os.link(source, target)
+        return self.name
+
+
+class CopyTransport(Transport):
+    name = "copy"
+
+    def transfer(self, source, target):
+        with open(source, "rb") as source_file:
+            with open(target, "wb") as target_file:
+                try:
+                    fcntl.ioctl(target_file, FICLONE, source_file.fileno())
+                    name = "reflink"
+                except (IOError, OSError) as e:
+                    if e.errno not in (
+                            errno.EBADF, errno.EINVAL, errno.ENOTTY,
+                            errno.EOPNOTSUPP, errno.EXDEV):
+                        raise
+                    shutil.copyfileobj(source_file, target_file)
+                    name = self.name
+        shutil.copystat(source, target)
+        return name
+
+
+class HTTPTransport(Transport):
+    name = "http"
+
+    def transfer(self, source, target):
+        if get_downloader(self.config).fetch(source, target):
+            return "http-cache"
+        return self.name
+
+
+class WgetTransport(Transport):
+    name = "wget"
+
+    def transfer(self, source, target):
+        # Match lazr.restfulclient, for convenience when working with
+        # development instances of Launchpad.
+        no_check_certificate = bool(
+            os.environ.get('LP_DISABLE_SSL_CERTIFICATE_VALIDATION', False))
+
+        command = ["wget", "-nv"]
+        if no_check_certificate:
+            command.append("--no-check-certificate")
+        command.extend([source, "-O", target])
+        ret = proxy_call(self.config, "fetch", command)
+        if ret != 0:
+            unlink_force(target)
+            command_str = "wget -nv"
+            if no_check_certificate:
+                command_str += " --no-check-certificate"
+            command_str += " '%s' -O '%s'" % (source, target)
+            raise FetchError("%s returned %d" % (command_str, ret))
+        return self.name
+
+
+def resolve_transport(config, source, target):
+    """Return the transport to use to fetch SOURCE to TARGET."""
+    if source.startswith("/"):
+        try:
+            same_device = (
+                os.stat(source).st_dev ==
+                os.stat(os.path.dirname(target) or ".").st_dev)
+        except OSError:
+            same_device = True
+        if same_device:
+            return HardlinkTransport(config)
+        else:
+            return CopyTransport(config)
+    elif source.startswith(("http://", "https://")):
+        return HTTPTransport(config)
+    else:
+        return WgetTransport(config)
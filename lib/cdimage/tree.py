@@ -19,9 +19,11 @@
 
 from __future__ import print_function
 
+import contextlib
 import errno
 from itertools import count
 from optparse import OptionParser
+import json
 import os
 import re
 try:
@@ -44,6 +46,8 @@ from cdimage.checksums import (
     metalink_checksum_directory,
 )
 from cdimage.config import Series, Touch
+from cdimage.journal import PublishJournal
+from cdimage.locking import Lock, LockError
 from cdimage.log import logger, reset_logging
 from cdimage.mirror import trigger_mirrors
 from cdimage import osextras
@@ -2575,11 +2579,12 @@ class DailyTreePublisher(Publisher):
             self.mark_current(date, current_arches)
         self.set_link_descriptions()
 
-        manifest_lock = os.path.join(
-            self.config.root, "etc", ".lock-manifest-daily")
+        manifest_lock = Lock(
+            os.path.join(self.config.root, "etc", ".lock-manifest-daily"),
+            timeout=60)
         try:
-            subprocess.check_call(["lockfile", "-r", "4", manifest_lock])
-        except subprocess.CalledProcessError:
+            manifest_lock.acquire()
+        except LockError:
             logger.error("Couldn't acquire manifest-daily lock!")
             raise
         try:
@@ -2598,7 +2603,7 @@ class DailyTreePublisher(Publisher):
             with open(os.path.join(trace_dir, fqdn), "w") as trace_file:
                 subprocess.check_call(["date", "-u"], stdout=trace_file)
         finally:
-            osextras.unlink_force(manifest_lock)
+            manifest_lock.release()
 
         self.post_qa(date, published)
 
@@ -2913,6 +2918,20 @@ class ReleasePublisher(Publisher):
         self.official = official
         self.status = status if status else "release"
         self.dry_run = dry_run
+        # While publishing, checksum removals are journalled here by
+        # directory rather than being applied immediately.
+        self.checksum_removals = None
+        # Completed operations are recorded here while publishing, so that
+        # an interrupted publication can be resumed cheaply.
+        self.journal = None
+        # Map live release directories to the staging directories in which
+        # they are being assembled.
+        self.staged_dirs = {}
+
+    @property
+    def staging(self):
+        """Should release directories be assembled and swapped in whole?"""
+        return bool(self.config["CDIMAGE_STAGE_RELEASE"])
 
     def daily_dir(self, source, date, publish_type):
         daily_tree = Tree.get_daily(self.config)
@@ -2938,16 +2957,45 @@ class ReleasePublisher(Publisher):
     def version_link(self, source):
         raise NotImplementedError
 
+    def release_dir(self, source, date, publish_type):
+        """Return the directory currently being published into.
+
+        This is the target directory, or its staging directory if it is
+        being staged.
+        """
+        target_dir = self.target_dir(source, date, publish_type)
+        return self.staged_dirs.get(target_dir, target_dir)
+
     def pool_dir(self, source):
         raise NotImplementedError
 
     def torrent_dir(self, source, publish_type):
         raise NotImplementedError
 
+    @property
+    def journal_path(self):
+        return os.path.join(self.tree.directory, ".publish-journal")
+
+    def already_done(self, operation, source, target):
+        """Has this operation been completed by a previous run?"""
+        if self.journal is None:
+            return False
+        if not self.journal.is_complete(operation, source, target):
+            return False
+        logger.info("%s is unchanged since it was published" % target)
+        return True
+
+    def journal_record(self, operation, source, target):
+        if self.journal is not None:
+            self.journal.record(operation, source, target)
+
     def make_torrent(self, path):
+        torrent_path = "%s.torrent" % path
+        if self.already_done("torrent", path, torrent_path):
+            return
         if not self.dry_run:
             logger.info("Creating torrent for %s ..." % path)
-        osextras.unlink_force("%s.torrent" % path)
+        osextras.unlink_force(torrent_path)
         command = ["btmakemetafile", self.torrent_tracker]
         if isinstance(self.tree, SimpleReleaseTree):
             # N.B.: Only the bittornado version of btmakemetafile has
@@ -2967,6 +3015,7 @@ class ReleasePublisher(Publisher):
         else:
             with open("/dev/null", "w") as devnull:
                 subprocess.check_call(command, stdout=devnull)
+            self.journal_record("torrent", path, torrent_path)
 
     def make_torrents(self, directory, prefix):
         images = []
@@ -3028,14 +3077,80 @@ class ReleasePublisher(Publisher):
             func(*args, **kwargs)
 
     def remove_checksum(self, directory, name):
-        if self.dry_run:
-            logger.info("checksum-remove --no-sign %s %s" % (directory, name))
+        if self.checksum_removals is not None:
+            self.checksum_removals.setdefault(directory, set()).add(name)
         else:
-            with ChecksumFileSet(self.config, directory, sign=False) as files:
-                files.remove(name)
+            self.apply_checksum_removals({directory: set([name])})
+
+    def apply_checksum_removals(self, removals):
+        """Remove entries from the checksums files in each directory.
+
+        Each directory's checksums files are read and rewritten only once,
+        however many entries are removed from them.
+        """
+        for directory in sorted(removals):
+            names = sorted(removals[directory])
+            if not names:
+                continue
+            if self.dry_run:
+                logger.info("checksum-remove --no-sign %s %s" % (
+                    directory, " ".join(names)))
+            else:
+                with ChecksumFileSet(
+                        self.config, directory, sign=False) as files:
+                    for name in names:
+                        files.remove(name)
+
+    @contextlib.contextmanager
+    def deferred_checksum_removals(self):
+        """Journal checksum removals, applying them all on exit.
+
+        This avoids rewriting the same checksums files once for every file
+        copied into a directory.  The journal is applied even if
+        publication fails, so that stale entries are never left behind.
+        """
+        if self.checksum_removals is not None:
+            yield
+            return
+        self.checksum_removals = {}
+        try:
+            yield
+        finally:
+            removals = self.checksum_removals
+            self.checksum_removals = None
+            self.apply_checksum_removals(removals)
+
+    @contextlib.contextmanager
+    def replacing(self, target):
+        """Yield a path to write in place of TARGET.
+
+        While release directories are being staged, TARGET may be a live
+        file, such as one in the pool, or hard-linked to one.  It is then
+        written under a temporary name and renamed into place, so that the
+        live file is never seen half-written.
+        """
+        if not self.staged_dirs or self.dry_run:
+            yield target
+            return
+        new_target = os.path.join(
+            os.path.dirname(target), ".%s.new" % os.path.basename(target))
+        osextras.unlink_force(new_target)
+        try:
+            yield new_target
+        except Exception:
+            osextras.unlink_force(new_target)
+            raise
+        os.rename(new_target, target)
 
     def copy(self, source, target):
-        self.do("cp -a %s %s" % (source, target), shutil.copy2, source, target)
+        if not self.already_done("copy", source, target):
+            with self.replacing(target) as path:
+                self.do(
+                    "cp -a %s %s" % (source, target),
+                    shutil.copy2, source, path)
+            self.journal_record("copy", source, target)
+        # A previous run may have been interrupted after copying but before
+        # checksumming, so the checksums are always recomputed.
         self.remove_checksum(os.path.dirname(target), os.path.basename(target))
 
     def symlink(self, source, link_name):
@@ -3063,9 +3178,126 @@ class ReleasePublisher(Publisher):
             return
         source_pat = "=%s" % os.path.basename(source).rsplit(".", 1)[0]
         target_pat = "=%s" % os.path.basename(target).rsplit(".", 1)[0]
-        with open(source) as sf, open(target, "w") as tf:
-            for line in sf:
-                tf.write(line.replace(source_pat, target_pat))
+        with self.replacing(target) as path:
+            with open(source) as sf, open(path, "w") as tf:
+                for line in sf:
+                    tf.write(line.replace(source_pat, target_pat))
+
+    @staticmethod
+    def _live_dir_identity(live_dir):
+        try:
+            st = os.stat(live_dir)
+        except OSError:
+            return None
+        return [st.st_dev, st.st_ino, st.st_mtime]
+
+    def stage_directory(self, live_dir, staging_dir):
+        """Assemble a copy of live_dir in staging_dir.
+
+        A staging directory left behind by an interrupted publication is
+        reused if live_dir has not changed since it was assembled, so that
+        the journal can skip the copies already made into it.  Otherwise it
+        is discarded.  Unchanged images are hard-linked rather than copied;
+        checksums files and indices are carried over so that they can be
+        updated incrementally.
+        """
+        if self.dry_run:
+            logger.info("Would stage %s in %s" % (live_dir, staging_dir))
+            return
+        stamp_path = "%s.json" % staging_dir
+        identity = self._live_dir_identity(live_dir)
+        try:
+            with open(stamp_path) as stamp:
+                staged_identity = json.load(stamp).get("live")
+        except (IOError, OSError, ValueError):
+            staged_identity = False
+        if staged_identity == identity and os.path.isdir(staging_dir):
+            logger.info("Resuming staging of %s ..." % live_dir)
+            return
+        logger.info("Staging %s ..." % live_dir)
+        osextras.unlink_force(stamp_path)
+        if os.path.lexists(staging_dir):
+            shutil.rmtree(staging_dir)
+        osextras.ensuredir(os.path.dirname(staging_dir))
+        os.mkdir(staging_dir)
+        if identity is not None:
+            self._copy_to_staging(live_dir, staging_dir)
+        # Only a completely assembled staging directory may be reused.
+        with AtomicFile(stamp_path) as stamp:
+            json.dump({"live": identity}, stamp)
+
+    def _copy_to_staging(self, live_dir, staging_dir):
+        # Large images are hard-linked, since publication always replaces
+        # them rather than rewriting them in place.  Everything else is
+        # small, and is copied so that it can safely be rewritten.
+        checksum_files = ChecksumFileSet(self.config, live_dir, sign=False)
+        for dirpath, dirnames, filenames in os.walk(live_dir):
+            relpath = os.path.relpath(dirpath, live_dir)
+            staged_dirpath = os.path.normpath(
+                os.path.join(staging_dir, relpath))
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                staged_path = os.path.join(staged_dirpath, name)
+                if name.startswith(".") and (
+                        name.endswith(".staging") or name.endswith(".old")):
+                    dirnames.remove(name)
+                elif os.path.islink(path):
+                    os.symlink(os.readlink(path), staged_path)
+                else:
+                    os.mkdir(staged_path)
+                    shutil.copystat(path, staged_path)
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                staged_path = os.path.join(staged_dirpath, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), staged_path)
+                elif (checksum_files.want_image(name) or
+                      name.endswith(".template")):
+                    os.link(path, staged_path)
+                else:
+                    shutil.copy2(path, staged_path)
+        shutil.copystat(live_dir, staging_dir)
+
+    def swap_directory(self, staging_dir, live_dir):
+        """Atomically replace live_dir with staging_dir."""
+        if self.dry_run:
+            logger.info("Would replace %s with %s" % (live_dir, staging_dir))
+            return
+        logger.info("Replacing %s ..." % live_dir)
+        osextras.unlink_force("%s.json" % staging_dir)
+        if not os.path.isdir(live_dir):
+            os.rename(staging_dir, live_dir)
+            return
+        try:
+            osextras.rename_exchange(staging_dir, live_dir)
+            old_dir = staging_dir
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+            # Fall back to two renames, leaving a very brief window in which
+            # live_dir does not exist.
+            old_dir = os.path.join(
+                os.path.dirname(live_dir),
+                ".%s.old" % os.path.basename(live_dir))
+            if os.path.lexists(old_dir):
+                shutil.rmtree(old_dir)
+            os.rename(live_dir, old_dir)
+            os.rename(staging_dir, live_dir)
+        shutil.rmtree(old_dir)
+
+    def purge_old_images(self, purge_dir, prefix, prefix_status):
+        for entry in os.listdir(purge_dir):
+            if not entry.startswith("%s-" % prefix):
+                continue
+            # TODO: This test is wrong, but cumbersome to fix.  For example,
+            # consider the existence of
+            # ubuntu-13.04-beta2-preinstalled-desktop-armhf+omap4.img while
+            # publishing ubuntu-13.04.
+            if entry.startswith("%s-" % prefix_status):
+                continue
+            entry_path = os.path.join(purge_dir, entry)
+            logger.info("Purging %s" % entry_path)
+            self.remove(entry_path)
 
     def mkemptydir(self, path):
         if self.dry_run:
@@ -3074,6 +3306,17 @@ class ReleasePublisher(Publisher):
         else:
             osextras.mkemptydir(path)
 
+    def zsyncmake(self, infile, outfile):
+        if self.already_done("zsync", infile, outfile):
+            return
+        with self.replacing(outfile) as path:
+            if path == outfile:
+                self.remove(outfile)
+            zsyncmake(
+                infile, path, os.path.basename(infile), dry_run=self.dry_run)
+        if not self.dry_run:
+            self.journal_record("zsync", infile, outfile)
+
     def checksum_directory(self, dirs, map_expr=None):
         self.do(
             "checksum-directory %s%s" % (
@@ -3135,12 +3378,12 @@ class ReleasePublisher(Publisher):
 
         def dist(ext, sep="."):
             return os.path.join(
-                self.target_dir(source, date, publish_type),
+                self.release_dir(source, date, publish_type),
                 "%s%s%s" % (base_status, sep, ext))
 
         def full(ext, sep="."):
             return os.path.join(
-                self.target_dir(source, date, publish_type),
+                self.release_dir(source, date, publish_type),
                 "%s%s%s" % (base_plain, sep, ext))
 
         def torrent(ext, sep="."):
@@ -3235,17 +3478,11 @@ class ReleasePublisher(Publisher):
             if self.want_pool:
                 if osextras.find_on_path("zsyncmake"):
                     logger.info("Making %s zsync metafile ..." % arch)
-                    self.remove(pool(zsyncext))
-                    zsyncmake(
-                        pool(ext), pool(zsyncext), os.path.basename(pool(ext)),
-                        dry_run=self.dry_run)
+                    self.zsyncmake(pool(ext), pool(zsyncext))
             elif self.want_full and self.official == "named":
                 if osextras.find_on_path("zsyncmake"):
                     logger.info("Making %s zsync metafile ..." % arch)
-                    self.remove(full(zsyncext))
-                    zsyncmake(
-                        full(ext), full(zsyncext), os.path.basename(full(ext)),
-                        dry_run=self.dry_run)
+                    self.zsyncmake(full(ext), full(zsyncext))
             elif self.want_full:
                 self.copy(daily(zsyncext), full(zsyncext))
             if self.want_dist:
@@ -3341,7 +3578,19 @@ class ReleasePublisher(Publisher):
         if self.want_pool:
             self.do("mkdir -p %s" % pool_dir, osextras.ensuredir, pool_dir)
         if self.want_dist or self.want_full:
-            self.do("mkdir -p %s" % target_dir, osextras.ensuredir, target_dir)
+            if self.staging:
+                # Assemble the release directory next to the live one, and
+                # swap it in once it is complete, so that mirrors never see
+                # a half-published release.
+                live_target_dir = target_dir
+                target_dir = os.path.join(
+                    os.path.dirname(live_target_dir),
+                    ".%s.staging" % os.path.basename(live_target_dir))
+                self.stage_directory(live_target_dir, target_dir)
+                self.staged_dirs[live_target_dir] = target_dir
+            else:
+                self.do(
+                    "mkdir -p %s" % target_dir, osextras.ensuredir, target_dir)
             if series.name != series.version:
                 version_link = self.version_link(source)
                 if not os.path.islink(version_link):
@@ -3372,38 +3621,36 @@ class ReleasePublisher(Publisher):
                         self.remove_tree(entry_path)
                 self.mkemptydir(torrent_dir)
 
+        self.journal = PublishJournal(self.journal_path, dry_run=self.dry_run)
+
         logger.info("Constructing release trees ...")
-        for arch in arches:
-            self.publish_release_arch(source, date, publish_type, arch)
+        # Checksums files are rewritten at most once per directory, before
+        # they are regenerated below.
+        with self.deferred_checksum_removals():
+            for arch in arches:
+                self.publish_release_arch(source, date, publish_type, arch)
+
+            if publish_type in ("uec", "server-uec"):
+                for name in (
+                    "published-ec2-release.txt", "tool-version-info.txt",
+                    "build-info.txt",
+                ):
+                    path = os.path.join(daily_dir, name)
+                    if not os.path.exists(path):
+                        continue
+                    if self.want_dist or self.want_full:
+                        self.copy(path, os.path.join(target_dir, name))
 
         # There can only be one set of images per release in the per-release
         # tree, so if we're publishing there then we can now safely clean up
         # previous images for that release.
-        if self.want_dist and not self.config["CDIMAGE_NO_PURGE"]:
-            for purge_dir in target_dir, pool_dir:
-                for entry in os.listdir(purge_dir):
-                    if not entry.startswith("%s-" % prefix):
-                        continue
-                    # TODO: This test is wrong, but cumbersome to fix.  For
-                    # example, consider the existence of
-                    # ubuntu-13.04-beta2-preinstalled-desktop-armhf+omap4.img
-                    # while publishing ubuntu-13.04.
-                    if entry.startswith("%s-" % prefix_status):
-                        continue
-                    entry_path = os.path.join(purge_dir, entry)
-                    logger.info("Purging %s" % entry_path)
-                    self.remove(entry_path)
-
-        if publish_type in ("uec", "server-uec"):
-            for name in (
-                "published-ec2-release.txt", "tool-version-info.txt",
-                "build-info.txt",
-            ):
-                path = os.path.join(daily_dir, name)
-                if not os.path.exists(path):
-                    continue
-                if self.want_dist or self.want_full:
-                    self.copy(path, os.path.join(target_dir, name))
+        purge = self.want_dist and not self.config["CDIMAGE_NO_PURGE"]
+        if purge:
+            self.purge_old_images(target_dir, prefix, prefix_status)
+            # Old images in the pool may still be linked from the live
+            # release directory until the staging directory replaces it.
+            if not self.staged_dirs:
+                self.purge_old_images(pool_dir, prefix, prefix_status)
 
         if self.want_dist:
             self.do(
@@ -3424,6 +3671,23 @@ class ReleasePublisher(Publisher):
             self.checksum_directory(
                 [target_dir, daily_dir],
                 map_expr="s/^%s-/%s-/" % (prefix_status, series))
+        if self.want_full:
+            logger.info("Checksumming full tree ...")
+            self.checksum_directory(
+                [target_dir, daily_dir],
+                map_expr="s/^%s-/%s-/" % (prefix, series))
+
+        if self.staged_dirs:
+            for live_dir, staging_dir in sorted(self.staged_dirs.items()):
+                self.swap_directory(staging_dir, live_dir)
+            self.staged_dirs = {}
+            target_dir = live_target_dir
+            if purge and self.want_pool:
+                self.purge_old_images(pool_dir, prefix, prefix_status)
+
+        # Metalink files embed paths relative to the tree, so these are only
+        # generated once the release directory is in place.
+        if self.want_dist:
             if self.want_metalink(publish_type):
                 logger.info(
                     "Creating and publishing metalink files for the simple "
@@ -3431,10 +3695,6 @@ class ReleasePublisher(Publisher):
                 self.make_metalink(
                     target_dir, self.metalink_version, dry_run=self.dry_run)
         if self.want_full:
-            logger.info("Checksumming full tree ...")
-            self.checksum_directory(
-                [target_dir, daily_dir],
-                map_expr="s/^%s-/%s-/" % (prefix, series))
             if self.want_metalink(publish_type):
                 logger.info(
                     "Creating and publishing metalink files for the full "